@@ -8,10 +8,14 @@
 # Description: 
 #
 
+import json
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import azure.functions as func
 import requests
+from requests.adapters import HTTPAdapter
 
 # Linear flow for escape room
 #                 1. Players enter escape room and clues lead to shine light on portrait.
@@ -23,46 +27,56 @@ import requests
 #                 7. Clues lead to passcode.
 # PasscodeTrigger 8. Entering passcode triggers, activating the GUI to complete escape room.
 
-# Flow configuration is a dictionary with the following structure
+# The flow is defined in a JSON file shared with the gateway (python/flows/escape_room_flow.json).
+# Its "triggers" section is the flow configuration used here:
 #      keys => Trigger Names
 #      values => List of Commands
+# Set FLOW_DEFINITION_PATH to use a different flow file.
 
-flow_configuration = {
-    "LightTrigger":
-        [{"NAME":"SetState", "TNID":"4", "AID":"1", "S":"1"}],
-
-    "ButtonTrigger":
-        [{"NAME":"SetState", "TNID":"6", "AID":"1", "S":"1"}],
-
-    "StepTrigger":
-        [{"NAME":"SetState", "TNID":"8", "AID":"1", "S":{
-                "IsComplete": "0",
-                "HeaderText": "Escape!",
-                "HeaderVisible":"1",
-                "InstructionsText": "Enter the passcode",
-                "InstructionsVisible":"1",
-                "ButtonText": "Submit",
-                "ButtonVisible":"1",
-                "Passcode": "123",
-                "PasscodeVisible":"1"
-            }}],
-
-    "PasscodeTrigger":
-        [{"NAME":"SetState", "TNID":"8", "AID":"1", "S":{
-                "IsComplete": "1",
-                "HeaderText": "Complete!",
-                "HeaderVisible":"1",
-                "InstructionsText": "",
-                "InstructionsVisible":"0",
-                "ButtonText": "",
-                "ButtonVisible":"0",
-                "Passcode": "",
-                "PasscodeVisible":"0"
-            }}]
-}
-
-
-def send_command(command):
+FLOW_DEFINITION_FILE = "escape_room_flow.json"
+
+
+def find_flow_definition():
+    """Return the path of the flow definition file.
+
+    Looks at FLOW_DEFINITION_PATH, then next to this file (where it is
+    deployed), then in the repository's python/flows directory.
+    """
+    if os.environ.get("FLOW_DEFINITION_PATH"):
+        return os.environ["FLOW_DEFINITION_PATH"]
+    here = os.path.dirname(os.path.abspath(__file__))
+    deployed = os.path.join(here, FLOW_DEFINITION_FILE)
+    if os.path.exists(deployed):
+        return deployed
+    return os.path.join(here, "..", "..", "python", "flows", FLOW_DEFINITION_FILE)
+
+
+def load_flow_configuration(path):
+    """Load the trigger name => list of commands mapping from a flow definition file."""
+    with open(path, "r") as f:
+        return json.load(f)["triggers"]
+
+
+flow_configuration = load_flow_configuration(find_flow_definition())
+
+
+# IoT Central application the commands are sent to. Set IOTC_APP_URL to use a
+# different application, or a local stand-in (see cloud/loadtest).
+IOTC_APP_URL = os.environ.get("IOTC_APP_URL", "https://csce838escaperoom.azureiotcentral.com").rstrip("/")
+
+# Commands of a trigger are sent concurrently. The session and worker pool are
+# module level so warm invocations reuse their keep-alive connections to IoT Central.
+COMMAND_WORKERS = 8
+COMMAND_TIMEOUT = (3.05, 10)  # (connect, read) seconds for each command
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=COMMAND_WORKERS)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+executor = ThreadPoolExecutor(max_workers=COMMAND_WORKERS)
+
+
+def send_command(command, timeout=COMMAND_TIMEOUT):
     """Run command on IoT Central device.
     
     command : dictionary with keys 
@@ -70,24 +84,52 @@ def send_command(command):
         "TNID" - target node ID (end-device)
         "AID" - activation ID (lives on end-device)
         "S" - state to be set on activation
+    timeout : requests timeout for the call
 
     returns response to command
     """
     # defining the api-endpoint and body based on the command
-    API_ENDPOINT = f"https://csce838escaperoom.azureiotcentral.com/api/devices/EscapeRoomApp/commands/{command['NAME']}?api-version=2022-07-31"
+    API_ENDPOINT = f"{IOTC_APP_URL}/api/devices/EscapeRoomApp/commands/{command['NAME']}?api-version=2022-07-31"
 
     body = {'request':command}
 
     # set api authorization
     headers = {'Authorization': "SharedAccessSignature sr=025a11fa-3ac4-4179-a64e-7a017ccd622a&sig=F3RrMY3kpN8WsNuKke3ScTzyDWXp%2BFudq3noTeoFHz4%3D&skn=CommandDevices&se=1700782146808"}
 
-    # sending post request and saving response as response object
-    r = requests.post(url = API_ENDPOINT, headers=headers, json=body)
+    # sending post request over the shared session and saving response as response object
+    r = session.post(url = API_ENDPOINT, headers=headers, json=body, timeout=timeout)
+    r.raise_for_status()
     
     # extracting response text 
     return r.text
 
 
+def send_commands(commands, trace_id=None):
+    """Send a trigger's commands concurrently.
+
+    trace_id : the trigger's trace ID ("TRID"), copied into each command so
+        the gateway can match the command to the frame that caused it
+
+    returns a list with one (command, ok, response text or error) tuple per
+    command, in the order of commands
+    """
+    if trace_id is not None:
+        commands = [dict(command, TRID=trace_id) for command in commands]
+    futures = [executor.submit(send_command, command) for command in commands]
+    results = []
+    for command, future in zip(commands, futures):
+        try:
+            results.append((command, True, future.result()))
+        except requests.RequestException as e:
+            results.append((command, False, f"{type(e).__name__}: {e}"))
+        except Exception as e:
+            # Anything else (e.g. an unexpected response) fails only this
+            # command, so the others are still reported
+            logging.exception(f"Command {command.get('NAME')} TNID {command.get('TNID')} failed")
+            results.append((command, False, f"{type(e).__name__}: {e}"))
+    return results
+
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """Activate devices with commands based on which device triggers the function."""
     trigger = req.get_json()
@@ -95,12 +137,16 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     # Flow configuration connects a trigger with a list of commands to activate
     commands = flow_configuration[trigger['NAME']]
 
-    responses = []
-    for command in commands:
-        responses.append(send_command(command))
+    results = send_commands(commands, trigger.get('TRID'))
+    failed = sum(1 for _, ok, _ in results if not ok)
 
-    logging.info(f"Python HTTP trigger function processed a request. {trigger['NAME']}")
+    logging.info(f"Python HTTP trigger function processed a request. {trigger['NAME']} trace {trigger.get('TRID')} ({len(results) - failed} sent, {failed} failed)")
 
-    responses = '\n'.join(responses)
+    responses = '\n'.join(
+        f"{command['NAME']} TNID {command.get('TNID')} AID {command.get('AID')}: {'OK' if ok else 'FAILED'} {text}"
+        for command, ok, text in results
+    )
 
+    if failed:
+        return func.HttpResponse(f"Trigger {trigger['NAME']} had {failed} of {len(results)} commands fail.\nCommand responses:\n{responses}", status_code=502)
     return func.HttpResponse(f"Trigger {trigger['NAME']} executed successfully.\nCommand responses:\n{responses}", status_code=200)
@@ -0,0 +1,152 @@
+# Escape Room Project
+#
+# Load test for the Azure Trigger Function
+#
+# Description:
+# Calls the trigger function's main() in-process with synthetic HTTP requests
+# at a fixed rate, against the local IoT Central stand-in (mock_iotc.py) or
+# any URL given with --iotc-url, and reports throughput and p50/p99 latency
+# for each trigger name. Needs the function's requirements installed.
+#
+#     python load_test.py --rate 50 --duration 30 --latency 0.05
+#     python load_test.py --triggers LightTrigger ButtonTrigger --json results.json
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_iotc import MockIoTCentral
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FUNCTION_DIR = os.path.join(HERE, "..", "Azure Trigger Function")
+
+
+def load_trigger_function(iotc_url):
+    """Import the trigger function with its commands pointed at iotc_url."""
+    os.environ["IOTC_APP_URL"] = iotc_url
+    spec = importlib.util.spec_from_file_location("trigger_function", os.path.join(FUNCTION_DIR, "__init__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def run(function, triggers, rate, duration, concurrency):
+    """Call function.main() rate times a second for duration seconds, cycling through triggers.
+
+    Requests are started on schedule whether or not earlier ones have finished
+    (up to concurrency at once), so a slow function shows up as latency instead
+    of as a lower offered rate.
+
+    returns trigger name => list of (latency seconds, status code)
+    """
+    import azure.functions as func
+
+    results = {name: [] for name in triggers}
+    lock = threading.Lock()
+
+    def call(name):
+        req = func.HttpRequest(method="POST", url="/api/trigger", body=json.dumps({"NAME": name}).encode())
+        start = time.perf_counter()
+        try:
+            status = function.main(req).status_code
+        except Exception:
+            status = None
+        latency = time.perf_counter() - start
+        with lock:
+            results[name].append((latency, status))
+
+    total = int(rate * duration)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        for i in range(total):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(call, triggers[i % len(triggers)])
+    return results
+
+
+def summarize(results, elapsed):
+    """Per-trigger request count, errors, throughput and latency percentiles (ms)."""
+    summary = {}
+    for name, samples in results.items():
+        latencies = sorted(latency for latency, _ in samples)
+        errors = sum(1 for _, status in samples if status != 200)
+        summary[name] = {
+            "requests": len(samples),
+            "errors": errors,
+            "throughput_per_second": len(samples) / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+            "max_ms": latencies[-1] * 1000 if latencies else None,
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'trigger':<18}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, s in summary.items():
+        if not s["requests"]:
+            print(f"{name:<18}{0:>10}")
+            continue
+        print(f"{name:<18}{s['requests']:>10}{s['errors']:>8}{s['throughput_per_second']:>9.1f}"
+              f"{s['p50_ms']:>10.1f}{s['p99_ms']:>10.1f}{s['max_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the trigger function against a local IoT Central stand-in")
+    parser.add_argument("--rate", type=float, default=20.0, help="trigger requests per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--concurrency", type=int, default=64, help="most requests in flight at once")
+    parser.add_argument("--triggers", nargs="+", help="trigger names to cycle through (default: every trigger in the flow)")
+    parser.add_argument("--iotc-url", help="IoT Central URL to send commands to instead of starting the stand-in")
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in seconds per command")
+    parser.add_argument("--jitter", type=float, default=0.0, help="stand-in extra seconds per command, at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="stand-in fraction of failed commands")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    mock = None
+    iotc_url = args.iotc_url
+    if iotc_url is None:
+        mock = MockIoTCentral(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+        iotc_url = mock.start()
+
+    try:
+        function = load_trigger_function(iotc_url)
+        triggers = args.triggers or list(function.flow_configuration)
+        unknown = [name for name in triggers if name not in function.flow_configuration]
+        if unknown:
+            sys.exit(f"Unknown triggers: {', '.join(unknown)}")
+
+        print(f"{args.rate:g} requests/s for {args.duration:g} s against {iotc_url}")
+        start = time.perf_counter()
+        results = run(function, triggers, args.rate, args.duration, args.concurrency)
+        elapsed = time.perf_counter() - start
+    finally:
+        if mock is not None:
+            mock.stop()
+
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"rate": args.rate, "duration": args.duration, "elapsed": elapsed, "triggers": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# Escape Room Project
+#
+# Local stand-in for the IoT Central device commands REST API
+#
+# Description:
+# Answers POST /api/devices/{device}/commands/{command} the way IoT Central
+# does once the device has replied, after an optional artificial delay, so the
+# trigger function can be exercised without an IoT Central application.
+#
+#     python mock_iotc.py --port 8765 --latency 0.05
+#     IOTC_APP_URL=http://127.0.0.1:8765 func start
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMMAND_PATH = re.compile(r"^/api/devices/(?P<device>[^/]+)/commands/(?P<command>[^/?]+)")
+
+
+class MockIoTCentral(ThreadingHTTPServer):
+    """HTTP server that accepts device commands.
+
+    latency : seconds each command takes (the device's reply time)
+    jitter : up to this many extra seconds are added at random
+    error_rate : fraction of commands answered with 504 (device unreachable)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__(address, CommandHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.commands_received = 0
+        self.commands_failed = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread and return the base URL."""
+        self.thread = threading.Thread(target=self.serve_forever, name="mock IoT Central", daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class CommandHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like IoT Central
+
+    def do_POST(self):
+        match = COMMAND_PATH.match(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if match is None:
+            self.send_json(404, {"error": {"code": "NotFound", "message": f"No route for {self.path}"}})
+            return
+        if "Authorization" not in self.headers:
+            self.send_json(401, {"error": {"code": "Unauthorized", "message": "Missing Authorization header"}})
+            return
+        try:
+            request = json.loads(body or b"{}").get("request")
+        except ValueError:
+            self.send_json(400, {"error": {"code": "InvalidBody", "message": "Body is not JSON"}})
+            return
+
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        failed = random.random() < server.error_rate
+        with server.lock:
+            server.commands_received += 1
+            if failed:
+                server.commands_failed += 1
+
+        if failed:
+            self.send_json(504, {"error": {"code": "GatewayTimeout", "message": f"Device {match['device']} did not respond"}})
+            return
+        self.send_json(200, {
+            "id": f"{random.getrandbits(64):016x}",
+            "request": request,
+            "responseCode": 200,
+            "response": {},
+        })
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # one line per command would swamp a load test
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the IoT Central device commands API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each command takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds per command")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of commands that fail with 504")
+    args = parser.parse_args()
+
+    server = MockIoTCentral((args.host, args.port), args.latency, args.jitter, args.error_rate)
+    print(f"Mock IoT Central listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"{server.commands_received} commands received, {server.commands_failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+# asyncio version of UART
+
+import asyncio
+import os
+from time import monotonic
+from UART import UART
+
+class AsyncUART(UART):
+	'''
+	A UART whose read/peek methods are coroutines. Instead of blocking on the serial port, the port's file descriptor is registered with the running event loop, and received bytes are moved into the read buffer by the loop's reader callback as soon as they arrive.
+	
+	Reads have the same semantics as UART: if it takes longer than the timeout to receive the next byte, the read/peek returns None. Writes are the same (blocking) methods as UART, since gateway packets are short.
+	
+	IterLines and IterLineViews are async generators, and ReadAvailableLines only takes the lines already in the read buffer (the event loop does all the receiving). There is no reader thread: the event loop already receives in the background.
+	
+	Requires an event loop with add_reader support (any selector event loop, which is the default everywhere except Windows).
+	'''
+	# Public variables
+	ReadChunkSize = 4096	# Maximum number of bytes moved from the OS per reader callback
+	
+	# Private variables
+	loop = None
+	dataReceived = None	# asyncio.Event, set whenever bytes are received or the port closes
+	viewHeld = False	# True while IterLineViews has a view into the read buffer out
+	
+	
+	# Constructor
+	def __init__(self):
+		super().__init__()
+		return
+		
+		
+		
+		
+	# Methods
+	async def Open(self, port, baudrate:int, timeout=250e-3, initialRTS=None, initialDTR=None):
+		'''
+		Opens the serial port and starts receiving on the running event loop.
+		No parity, one stop bit, 8-bit byte size.
+		
+		@port: The desired serial port to connect to
+		@baudrate: The baud in bits per second
+		@timeout: When reading/peeking, if the criteria to finish reading has not been met when the timeout has elapsed since the last received byte, the read/peek operation will be canceled.
+		@initialDTR: int, the value DTR will have when the port is opened (0 or 1)
+		@initialRTS: int, the value RTS will have when the port is opened (0 or 1)
+		
+		@Returns: bool (connection success state)
+		'''
+		if self.thisOS == 'windows':
+			print('AsyncUART is not supported on Windows')
+			return False
+		if port is None:
+			print('port must be given when using AsyncUART')
+			return False
+			
+		self.loop = asyncio.get_running_loop()
+		if self.IsOpen:
+			self.Close()
+			
+		# UART.Open blocks briefly while the port settles, so keep it off the event loop
+		opened = await self.loop.run_in_executor(None, lambda: UART.Open(self, port, baudrate, timeout=timeout, initialRTS=initialRTS, initialDTR=initialDTR))
+		if opened is not True:
+			return False
+			
+		self.dataReceived = asyncio.Event()
+		self.loop.add_reader(self.ser.fileno(), self._OnReadable)
+		return True
+		
+	def Close(self):
+		'''
+		Stops receiving and closes the serial port
+		'''
+		if (self.loop is not None) and self.IsOpen:
+			self.loop.remove_reader(self.ser.fileno())
+		super().Close()
+		if self.dataReceived is not None:
+			# Wake up any waiting reads so they can see the port is closed
+			self.loop.call_soon_threadsafe(self.dataReceived.set)
+		return
+		
+	def _OnReadable(self):
+		try:
+			data = os.read(self.ser.fileno(), self.ReadChunkSize)
+		except BlockingIOError:
+			return
+		except OSError:
+			self.serialErrors += 1
+			self.Close()
+			return
+		if len(data) <= 0:
+			# The device went away
+			self.serialErrors += 1
+			self.Close()
+			return
+		self.receiveTime = monotonic()
+		self.bytesReceived += len(data)
+		self._ReserveReadBuffer(len(data))
+		self.readbuffer[self.readEnd:self.readEnd + len(data)] = data
+		self.readEnd += len(data)
+		if self.readEnd - self.readStart > self.readBufferHighWater:
+			self.readBufferHighWater = self.readEnd - self.readStart
+		self.dataReceived.set()
+		return
+		
+	def _ReserveReadBuffer(self, numbytes):
+		if (self.viewHeld == False) or (len(self.readbuffer) - self.readEnd >= numbytes):
+			super()._ReserveReadBuffer(numbytes)
+			return
+		# A line view from IterLineViews points into the buffer, so move the unread bytes to a new buffer instead of sliding them under it
+		count = self.readEnd - self.readStart
+		size = len(self.readbuffer)
+		while size - count < numbytes:
+			size *= 2
+		newbuffer = bytearray(size)
+		newbuffer[:count] = memoryview(self.readbuffer)[self.readStart:self.readEnd]
+		self.readbuffer = newbuffer
+		self.readStart = 0
+		self.readEnd = count
+		return
+		
+	def _ReceiveAvailable(self):
+		# Bytes are moved into the read buffer by _OnReadable as they arrive, never by reading the port directly
+		if self.IsOpen == False:
+			return None
+		return 0
+		
+	async def _FillReadBuffer(self, numbytes):
+		'''
+		Waits until at least numbytes bytes are in the read buffer.
+		
+		Returns: bool (True when the bytes are available, False if the timeout elapsed before the next byte was received), or None (if the serial port was closed)
+		'''
+		while (self.readEnd - self.readStart) < numbytes:
+			if self.IsOpen == False:
+				return None
+			self.dataReceived.clear()
+			try:
+				await asyncio.wait_for(self.dataReceived.wait(), self.Timeout)
+			except asyncio.TimeoutError:
+				self.readTimeouts += 1
+				return False
+		return True
+		
+	async def _PeekFrameLength(self, terminator_bytes:bytes, maxSize=None, stripTerminator=False):
+		'''
+		Waits until the terminator is in the read buffer (or maxSize bytes have arrived without one), searching only the newly received bytes each time.
+		
+		Returns: tuple[int, int] (the length of the frame at the start of the read buffer following the same rules as PeekBytesUntil, and the number of bytes to remove to consume it including any stripped terminator), or None (if timeout elapsed)
+		'''
+		if self.IsOpen == False:
+			return None
+			
+		index = self._FindInReadBuffer(terminator_bytes)
+		while index < 0:
+			currentBytesInReadBuffer = self.readEnd - self.readStart
+			if maxSize is not None:
+				if currentBytesInReadBuffer >= maxSize:
+					return (maxSize, maxSize)
+			if await self._FillReadBuffer(currentBytesInReadBuffer + 1) is not True:
+				return None
+			index = self._FindInReadBuffer(terminator_bytes)
+			
+		numbytes = index - self.readStart + len(terminator_bytes)
+		if stripTerminator:
+			return (numbytes - len(terminator_bytes), numbytes)
+		return (numbytes, numbytes)
+		
+	async def PeekBytes(self, numbytes=None):
+		'''
+		Reads bytes from the serial port without removing them from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@numbytes: the number of bytes to read. If None, reads the entire current buffer without waiting for any new data.
+		
+		Returns: bytes (the bytes read), or None (if timeout elapsed)
+		'''
+		if self.IsOpen == False:
+			return None
+		if numbytes is None:
+			return self._CopyReadBuffer(self.readEnd - self.readStart)
+		if await self._FillReadBuffer(numbytes) is not True:
+			return None
+		return self._CopyReadBuffer(numbytes)
+		
+	async def Peek(self, numchars=None):
+		'''
+		Reads a string from the serial port without removing it from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@numchars: the number of chars to read. If None, reads the entire current buffer without waiting for any new data.
+		
+		Returns: str (the chars read), or None (if timeout elapsed)
+		'''
+		r = await self.PeekBytes(numchars)
+		if r is None:
+			return None
+		return r.decode(self.Encoding)
+		
+	async def ReadBytes(self, numbytes=None):
+		'''
+		Reads bytes from the serial port and removes them from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@numbytes: the number of bytes to read. If None, reads the entire current buffer without waiting for any new data.
+		
+		Returns: bytes (the bytes read), or None (if timeout elapsed)
+		'''
+		r = await self.PeekBytes(numbytes)
+		if r is None:
+			return None
+		self._ConsumeReadBuffer(len(r))
+		return r
+		
+	async def Read(self, numchars=None):
+		'''
+		Reads a string from the serial port and removes it from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@numchars: the number of chars to read. If None, reads the entire current buffer without waiting for any new data.
+		
+		Returns: str (the chars read), or None (if timeout elapsed)
+		'''
+		r = await self.ReadBytes(numchars)
+		if r is None:
+			return None
+		return r.decode(self.Encoding)
+		
+	async def PeekBytesUntil(self, terminator_bytes:bytes, maxSize=None, stripTerminator=False):
+		'''
+		Reads bytes from the serial port until the terminator is found without removing them from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@terminator_bytes: The terminator. Reads from the serial port until the terminator is found.
+		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no terminator has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit.
+		@stripTerminator: If true, removes the terminator from the end of the return bytes.
+		
+		Returns: bytes (the bytes read), or None (if timeout elapsed)
+		'''
+		if type(terminator_bytes) != bytes:
+			return None
+		if len(terminator_bytes) <= 0:
+			return None
+		frame = await self._PeekFrameLength(terminator_bytes, maxSize=maxSize, stripTerminator=stripTerminator)
+		if frame is None:
+			return None
+		return self._CopyReadBuffer(frame[0])
+		
+	async def PeekUntil(self, terminator, maxSize=None, stripTerminator=False):
+		'''
+		Reads a string from the serial port until the terminator is found without removing it from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@terminator: The terminator. Reads from the serial port until the terminator is found.
+		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no terminator has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit.
+		@stripTerminator: If true, removes the terminator from the end of the return string.
+		
+		Returns: str (the chars read), or None (if timeout elapsed)
+		'''
+		if type(terminator) != str:
+			return None
+		r = await self.PeekBytesUntil(terminator.encode(self.Encoding), maxSize=maxSize, stripTerminator=stripTerminator)
+		if r is None:
+			return None
+		return r.decode(self.Encoding)
+		
+	async def ReadBytesUntil(self, terminator_bytes, maxSize=None, stripTerminator=False):
+		'''
+		Reads bytes from the serial port until the terminator is found and removes them from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@terminator_bytes: The terminator. Reads from the serial port until the terminator is found.
+		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no terminator has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit.
+		@stripTerminator: If true, removes the terminator from the end of the return bytes.
+		
+		Returns: bytes (the bytes read), or None (if timeout elapsed)
+		'''
+		if type(terminator_bytes) != bytes:
+			return None
+		if len(terminator_bytes) <= 0:
+			return None
+		frame = await self._PeekFrameLength(terminator_bytes, maxSize=maxSize, stripTerminator=stripTerminator)
+		if frame is None:
+			return None
+		r = self._CopyReadBuffer(frame[0])
+		self._ConsumeReadBuffer(frame[1])
+		return r
+		
+	async def ReadUntil(self, terminator, maxSize=None, stripTerminator=False):
+		'''
+		Reads a string from the serial port until the terminator is found and removes it from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@terminator: The terminator. Reads from the serial port until the terminator is found.
+		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no terminator has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit.
+		@stripTerminator: If true, removes the terminator from the end of the return string.
+		
+		Returns: str (the chars read), or None (if timeout elapsed)
+		'''
+		if type(terminator) != str:
+			return None
+		r = await self.ReadBytesUntil(terminator.encode(self.Encoding), maxSize=maxSize, stripTerminator=stripTerminator)
+		if r is None:
+			return None
+		return r.decode(self.Encoding)
+		
+	async def PeekLine(self, maxSize=None, stripNewline=False):
+		'''
+		Reads a string from the serial port until a line ending is found (determined by NewlineRead) without removing it from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no line ending has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit.
+		@stripNewline: If true, removes the line ending from the end of the return string.
+		
+		Returns: str (the chars read), or None (if timeout elapsed)
+		'''
+		return await self.PeekUntil(terminator=self.NewlineRead, maxSize=maxSize, stripTerminator=stripNewline)
+		
+	async def ReadLine(self, maxSize=None, stripNewline=False):
+		'''
+		Reads a string from the serial port until a line ending is found (determined by NewlineRead) and removes it from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		
+		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no line ending has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit.
+		@stripNewline: If true, removes the line ending from the end of the return string.
+		
+		Returns: str (the chars read), or None (if timeout elapsed)
+		'''
+		r = await self.ReadUntil(terminator=self.NewlineRead, maxSize=maxSize, stripTerminator=stripNewline)
+		if r is not None:
+			self.linesReceived += 1
+		return r
+		
+	async def IterLineViews(self, maxSize=None, stripNewline=False, stopOnTimeout=False):
+		'''
+		Async generator that yields each line as soon as it is complete (determined by NewlineRead), removing it from the read buffer. Lines are yielded as memoryviews into the read buffer, so no bytes are copied; a view is released when the next line is requested and must not be used after that (call bytes() on it to keep a copy).
+		
+		@maxSize: The maximum number of bytes in a line. If maxSize bytes are received without a line ending, they are yielded as a line. If maxSize is None, there is no limit.
+		@stripNewline: If true, removes the line ending from the end of each line.
+		@stopOnTimeout: If true, the generator ends when the timeout elapses without a complete line. Otherwise it keeps waiting until the serial port is closed.
+		
+		Yields: memoryview (the bytes of the line)
+		'''
+		newline = self.NewlineRead.encode(self.Encoding)
+		while True:
+			frame = await self._PeekFrameLength(newline, maxSize=maxSize, stripTerminator=stripNewline)
+			if frame is None:
+				if stopOnTimeout or (self.IsOpen == False):
+					return
+				continue
+			numbytes, removeBytesCount = frame
+			view = memoryview(self.readbuffer)[self.readStart:self.readStart + numbytes]
+			self.linesReceived += 1
+			self.viewHeld = True
+			try:
+				yield view
+			finally:
+				view.release()
+				self.viewHeld = False
+				self._ConsumeReadBuffer(removeBytesCount)
+				
+	async def IterLines(self, maxSize=None, stripNewline=False, stopOnTimeout=False):
+		'''
+		Async generator that yields each line as a string as soon as it is complete (determined by NewlineRead), removing it from the read buffer.
+		
+		@maxSize: The maximum number of bytes in a line. If maxSize bytes are received without a line ending, they are yielded as a line. If maxSize is None, there is no limit.
+		@stripNewline: If true, removes the line ending from the end of each line.
+		@stopOnTimeout: If true, the generator ends when the timeout elapses without a complete line. Otherwise it keeps waiting until the serial port is closed.
+		
+		Yields: str (the chars of the line)
+		'''
+		newline = self.NewlineRead.encode(self.Encoding)
+		while True:
+			frame = await self._PeekFrameLength(newline, maxSize=maxSize, stripTerminator=stripNewline)
+			if frame is None:
+				if stopOnTimeout or (self.IsOpen == False):
+					return
+				continue
+			r = str(memoryview(self.readbuffer)[self.readStart:self.readStart + frame[0]], self.Encoding)
+			self._ConsumeReadBuffer(frame[1])
+			self.linesReceived += 1
+			yield r
+			
+	# "async for line in uart.Lines()" (or uart.lines()) keeps waiting through timeouts and ends when the serial port is closed
+	Lines = IterLines
+	lines = IterLines
+	
+	def StartReaderThread(self, queueSize=None, maxSize=None):
+		'''
+		Not available: the event loop already receives in the background. Use IterLines or ReadLine.
+		
+		Returns: bool (False)
+		'''
+		print('AsyncUART has no reader thread, the event loop receives in the background')
+		return False
@@ -3,11 +3,18 @@
 import serial	# pyserial (install with pip install pyserial)
 from serial.tools import list_ports	# also pyserial
 import platform
-from time import sleep
+import queue
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, monotonic
 from datetime import datetime
 
+@functools.lru_cache(maxsize=None)
 def GetOS():
 	'''
+	Detected once per process (the OS can't change while it runs), so creating UARTs doesn't read /sys/firmware/devicetree again
+	
 	Returns: str (A string corresponding to the operating system, including if running on WSL for Windows)
 	'''
 	uname = platform.uname()
@@ -33,8 +40,125 @@ def GetOS():
 			return 'linux'
 	return None
 
-if GetOS() == 'rpi':
-	import RPi.GPIO as GPIO	# should come with any Raspberry Pi
+GPIO = None	# RPi.GPIO, imported the first time a Raspberry Pi pin is used
+
+def _ImportGPIO():
+	'''
+	Returns: module (RPi.GPIO, which should come with any Raspberry Pi)
+	'''
+	global GPIO
+	if GPIO is None:
+		import RPi.GPIO
+		GPIO = RPi.GPIO
+	return GPIO
+
+def PortMatches(portInfo, vid=None, pid=None, serialNumber=None):
+	'''
+	Checks a port from serial.tools.list_ports against a VID/PID/serial number rule. Rule fields that are None match anything.
+	
+	Returns: bool (True if the port matches the rule)
+	'''
+	if (vid is not None) and (portInfo.vid != vid):
+		return False
+	if (pid is not None) and (portInfo.pid != pid):
+		return False
+	if (serialNumber is not None) and (portInfo.serial_number != serialNumber):
+		return False
+	return True
+
+class PortWatcher():
+	'''
+	Watches for serial ports being plugged in or removed. A background thread re-enumerates the port list every Interval seconds and compares it to the previous list; ports are never opened, so only ports that actually appeared are reported (and probed by whoever handles them).
+	'''
+	# Public variables
+	Interval = 1.0	# Seconds between enumerations
+	
+	# Private variables
+	onAdded = None
+	onRemoved = None
+	rule = None
+	knownPorts = None	# dict of device name -> port info
+	thread = None
+	stop = None
+	
+	
+	# Properties
+	@property
+	def KnownPorts(self):
+		return list(self.knownPorts.keys())
+	
+	@property
+	def Running(self):
+		return (self.thread is not None) and self.thread.is_alive()
+	
+	
+	# Constructor
+	def __init__(self, onAdded=None, onRemoved=None, vid=None, pid=None, serialNumber=None, interval=None):
+		'''
+		@onAdded: function(portInfo), called from the watcher thread for each new port that matches the rule
+		@onRemoved: function(device:str), called from the watcher thread for each matching port that disappears
+		@vid, @pid, @serialNumber: only ports matching this rule are reported (None matches anything)
+		@interval: seconds between enumerations. If None, Interval is used.
+		'''
+		self.onAdded = onAdded
+		self.onRemoved = onRemoved
+		self.rule = {'vid': vid, 'pid': pid, 'serialNumber': serialNumber}
+		if interval is not None:
+			self.Interval = interval
+		self.knownPorts = dict()
+		return
+	
+	
+	# Methods
+	def Start(self):
+		'''
+		Starts watching. Ports that are already present are taken as known and are not reported.
+		'''
+		if self.Running:
+			return
+		self.knownPorts = self._Enumerate()
+		self.stop = threading.Event()
+		self.thread = threading.Thread(target=self._WatchLoop, name='serial port watcher', daemon=True)
+		self.thread.start()
+		return
+	
+	def Stop(self):
+		if self.thread is None:
+			return
+		self.stop.set()
+		self.thread.join()
+		self.thread = None
+		return
+	
+	def Poll(self):
+		'''
+		Enumerates the ports once and reports any changes since the previous enumeration
+		'''
+		ports = self._Enumerate()
+		for device in self.knownPorts:
+			if device not in ports:
+				UART.InvalidatePortProbeCache(device)
+				if self.onRemoved is not None:
+					self.onRemoved(device)
+		for device in ports:
+			if device not in self.knownPorts:
+				UART.InvalidatePortProbeCache(device)
+				if self.onAdded is not None:
+					self.onAdded(ports[device])
+		self.knownPorts = ports
+		return
+	
+	def _Enumerate(self):
+		ports = dict()
+		for port in list_ports.comports():
+			if PortMatches(port, **self.rule):
+				ports[port.device] = port
+		return ports
+	
+	def _WatchLoop(self):
+		while not self.stop.wait(self.Interval):
+			self.Poll()
+		return
 
 class UART():
 	# Public variables
@@ -42,18 +166,44 @@ class UART():
 	NewlineRead = '\n'
 	Encoding = 'latin-1'	# Also could be 'ascii'
 	
+	ReadBufferSize = 4096	# Initial capacity of the read buffer in bytes (it grows if a frame needs more)
+	LineQueueSize = 256	# Number of received lines the reader thread holds before the oldest are dropped
+	PortProbeCacheTTL = 5.0	# Seconds a port's open/closed probe result is reused by GetAvailableSerialPorts
+	PortProbeWorkers = 16	# Maximum number of ports probed at the same time
+	Recorder = None	# SessionRecorder every received frame and written line is recorded to (see session_log.py)
+	
 	# Private variables
 	ser = None
-	readbuffer = b''
+	readbuffer = None	# bytearray, the unread bytes are readbuffer[readStart:readEnd]
+	readStart = 0
+	readEnd = 0
+	scanTerminator = None	# The terminator the unread bytes were last searched for
+	scannedCount = 0	# The first scannedCount unread bytes are known not to contain scanTerminator
+	READER_CLOSED = object()	# Queued by the reader thread when it exits
+	readerThread = None
+	readerStop = None	# threading.Event, set to ask the reader thread to exit
+	lineQueue = None	# queue.Queue of (line, receive time) received by the reader thread, ended by READER_CLOSED when the thread exits
+	lineQueueOverflows = 0
+	receiveTime = None	# monotonic() time bytes were last received into the read buffer
+	lastLineTime = None
+	bytesReceived = 0
+	bytesSent = 0
+	linesReceived = 0
+	linesSent = 0
+	readTimeouts = 0	# Reads that waited the whole timeout for a byte
+	serialErrors = 0	# Times the port failed with a SerialException and was closed
+	readBufferHighWater = 0	# Most unread bytes the read buffer has held
 	thisOS = None
 	libftdi_timeout = None
+	portProbeCache = dict()	# Shared by all instances: device name -> (monotonic time of probe, port was free)
+	portProbeCacheLock = threading.Lock()
 	
 	
 	# Properties
 	@property
 	def IsOpen(self):
 		return self.ser.is_open
-		
+	
 	@property
 	def Connected(self):
 		return self.IsOpen
@@ -78,6 +228,74 @@ class UART():
 	def Timeout(self, timeout):
 		self.ser.timeout = timeout
 	
+	@property
+	def BytesInReadBuffer(self):
+		return self.readEnd - self.readStart
+	
+	@property
+	def ReaderThreadRunning(self):
+		return (self.readerThread is not None) and self.readerThread.is_alive()
+	
+	@property
+	def QueueDepth(self):
+		if self.lineQueue is None:
+			return 0
+		return self.lineQueue.qsize()
+	
+	@property
+	def QueueOverflowCount(self):
+		return self.lineQueueOverflows
+	
+	@property
+	def BytesReceived(self):
+		return self.bytesReceived
+	
+	@property
+	def BytesSent(self):
+		return self.bytesSent
+	
+	@property
+	def LinesReceived(self):
+		return self.linesReceived
+	
+	@property
+	def LinesSent(self):
+		return self.linesSent
+	
+	@property
+	def ReadTimeouts(self):
+		return self.readTimeouts
+	
+	@property
+	def SerialErrors(self):
+		return self.serialErrors
+	
+	@property
+	def ReadBufferHighWater(self):
+		'''
+		Returns: int (the most unread bytes the read buffer has held since the UART was created)
+		'''
+		return self.readBufferHighWater
+	
+	@property
+	def LastLineTime(self):
+		'''
+		Returns: float (monotonic() time the bytes completing the last line read were received, for latency measurements), or None
+		'''
+		return self.lastLineTime
+	
+	@property
+	def FileDescriptor(self):
+		'''
+		Returns: int (the OS file descriptor of the open port, for selectors/epoll), or None (if the port is closed or has no file descriptor, e.g. on Windows)
+		'''
+		if (self.IsOpen == False) or (self.ser is None):
+			return None
+		try:
+			return self.ser.fileno()
+		except (AttributeError, OSError, ValueError):
+			return None
+	
 	
 	
 	
@@ -85,6 +303,7 @@ class UART():
 	def __init__(self, port=None, baudrate=None, autoconnect=False):
 		self.thisOS = GetOS()
 		self.ResetSerial()
+		self.ResetReadBuffer()
 		
 		if port is not None:
 			self.Open(port=port, baudrate=baudrate)
@@ -106,9 +325,67 @@ class UART():
 			raise Exception('This operating system is not supported')
 		return
 	
+	def ResetReadBuffer(self):
+		'''
+		Discards all unread bytes and restores the read buffer to its initial capacity
+		'''
+		self.readbuffer = bytearray(self.ReadBufferSize)
+		self.readStart = 0
+		self.readEnd = 0
+		self.scannedCount = 0
+		return
+	
+	@classmethod
+	def InvalidatePortProbeCache(cls, device=None):
+		'''
+		Forgets cached port probe results so the next scan opens the port again
+		
+		@device: the port to forget. If None, forgets every port.
+		'''
+		with cls.portProbeCacheLock:
+			if device is None:
+				cls.portProbeCache.clear()
+			else:
+				cls.portProbeCache.pop(device, None)
+		return
+	
+	def _ProbePort(self, device:str):
+		'''
+		Checks whether a port is free by opening and closing it. Results are cached for PortProbeCacheTTL seconds.
+		
+		Returns: bool (True if the port could be opened)
+		'''
+		now = monotonic()
+		with self.portProbeCacheLock:
+			cached = self.portProbeCache.get(device)
+		if (cached is not None) and (now - cached[0] < self.PortProbeCacheTTL):
+			return cached[1]
+		try:
+			dummyser = serial.Serial(device)
+			dummyser.close()
+			isFree = True
+		except (serial.SerialException, OSError, ValueError):
+			# [Errno 2]/[Errno 5]: the port doesn't exist, [Errno 13]: someone else has it open
+			isFree = False
+		with self.portProbeCacheLock:
+			self.portProbeCache[device] = (now, isFree)
+		return isFree
+	
+	def _ProbePorts(self, devices):
+		'''
+		Probes all of the given ports at the same time
+		
+		Returns: list[str] (the ports that are free, in the order given)
+		'''
+		if len(devices) == 0:
+			return []
+		with ThreadPoolExecutor(max_workers=min(self.PortProbeWorkers, len(devices))) as pool:
+			isFree = list(pool.map(self._ProbePort, devices))
+		return [d for d, f in zip(devices, isFree) if f]
+	
 	def GetAvailableSerialPorts(self, removeConnectedPorts:bool=True, removeBlankPorts:bool=True):
 		'''
-		Returns a list of all available serial ports
+		Returns a list of all available serial ports. Ports are probed concurrently and probe results are cached for PortProbeCacheTTL seconds.
 		
 		@removeConnectedPorts: Do not list ports that have already been opened
 		@removeBlankPorts: Do not list ports that have no VID or PID information
@@ -119,42 +396,78 @@ class UART():
 		ports = []
 		
 		if self.thisOS == 'rpi':
-			rpiPorts = ['/dev/serial0']
-			for port in rpiPorts:
-				try:
-					dummyser = serial.Serial(port)
-					dummyser.close()
-				except:
-					continue
-				ports.append(port)
-			
+			ports += self._ProbePorts(['/dev/serial0'])
+		
+		candidates = []
 		for port in allPorts:
 			# Check if the port has a PID or VID
 			if removeBlankPorts and (self.thisOS != 'wsl'):
 				if (port.pid is None) and (port.vid is None):
 					continue
-			
-			# Check if the port is already open or not
-			if removeConnectedPorts or (self.thisOS == 'wsl'):
-				try:
-					dummyser = serial.Serial(port.device)
-					dummyser.close()
-				except serial.SerialException as e:
-					if str(e).startswith('[Errno 5]'):
-						# Serial port does not exist
-						continue
-					elif str(e).startswith('[Errno 13]'):
-						# Serial port is already connected to by someone else
-						continue
-					elif str(e).startswith('[Errno 2]'):
-						# This serial port doesn't even exist in the /dev/ttyS* folder, for whatever reason
-						continue
-					else:
-						continue	# This re-raises the exception
-			
-			ports.append(port.device)
+			candidates.append(port.device)
 		
-		return ports
+		# Check if the ports are already open or not
+		if removeConnectedPorts or (self.thisOS == 'wsl'):
+			candidates = self._ProbePorts(candidates)
+		
+		return ports + candidates
+	
+	def FindPort(self, vid=None, pid=None, serialNumber=None, removeConnectedPorts:bool=True):
+		'''
+		Picks a serial port by a stable VID/PID/serial number rule instead of asking the user. When several ports match, the one with the lowest device name is chosen so the choice does not change between runs.
+		
+		@vid: the USB vendor ID (int) the port must have, or None to match any
+		@pid: the USB product ID (int) the port must have, or None to match any
+		@serialNumber: the USB serial number (str) the port must have, or None to match any
+		@removeConnectedPorts: Do not pick ports that have already been opened
+		
+		Returns: str (the port), or None (if no port matches)
+		'''
+		matches = sorted(p.device for p in list_ports.comports() if PortMatches(p, vid=vid, pid=pid, serialNumber=serialNumber))
+		if removeConnectedPorts:
+			matches = self._ProbePorts(matches)
+		if len(matches) <= 0:
+			return None
+		return matches[0]
+	
+	def WaitForPort(self, vid=None, pid=None, serialNumber=None, timeout=None):
+		'''
+		Like FindPort, but if no port matches yet, watches for a matching port to be plugged in (or re-enumerated) instead of rescanning every port. Matching ports that are busy are probed again every PortWatcher.Interval until one is free.
+		
+		@timeout: seconds to wait. If None, waits forever.
+		
+		Returns: str (the port), or None (if timeout elapsed)
+		'''
+		changes = queue.Queue()	# (device, True if added or False if removed)
+		watcher = PortWatcher(onAdded=lambda p: changes.put((p.device, True)), onRemoved=lambda d: changes.put((d, False)), vid=vid, pid=pid, serialNumber=serialNumber)
+		# Start watching before looking, so a port that appears in between is reported
+		watcher.Start()
+		try:
+			# The ports already present are not reported by the watcher, so start with them
+			candidates = set(watcher.KnownPorts)
+			deadline = None if timeout is None else monotonic() + timeout
+			while True:
+				free = self._ProbePorts(sorted(candidates))
+				if len(free) > 0:
+					return free[0]
+				remaining = None if deadline is None else max(0, deadline - monotonic())
+				if remaining == 0:
+					return None
+				try:
+					device, added = changes.get(timeout=watcher.Interval if remaining is None else min(remaining, watcher.Interval))
+					while True:
+						if added:
+							candidates.add(device)
+						else:
+							candidates.discard(device)
+						device, added = changes.get_nowait()
+				except queue.Empty:
+					pass
+				# Probe busy ports again instead of taking the cached result
+				for device in candidates:
+					UART.InvalidatePortProbeCache(device)
+		finally:
+			watcher.Stop()
 	
 	def InteractivePortChooser(self, removeConnectedPorts:bool=True, removeBlankPorts:bool=True):
 		availPorts = self.GetAvailableSerialPorts(removeConnectedPorts=removeConnectedPorts, removeBlankPorts=removeBlankPorts)
@@ -204,7 +517,7 @@ class UART():
 		Opens the serial port to establish a connection.
 		No parity, one stop bit, 8-bit byte size.
 		
-		@port: The desired serial port to connect to
+		@port: The desired serial port to connect to, or a pyserial URL (e.g. "loop://")
 		@baudrate: The baud in bits per second
 		@timeout: When reading/peeking, if the criteria to finish reading has not been met when the timeout has elapsed since the last received byte, the read/peek operation will be canceled.
 		@initialDTR: int, the value DTR will have when the port is opened (0 or 1)
@@ -223,7 +536,9 @@ class UART():
 			print('initialDTR must be None, 0, or 1')
 			return False
 		
-		self.readbuffer = b''
+		if self.readerThread is not None:
+			self.StopReaderThread()
+		self.ResetReadBuffer()
 		
 		# Is the port already open?
 		if self.ser is not None:
@@ -247,7 +562,11 @@ class UART():
 			return False
 		
 		try:
-			ser = serial.Serial()
+			if '://' in port:
+				# A pyserial URL, e.g. loop:// (a loopback with no hardware) or socket://host:port
+				ser = serial.serial_for_url(port, do_not_open=True)
+			else:
+				ser = serial.Serial()
 			if initialDTR is not None:
 				ser.dtr = initialDTR
 			if initialRTS is not None:
@@ -271,11 +590,13 @@ class UART():
 	
 	def Close(self):
 		'''
-		Closes the serial port
+		Closes the serial port (and stops the reader thread, if it is running)
 		'''
+		if self.readerThread is not None and self.readerThread is not threading.current_thread():
+			self.StopReaderThread()
 		self.ser.close()
 		self.ResetSerial()
-		self.readbuffer = b''
+		self.ResetReadBuffer()
 		return
 	
 	def Write(self, data):
@@ -288,7 +609,7 @@ class UART():
 		'''
 		if (self.IsOpen == False) or (self.ser is None):
 			return None
-			
+		
 		# Convert numbers to a string
 		if (type(data) == int) or (type(data) == float):
 			data = str(data)
@@ -297,10 +618,13 @@ class UART():
 		if type(data) == str:
 			data = data.encode(self.Encoding)
 		
-		if type(data) == bytes:
-			return self.ser.write(data)
-		else:
+		if type(data) != bytes:
 			return None
+		count = self.ser.write(data)
+		self.bytesSent += len(data)
+		if self.Recorder is not None:
+			self.Recorder.Sent(data)
+		return count
 	
 	def WriteLine(self, w):
 		'''
@@ -310,11 +634,16 @@ class UART():
 		
 		Returns: int (the number of bytes written)
 		'''
-		newline = self.NewlineWrite.encode(self.Encoding)
-		count = self.Write(w)
-		if count is None:
+		if (type(w) == int) or (type(w) == float):
+			w = str(w)
+		if type(w) == str:
+			w = w.encode(self.Encoding)
+		if type(w) != bytes:
 			return None
-		count += self.Write(newline)
+		# One write, so the line and its ending go out (and are recorded) together
+		count = self.Write(w + self.NewlineWrite.encode(self.Encoding))
+		if count is not None:
+			self.linesSent += 1
 		return count
 	
 	def WriteBytes(self, w):
@@ -322,6 +651,121 @@ class UART():
 			return None
 		return self.Write(w)
 	
+	def _ReserveReadBuffer(self, numbytes):
+		'''
+		Makes room for numbytes more bytes after the end of the unread data, sliding the unread data to the front of the buffer or growing the buffer only when the free space runs out.
+		'''
+		if len(self.readbuffer) - self.readEnd >= numbytes:
+			return
+		count = self.readEnd - self.readStart
+		size = len(self.readbuffer)
+		while size - count < numbytes:
+			size *= 2
+		if size == len(self.readbuffer):
+			# Enough total space, move the unread bytes to the front
+			with memoryview(self.readbuffer) as view:
+				view[:count] = view[self.readStart:self.readEnd]
+		else:
+			newbuffer = bytearray(size)
+			newbuffer[:count] = memoryview(self.readbuffer)[self.readStart:self.readEnd]
+			self.readbuffer = newbuffer
+		self.readStart = 0
+		self.readEnd = count
+		return
+	
+	def _ReceiveIntoReadBuffer(self, numbytes):
+		'''
+		Reads up to numbytes bytes from the serial port directly into the read buffer. Blocks for at most the timeout if no bytes are waiting.
+		
+		Returns: int (the number of bytes received), or None (if the serial port failed and was closed)
+		'''
+		self._ReserveReadBuffer(numbytes)
+		try:
+			with memoryview(self.readbuffer) as view:
+				count = self.ser.readinto(view[self.readEnd:self.readEnd + numbytes])
+		except serial.serialutil.SerialException:
+			self.serialErrors += 1
+			self.Close()
+			return None
+		if count > 0:
+			self.receiveTime = monotonic()
+			self.bytesReceived += count
+			self.readEnd += count
+			if self.readEnd - self.readStart > self.readBufferHighWater:
+				self.readBufferHighWater = self.readEnd - self.readStart
+		return count
+	
+	def _ReceiveAvailable(self):
+		'''
+		Moves every byte waiting in the OS receive buffer into the read buffer in a single read, without blocking.
+		
+		Returns: int (the number of bytes received), or None (if the serial port failed and was closed)
+		'''
+		try:
+			numbytes = self.ser.in_waiting
+		except serial.serialutil.SerialException:
+			self.serialErrors += 1
+			self.Close()
+			return None
+		if numbytes <= 0:
+			return 0
+		return self._ReceiveIntoReadBuffer(numbytes)
+	
+	def _FillReadBuffer(self, numbytes):
+		'''
+		Receives until at least numbytes bytes are in the read buffer. Waiting bytes are drained in bulk; when none are waiting, blocks on the next byte for up to the timeout.
+		
+		Returns: bool (True when the bytes are available, False if the timeout elapsed before the next byte was received), or None (if the serial port failed and was closed)
+		'''
+		while (self.readEnd - self.readStart) < numbytes:
+			count = self._ReceiveAvailable()
+			if count is None:
+				return None
+			if count > 0:
+				continue
+			count = self._ReceiveIntoReadBuffer(1)
+			if count is None:
+				return None
+			if count <= 0:
+				self.readTimeouts += 1
+				return False
+		return True
+	
+	def _CopyReadBuffer(self, numbytes):
+		return bytes(memoryview(self.readbuffer)[self.readStart:self.readStart + numbytes])
+	
+	def _ConsumeReadBuffer(self, numbytes):
+		if self.Recorder is not None:
+			# Every frame handed out (by ReadLine, the reader thread, ReadAvailableLines...) passes through here
+			with memoryview(self.readbuffer)[self.readStart:self.readStart + numbytes] as frame:
+				self.Recorder.Received(frame)
+		if self.lineQueue is None:
+			# With the reader thread running, the time travels through the line queue instead
+			self.lastLineTime = self.receiveTime
+		self.readStart += numbytes
+		self.scannedCount = max(0, self.scannedCount - numbytes)
+		if self.readStart >= self.readEnd:
+			# Nothing left unread, start over at the front of the buffer for free
+			self.readStart = 0
+			self.readEnd = 0
+		return
+	
+	def _FindInReadBuffer(self, terminator_bytes:bytes):
+		'''
+		Searches the unread bytes for the terminator, resuming where the previous search for the same terminator left off instead of rescanning from the start of the buffer.
+		
+		Returns: int (the index of the terminator in readbuffer), or -1 (if it is not in the read buffer yet)
+		'''
+		if terminator_bytes != self.scanTerminator:
+			self.scanTerminator = terminator_bytes
+			self.scannedCount = 0
+		# Back up by the terminator length minus one in case it straddles the previous search boundary
+		start = self.readStart + max(0, self.scannedCount - len(terminator_bytes) + 1)
+		index = self.readbuffer.find(terminator_bytes, start, self.readEnd)
+		if index < 0:
+			self.scannedCount = self.readEnd - self.readStart
+		return index
+	
 	def PeekBytes(self, numbytes=None):
 		'''
 		Reads bytes from the serial port without removing them from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
@@ -332,31 +776,20 @@ class UART():
 		'''
 		if (self.IsOpen == False) or (self.ser is None):
 			return None
+		if self._BufferOwnedByReaderThread():
+			return None
 		
 		# If numbytes is unspecified, simply return everything currently in the read buffer
 		if numbytes is None:
-			try:
-				numbytes = self.ser.in_waiting + len(self.readbuffer)
-			except serial.serialutil.SerialException:
-				self.Close()
+			if self._ReceiveAvailable() is None:
 				return None
-		
-		# If the required number of bytes already exists in the read buffer, just read them from the read buffer
-		if numbytes <= len(self.readbuffer):
-			return self.readbuffer[:numbytes]
+			return self._CopyReadBuffer(self.readEnd - self.readStart)
 		
 		# Wait for the proper number of bytes to be received. If the timeout elapses before the next byte is received, return None
-		while len(self.readbuffer) < numbytes:
-			try:
-				s = self.ser.read(1)
-			except serial.serialutil.SerialException:
-				self.Close()
-				return None
-			if len(s) <= 0:
-				return None
-			self.readbuffer += s
+		if self._FillReadBuffer(numbytes) is not True:
+			return None
 		
-		return self.readbuffer[:numbytes]
+		return self._CopyReadBuffer(numbytes)
 	
 	def Peek(self, numchars=None):
 		'''
@@ -383,7 +816,7 @@ class UART():
 		r = self.PeekBytes(numbytes)
 		if r is None:
 			return None
-		self.readbuffer = self.readbuffer[len(r):]
+		self._ConsumeReadBuffer(len(r))
 		return r
 	
 	def Read(self, numchars=None):
@@ -399,7 +832,7 @@ class UART():
 			return None
 		r = r.decode(self.Encoding)
 		return r
-		
+	
 	def PeekBytesUntil(self, terminator_bytes:bytes, maxSize=None, stripTerminator=False):
 		'''
 		Reads bytes from the serial port until the terminator is found without removing them from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
@@ -415,26 +848,42 @@ class UART():
 		if len(terminator_bytes) <= 0:
 			return None
 		
+		frame = self._PeekFrameLength(terminator_bytes, maxSize=maxSize, stripTerminator=stripTerminator)
+		if frame is None:
+			return None
+		return self._CopyReadBuffer(frame[0])
+	
+	def _PeekFrameLength(self, terminator_bytes:bytes, maxSize=None, stripTerminator=False):
+		'''
+		Receives until the terminator is in the read buffer (or maxSize bytes have arrived without one), searching only the newly received bytes each time.
+		
+		Returns: tuple[int, int] (the length of the frame at the start of the read buffer following the same rules as PeekBytesUntil, and the number of bytes to remove to consume it including any stripped terminator), or None (if timeout elapsed)
+		'''
+		if (self.IsOpen == False) or (self.ser is None):
+			return None
+		if self._BufferOwnedByReaderThread():
+			return None
+		
 		# Get all initially available bytes into the read buffer
-		r = self.PeekBytes()
-		if r is None:
+		if self._ReceiveAvailable() is None:
 			return None
-		currentBytesInReadBuffer = len(self.readbuffer)
 		
 		# Wait until the terminator is in the read buffer
-		while terminator_bytes not in self.readbuffer:
+		index = self._FindInReadBuffer(terminator_bytes)
+		while index < 0:
+			currentBytesInReadBuffer = self.readEnd - self.readStart
 			if maxSize is not None:
 				if currentBytesInReadBuffer >= maxSize:
-					return self.PeekBytes(currentBytesInReadBuffer)
-			if self.PeekBytes(currentBytesInReadBuffer + 1) is None:
+					return (maxSize, maxSize)
+			if self._FillReadBuffer(currentBytesInReadBuffer + 1) is not True:
 				return None
-			currentBytesInReadBuffer = len(self.readbuffer)
+			index = self._FindInReadBuffer(terminator_bytes)
 		
 		# Get the bytes up to the terminator
-		r = self.readbuffer[:self.readbuffer.index(terminator_bytes)]
-		if not stripTerminator:
-			r += terminator_bytes
-		return r
+		numbytes = index - self.readStart + len(terminator_bytes)
+		if stripTerminator:
+			return (numbytes - len(terminator_bytes), numbytes)
+		return (numbytes, numbytes)
 	
 	def PeekUntil(self, terminator, maxSize=None, stripTerminator=False):
 		'''
@@ -471,7 +920,7 @@ class UART():
 		removeBytesCount = len(r)
 		if stripTerminator:
 			removeBytesCount += len(terminator_bytes)
-		self.readbuffer = self.readbuffer[removeBytesCount:]
+		self._ConsumeReadBuffer(removeBytesCount)
 		return r
 	
 	def ReadUntil(self, terminator, maxSize=None, stripTerminator=False):
@@ -507,28 +956,224 @@ class UART():
 			return None
 		return r
 	
-	def ReadLine(self, maxSize=None, stripNewline=False):
+	def ReadLine(self, maxSize=None, stripNewline=False, timeout=None):
 		'''
 		Reads a string from the serial port until a line ending is found (determined by NewlineRead) and removes it from the read buffer. If it takes longer than the timeout to read any byte from the serial port, returns None.
+		While the reader thread is running, the next line is taken from its queue instead, and None is returned if no line arrives within the timeout. If the reader thread has exited (e.g. the port failed and was closed), the lines it queued are returned without waiting, then None.
 		
-		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no line ending has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit.
+		@maxSize: The maximum number of bytes to read. If there are maxSize bytes in the serial terminal and no line ending has been found, returns the read buffer up to maxSize. If maxSize is None, there is no limit. (Set by StartReaderThread while the reader thread is running.)
 		@stripNewline: If true, removes the line ending from the end of the return string.
+		@timeout: Overrides the port timeout for this call. If None, the port timeout is used.
 		
 		Returns: str (the chars read), or None (if timeout elapsed)
 		'''
+		if self.lineQueue is not None:
+			if timeout is None:
+				timeout = self.Timeout
+			try:
+				# The reader thread queues READER_CLOSED when it exits, so this never waits on a dead thread
+				r, receiveTime = self.lineQueue.get(timeout=timeout) if self.ReaderThreadRunning else self.lineQueue.get_nowait()
+			except queue.Empty:
+				return None
+			if r is self.READER_CLOSED:
+				# Leave it for the next call (and any other reader)
+				self._QueueLine(r, None)
+				return None
+			self.lastLineTime = receiveTime
+			if stripNewline and r.endswith(self.NewlineRead):
+				r = r[:-len(self.NewlineRead)]
+			return r
+		
+		if (timeout is not None) and self.IsOpen and (timeout != self.Timeout):
+			# Changing the timeout reconfigures the port, so only do it when needed
+			previousTimeout = self.Timeout
+			self.Timeout = timeout
+			try:
+				return self.ReadLine(maxSize=maxSize, stripNewline=stripNewline)
+			finally:
+				if self.IsOpen:
+					self.Timeout = previousTimeout
+		
 		r = self.ReadUntil(terminator=self.NewlineRead, maxSize=maxSize, stripTerminator=stripNewline)
 		if r is None:
 			return None
+		self.linesReceived += 1
 		return r
 	
+	def IterLineViews(self, maxSize=None, stripNewline=False, stopOnTimeout=False):
+		'''
+		Generator that yields each line as soon as it is complete (determined by NewlineRead), removing it from the read buffer. Lines are yielded as memoryviews into the read buffer, so no bytes are copied; a view is released when the next line is requested and must not be used after that (call bytes() on it to keep a copy).
+		
+		@maxSize: The maximum number of bytes in a line. If maxSize bytes are received without a line ending, they are yielded as a line. If maxSize is None, there is no limit.
+		@stripNewline: If true, removes the line ending from the end of each line.
+		@stopOnTimeout: If true, the generator ends when the timeout elapses without a complete line. Otherwise it keeps waiting until the serial port is closed.
+		
+		Yields: memoryview (the bytes of the line)
+		'''
+		if self._BufferOwnedByReaderThread():
+			raise Exception('IterLineViews is not available while the reader thread is running, use IterLines')
+		newline = self.NewlineRead.encode(self.Encoding)
+		while True:
+			frame = self._PeekFrameLength(newline, maxSize=maxSize, stripTerminator=stripNewline)
+			if frame is None:
+				if stopOnTimeout or (self.IsOpen == False):
+					return
+				continue
+			numbytes, removeBytesCount = frame
+			view = memoryview(self.readbuffer)[self.readStart:self.readStart + numbytes]
+			self.linesReceived += 1
+			try:
+				yield view
+			finally:
+				view.release()
+				self._ConsumeReadBuffer(removeBytesCount)
+	
+	def IterLines(self, maxSize=None, stripNewline=False, stopOnTimeout=False):
+		'''
+		Generator that yields each line as a string as soon as it is complete (determined by NewlineRead), removing it from the read buffer.
+		
+		@maxSize: The maximum number of bytes in a line. If maxSize bytes are received without a line ending, they are yielded as a line. If maxSize is None, there is no limit.
+		@stripNewline: If true, removes the line ending from the end of each line.
+		@stopOnTimeout: If true, the generator ends when the timeout elapses without a complete line. Otherwise it keeps waiting until the serial port is closed.
+		
+		Yields: str (the chars of the line)
+		'''
+		if self.lineQueue is not None:
+			# Lines are already decoded by the reader thread
+			while True:
+				r = self.ReadLine(stripNewline=stripNewline)
+				if r is not None:
+					yield r
+				elif stopOnTimeout or not self.ReaderThreadRunning:
+					return
+		for view in self.IterLineViews(maxSize=maxSize, stripNewline=stripNewline, stopOnTimeout=stopOnTimeout):
+			yield str(view, self.Encoding)
+	
+	def ReadAvailableLines(self, maxLines=None, maxSize=None, stripNewline=False):
+		'''
+		Moves the bytes already waiting in the OS receive buffer into the read buffer without blocking, and removes and returns the complete lines (determined by NewlineRead). A partial line stays in the read buffer until the rest arrives. For event loops that call it when the port's FileDescriptor is readable.
+		
+		@maxLines: The maximum number of lines to return. Further complete lines stay in the read buffer for the next call (so one busy port can't hold up a loop serving several). If None, there is no limit.
+		@maxSize: The maximum number of bytes in a line. If maxSize bytes are received without a line ending, they are returned as a line. If maxSize is None, there is no limit.
+		@stripNewline: If true, removes the line ending from the end of each line.
+		
+		Returns: list[str] (the lines, possibly empty), or None (if the port is closed or failed, or the reader thread is running)
+		'''
+		if (self.IsOpen == False) or (self.ser is None):
+			return None
+		if self._BufferOwnedByReaderThread():
+			return None
+		if self._ReceiveAvailable() is None:
+			return None
+		
+		newline = self.NewlineRead.encode(self.Encoding)
+		lines = []
+		while (maxLines is None) or (len(lines) < maxLines):
+			index = self._FindInReadBuffer(newline)
+			if index >= 0:
+				numbytes = index - self.readStart + len(newline)
+				lineLength = numbytes - len(newline) if stripNewline else numbytes
+			elif (maxSize is not None) and (self.readEnd - self.readStart >= maxSize):
+				numbytes = maxSize
+				lineLength = maxSize
+			else:
+				break
+			lines.append(str(memoryview(self.readbuffer)[self.readStart:self.readStart + lineLength], self.Encoding))
+			self._ConsumeReadBuffer(numbytes)
+		self.linesReceived += len(lines)
+		return lines
+	
+	def StartReaderThread(self, queueSize=None, maxSize=None):
+		'''
+		Starts a dedicated thread that reads continuously from the serial port and pushes each complete line (decoded, with its line ending) into a bounded queue. While it runs, ReadLine and IterLines take lines from the queue, and the byte-level Peek/Read methods return None.
+		If the queue is full, the oldest line is dropped to make room and QueueOverflowCount is incremented.
+		
+		@queueSize: The maximum number of lines held in the queue. If None, LineQueueSize is used.
+		@maxSize: The maximum number of bytes in a line. If maxSize bytes are received without a line ending, they are queued as a line. If maxSize is None, there is no limit.
+		
+		Returns: bool (True if the reader thread is running)
+		'''
+		if (self.IsOpen == False) or (self.ser is None):
+			return False
+		if self.ReaderThreadRunning:
+			return True
+		if queueSize is None:
+			queueSize = self.LineQueueSize
+		self.lineQueue = queue.Queue(queueSize)
+		self.lineQueueOverflows = 0
+		self.readerStop = threading.Event()
+		self.readerThread = threading.Thread(target=self._ReaderThreadLoop, args=(maxSize,), name='UART reader ' + str(self.Port), daemon=True)
+		self.readerThread.start()
+		return True
+	
+	def StopReaderThread(self):
+		'''
+		Stops the reader thread. Lines already in the queue are discarded, and any partial line stays in the read buffer.
+		'''
+		if self.readerThread is None:
+			return
+		self.readerStop.set()
+		if self.IsOpen and hasattr(self.ser, 'cancel_read'):
+			# Wake the thread up if it is blocked waiting for a byte
+			self.ser.cancel_read()
+		self.readerThread.join()
+		self.readerThread = None
+		self.lineQueue = None
+		return
+	
+	def _BufferOwnedByReaderThread(self):
+		return (self.readerThread is not None) and (self.readerThread is not threading.current_thread())
+	
+	def _ReaderThreadLoop(self, maxSize):
+		lineQueue = self.lineQueue
+		newline = self.NewlineRead.encode(self.Encoding)
+		try:
+			while not self.readerStop.is_set():
+				frame = self._PeekFrameLength(newline, maxSize=maxSize)
+				if frame is None:
+					if self.IsOpen == False:
+						# Unplugged (or closed): a SerialException closes the port from this thread
+						return
+					continue
+				r = str(memoryview(self.readbuffer)[self.readStart:self.readStart + frame[0]], self.Encoding)
+				self._ConsumeReadBuffer(frame[1])
+				self.linesReceived += 1
+				self._QueueLine(r, self.receiveTime, lineQueue)
+		finally:
+			# Wakes up a ReadLine waiting on the queue, and tells it no more lines will come
+			self._QueueLine(self.READER_CLOSED, None, lineQueue)
+		return
+	
+	def _QueueLine(self, r, receiveTime, lineQueue=None):
+		# If the queue is full, the oldest line is dropped to make room
+		if lineQueue is None:
+			lineQueue = self.lineQueue
+		while True:
+			try:
+				lineQueue.put_nowait((r, receiveTime))
+				return
+			except queue.Full:
+				try:
+					lineQueue.get_nowait()
+				except queue.Empty:
+					pass
+				self.lineQueueOverflows += 1
+	
 	def FlushReadBuffer(self):
 		'''
 		Removes all data from the read buffer
 		'''
 		if (self.IsOpen == False) or (self.ser is None):
 			return
+		if self.lineQueue is not None:
+			# The read buffer belongs to the reader thread, only drop the lines it has already queued
+			while True:
+				try:
+					self.lineQueue.get_nowait()
+				except queue.Empty:
+					return
 		self.ser.reset_input_buffer()
-		self.readbuffer = b''
+		self.ResetReadBuffer()
 		return
 	
 	def FlushWriteBuffer(self):
@@ -573,6 +1218,7 @@ class UART():
 			except:
 				return None
 			# Set up the pin
+			GPIO = _ImportGPIO()
 			GPIO.setwarnings(False)
 			GPIO.setmode(GPIO.BOARD)
 			GPIO.setup(gpioPinNum, GPIO.OUT)
@@ -614,10 +1260,10 @@ class UART():
 			except:
 				return None
 			# Set up the pin
+			GPIO = _ImportGPIO()
 			GPIO.setwarnings(False)
 			GPIO.setmode(GPIO.BOARD)
 			# Return the output of the pin
 			GPIO.setup(gpioPinNum, GPIO.OUT)
 			return GPIO.input(gpioPinNum)
 		return None
-		
\ No newline at end of file
@@ -0,0 +1,68 @@
+# Measures the per-packet cost of the gateway loop logic: RoomGateway.HandleLine (decode, packet ID check and flow dispatch) on a stream of the demo room's packets, with and without commands awaiting confirmation.
+#
+# Run from the python directory or this one:
+#	python benchmarks/bench_dispatch.py
+
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flow_engine import FlowEngine, LoadFlow
+from room_gateway import RoomGateway, RegistryFromFlow
+from reliable_delivery import ReliableDelivery
+from tx_scheduler import TxScheduler
+from virtual_fleet import VirtualNode, DEMO_NODES
+
+FlowPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'flows', 'demo_flow.json')
+
+def MakeLines(count:int, seed:int=1):
+	'''
+	Returns: list[str] (the demo room's nodes taking turns to send their state, with increasing packet IDs)
+	'''
+	rng = random.Random(seed)
+	nodes = [VirtualNode(ID, name, 1.0, activationDevices, triggerDevices, 0.0) for ID, (name, activationDevices, triggerDevices) in DEMO_NODES.items()]
+	lines = []
+	for i in range(count):
+		node = nodes[i % len(nodes)]
+		node.Sense(rng)
+		lines.append(json.dumps(node.Transmit(i * 0.01, True), separators=(',', ':')) + '\r\n')
+	return lines
+
+def MakeRoom(withDelivery:bool):
+	flow = FlowEngine(LoadFlow(FlowPath))
+	registry = RegistryFromFlow(flow)
+	delivery = None
+	if withDelivery:
+		# Commands are queued but never written, so they stay outstanding and every packet is checked against them
+		delivery = ReliableDelivery(TxScheduler(None, autostart=False), registry)
+		delivery.Send(4, 1, 'SO', '1')
+		delivery.Send(4, 2, 'SO', '1')
+		delivery.Send(6, 1, 'LED', '1')
+	return RoomGateway('bench', flow, registry, delivery, verbose=False)
+
+def Run(number:int=50000):
+	'''
+	Returns: list[dict] (packets per second and microseconds per packet for each case)
+	'''
+	lines = MakeLines(number)
+	results = []
+	for name, withDelivery in (('HandleLine', False), ('HandleLine with outstanding commands', True)):
+		best = None
+		for i in range(3):
+			room = MakeRoom(withDelivery)
+			start = perf_counter()
+			for line in lines:
+				room.HandleLine(line, 0.0)
+			elapsed = perf_counter() - start
+			if room.DecodeErrors or room.Replayed:
+				raise Exception('Unexpected packet errors in the benchmark stream')
+			best = elapsed if best is None else min(best, elapsed)
+		results.append({'case': name, 'packets_per_second': number / best, 'us_per_packet': best / number * 1e6})
+	return results
+
+if __name__ == '__main__':
+	for r in Run():
+		print('%-40s %10.0f packets/s %7.2f us/packet' % (r['case'], r['packets_per_second'], r['us_per_packet']))
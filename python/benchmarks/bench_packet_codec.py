@@ -0,0 +1,49 @@
+# Compares the JSON and binary packet encodings: size on the wire and encode/decode time.
+#
+# Run from the python directory or this one:
+#	python benchmarks/bench_packet_codec.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import packet_codec
+
+
+# Packets as they appear on the gateway link
+SamplePackets = {
+	'outlet command': {'SNID': 1, 'TNID': 4, 'PID': 300, 'UT': 1, 'AL': [{'ID': 1, 'T': 'SO', 'S': '1'}]},
+	'step trigger': {'SNID': 7, 'TNID': 1, 'PID': 57, 'UT': 184211, 'TL': [{'ID': 1, 'T': 'STEP', 'S': '1'}]},
+	'light telemetry': {'SNID': 3, 'TNID': 1, 'PID': 1042, 'UT': 3600123, 'TL': [{'ID': 1, 'T': 'light', 'S': 'Tel:412.50,Trig:0'}]},
+	'outlet state report': {'SNID': 4, 'TNID': 1, 'PID': 301, 'UT': 98012, 'AL': [{'ID': 1, 'T': 'SO', 'S': '1'}, {'ID': 2, 'T': 'SO', 'S': '0'}, {'ID': 3, 'T': 'SO', 'S': '0'}, {'ID': 4, 'T': 'SO', 'S': '?', 'ER': 'null SetStateFunc'}]},
+}
+
+def Bench(func, arg, number):
+	return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+
+def Run(number=20000):
+	'''
+	Returns: list[dict] (one result per sample packet)
+	'''
+	results = []
+	for name, d in SamplePackets.items():
+		j = packet_codec.EncodeJson(d)
+		b = packet_codec.EncodeBinary(d)
+		assert packet_codec.Decode(j) == d
+		assert packet_codec.Decode(b) == d
+		results.append({
+			'packet': name,
+			'json_bytes': len(j) + 1,	# plus the line ending
+			'binary_bytes': len(b),
+			'json_encode_us': Bench(packet_codec.EncodeJson, d, number) * 1e6,
+			'binary_encode_us': Bench(packet_codec.EncodeBinary, d, number) * 1e6,
+			'json_decode_us': Bench(packet_codec.DecodeJson, j, number) * 1e6,
+			'binary_decode_us': Bench(packet_codec.DecodeBinary, b, number) * 1e6,
+		})
+	return results
+
+if __name__ == '__main__':
+	print('%-20s %6s %6s %9s %9s %9s %9s' % ('packet', 'json B', 'bin B', 'json enc', 'bin enc', 'json dec', 'bin dec'))
+	for r in Run():
+		print('%-20s %6d %6d %7.2fus %7.2fus %7.2fus %7.2fus' % (r['packet'], r['json_bytes'], r['binary_bytes'], r['json_encode_us'], r['binary_encode_us'], r['json_decode_us'], r['binary_decode_us']))
@@ -0,0 +1,51 @@
+# Compares packet decode throughput: the demo gateway's json.loads plus ad-hoc key checks, the validating PacketDecoder, and the trusted fast path.
+#
+# Run from the python directory or this one:
+#	python benchmarks/bench_packet_decoder.py
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from packet_decoder import PacketDecoder
+
+
+SampleLines = [
+	'{"SNID":7,"TNID":1,"PID":57,"UT":184211,"TL":[{"ID":1,"T":"STEP","S":"1"}]}\n',
+	'{"SNID":3,"TNID":1,"PID":1042,"UT":3600123,"TL":[{"ID":1,"T":"light","S":"Tel:412.50,Trig:0"}]}\n',
+	'{"SNID":4,"TNID":1,"PID":301,"UT":98012,"AL":[{"ID":1,"T":"SO","S":"1"},{"ID":2,"T":"SO","S":"0"},{"ID":3,"T":"SO","S":"0"},{"ID":4,"T":"SO","S":"0"}]}\n',
+]
+
+def DecodeLikeDemo(s):
+	# What escape-room-demo-sam-murray.py did before PacketDecoder
+	d = json.loads(s)
+	if 'SNID' not in d:
+		return None
+	if 'PID' not in d:
+		return None
+	TL = None
+	if 'TL' in d:
+		TL = d['TL']
+	return d
+
+def Run(number=20000):
+	'''
+	Returns: list[dict] (packets per second for each decoder)
+	'''
+	validating = PacketDecoder()
+	trusted = PacketDecoder(trusted=True)
+	decoders = [('demo json.loads + key checks', DecodeLikeDemo), ('PacketDecoder', validating.Decode), ('PacketDecoder trusted', trusted.Decode)]
+	results = []
+	for name, decode in decoders:
+		def DecodeAll():
+			for s in SampleLines:
+				decode(s)
+		seconds = min(timeit.repeat(DecodeAll, number=number, repeat=5))
+		results.append({'decoder': name, 'packets_per_second': number * len(SampleLines) / seconds})
+	return results
+
+if __name__ == '__main__':
+	for r in Run():
+		print('%-30s %10.0f packets/s' % (r['decoder'], r['packets_per_second']))
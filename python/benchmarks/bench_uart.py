@@ -0,0 +1,198 @@
+# Measures the UART hot paths with no hardware: reading lines with ReadLine and with PeekBytesUntil + ReadBytes, at several line sizes and backlog depths, and writing lines with WriteLine.
+#
+# The link is a pty pair (POSIX) or pyserial's loop:// port, whose byte-at-a-time queue makes it much slower than a real port; compare results on the same transport only. The backlog is the number of lines that arrive together, i.e. that are waiting when the reader gets to them. loop:// holds at most 4096 bytes, so larger backlogs are skipped on it.
+#
+# Run from the python directory or this one:
+#	python benchmarks/bench_uart.py [pty|loop]
+
+import os
+import sys
+import threading
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from UART import UART
+
+
+LineSizes = (32, 128, 1024)	# Bytes per line, including the line ending
+Backlogs = (1, 16, 256)	# Lines that arrive together
+LOOP_CAPACITY = 4096	# Bytes the loop:// port holds before writes block
+
+def MakeLine(size:int):
+	return b'{' + b'x' * (size - 3) + b'}\n'
+
+class Link():
+	'''
+	An open UART and the far end of its link
+	'''
+	def __init__(self, transport:str):
+		self.Transport = transport
+		self.UART = UART()
+		if transport == 'pty':
+			import tty
+			self.master, slave = os.openpty()
+			tty.setraw(self.master)
+			tty.setraw(slave)
+			ok = self.UART.Open(os.ttyname(slave), baudrate=115200)
+			os.close(slave)
+		else:
+			self.master = None
+			ok = self.UART.Open('loop://', baudrate=115200)
+		if ok is not True:
+			raise Exception('Could not open the ' + transport + ' link')
+		self.UART.Timeout = 1.0
+		return
+	
+	@property
+	def Capacity(self):
+		'''
+		Bytes that can be written before the reader has to take some (None if unbounded)
+		'''
+		return LOOP_CAPACITY if self.master is None else None
+	
+	def Feed(self, data:bytes):
+		'''
+		Sends data towards the UART
+		'''
+		if self.master is None:
+			self.UART.ser.write(data)
+			return
+		view = memoryview(data)
+		while view:
+			count = os.write(self.master, view)
+			view = view[count:]
+		return
+	
+	def Drain(self):
+		'''
+		Discards what the UART has written
+		'''
+		if self.master is None:
+			self.UART.ser.reset_input_buffer()
+			return
+		os.read(self.master, 1 << 20)
+		return
+	
+	def Close(self):
+		self.UART.Close()
+		if self.master is not None:
+			os.close(self.master)
+		return
+
+def _ReadLine(uart):
+	return uart.ReadLine()
+
+def _PeekThenRead(uart):
+	r = uart.PeekBytesUntil(b'\n')
+	if r is None:
+		return None
+	return uart.ReadBytes(len(r))
+
+def BenchRead(link, read, size:int, backlog:int, totalLines:int):
+	'''
+	Returns: float (lines per second), or None (if the backlog doesn't fit the link)
+	'''
+	burst = MakeLine(size) * backlog
+	bursts = max(1, totalLines // backlog)
+	uart = link.UART
+	if link.Capacity is not None:
+		if len(burst) > link.Capacity:
+			return None
+		# loop:// is its own far end, so write a burst and read it back on this thread
+		start = perf_counter()
+		for i in range(bursts):
+			link.Feed(burst)
+			for j in range(backlog):
+				if read(uart) is None:
+					raise Exception('Timed out reading')
+		return bursts * backlog / (perf_counter() - start)
+	
+	# Feed the bursts from another thread, each one once the previous has been read
+	ready = threading.Semaphore(1)
+	def Feeder():
+		for i in range(bursts):
+			ready.acquire()
+			link.Feed(burst)
+		return
+	feeder = threading.Thread(target=Feeder, daemon=True)
+	start = perf_counter()
+	feeder.start()
+	for i in range(bursts):
+		for j in range(backlog):
+			if read(uart) is None:
+				raise Exception('Timed out reading')
+		ready.release()
+	elapsed = perf_counter() - start
+	feeder.join()
+	return bursts * backlog / elapsed
+
+def BenchWrite(link, size:int, totalLines:int):
+	'''
+	Returns: float (microseconds per WriteLine)
+	'''
+	line = MakeLine(size)[:-1].decode('latin-1')
+	uart = link.UART
+	if link.Capacity is not None:
+		batch = max(1, link.Capacity // size)
+		elapsed = 0.0
+		for i in range(0, totalLines, batch):
+			start = perf_counter()
+			for j in range(batch):
+				uart.WriteLine(line)
+			elapsed += perf_counter() - start
+			link.Drain()
+		return elapsed / (((totalLines + batch - 1) // batch) * batch) * 1e6
+	
+	stop = threading.Event()
+	def Drainer():
+		while not stop.is_set():
+			link.Drain()
+		return
+	drainer = threading.Thread(target=Drainer, daemon=True)
+	drainer.start()
+	start = perf_counter()
+	for i in range(totalLines):
+		uart.WriteLine(line)
+	elapsed = perf_counter() - start
+	stop.set()
+	uart.WriteLine('')	# Wake the drainer up
+	drainer.join()
+	return elapsed / totalLines * 1e6
+
+def Run(transport:str=None, totalLines:int=20000):
+	'''
+	Returns: list[dict] (one result per measurement)
+	'''
+	if transport is None:
+		transport = 'pty' if os.name == 'posix' else 'loop'
+	if transport == 'loop':
+		# loop:// moves bytes through a queue one at a time, so it is ~50x slower than a pty
+		totalLines //= 20
+	results = []
+	link = Link(transport)
+	try:
+		for size in LineSizes:
+			lines = max(200, totalLines * 128 // max(size, 128))
+			for backlog in Backlogs:
+				for name, read in (('ReadLine', _ReadLine), ('PeekBytesUntil', _PeekThenRead)):
+					best = None
+					for i in range(3):
+						r = BenchRead(link, read, size, backlog, lines)
+						if r is None:
+							break
+						best = r if best is None else max(best, r)
+					if best is None:
+						continue
+					results.append({'method': name, 'transport': transport, 'line_bytes': size, 'backlog': backlog, 'lines_per_second': best, 'megabytes_per_second': best * size / 1e6})
+			best = min(BenchWrite(link, size, lines) for i in range(3))
+			results.append({'method': 'WriteLine', 'transport': transport, 'line_bytes': size, 'us_per_line': best})
+	finally:
+		link.Close()
+	return results
+
+if __name__ == '__main__':
+	for r in Run(sys.argv[1] if len(sys.argv) > 1 else None):
+		if 'lines_per_second' in r:
+			print('%-15s %5s %5d B x %-4d %10.0f lines/s %8.1f MB/s' % (r['method'], r['transport'], r['line_bytes'], r['backlog'], r['lines_per_second'], r['megabytes_per_second']))
+		else:
+			print('%-15s %5s %5d B        %10.2f us/line' % (r['method'], r['transport'], r['line_bytes'], r['us_per_line']))
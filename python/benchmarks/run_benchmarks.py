@@ -0,0 +1,130 @@
+# Runs every benchmark and writes the results as JSON, optionally comparing them with an earlier run so regressions between versions show up.
+#
+# Run from the python directory or this one:
+#	python benchmarks/run_benchmarks.py --output results.json
+#	python benchmarks/run_benchmarks.py --compare results.json
+#
+# Each result is {"suite", "name", "params", "metric", "value", "higher_is_better"}; a result is matched with the earlier run's by suite, name, params and metric.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_dispatch
+import bench_packet_codec
+import bench_packet_decoder
+import bench_uart
+
+# Result field -> whether a larger value is better. Fields not listed here are parameters of the measurement.
+METRICS = {
+	'lines_per_second': True,
+	'megabytes_per_second': True,
+	'packets_per_second': True,
+	'us_per_line': False,
+	'us_per_packet': False,
+	'json_encode_us': False,
+	'binary_encode_us': False,
+	'json_decode_us': False,
+	'binary_decode_us': False,
+}
+
+# Suite -> (function(quick, transport) returning the suite's results, the result field that names the measurement)
+SUITES = {
+	'uart': (lambda quick, transport: bench_uart.Run(transport, totalLines=2000 if quick else 20000), 'method'),
+	'codec': (lambda quick, transport: bench_packet_codec.Run(number=2000 if quick else 20000), 'packet'),
+	'decoder': (lambda quick, transport: bench_packet_decoder.Run(number=2000 if quick else 20000), 'decoder'),
+	'dispatch': (lambda quick, transport: bench_dispatch.Run(number=5000 if quick else 50000), 'case'),
+}
+
+def Flatten(suite:str, results:list, nameField:str):
+	'''
+	Returns: list[dict] (one record per metric of each result)
+	'''
+	records = []
+	for r in results:
+		params = {k: v for k, v in r.items() if (k not in METRICS) and (k != nameField)}
+		for metric, higherIsBetter in METRICS.items():
+			if metric in r:
+				records.append({'suite': suite, 'name': r[nameField], 'params': params, 'metric': metric, 'value': r[metric], 'higher_is_better': higherIsBetter})
+	return records
+
+def GitRevision():
+	try:
+		return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=10).stdout.strip() or None
+	except (OSError, subprocess.SubprocessError):
+		return None
+
+def RunSuites(suites, quick:bool=False, transport:str=None):
+	'''
+	Returns: dict (the run's environment and its records)
+	'''
+	records = []
+	for suite in suites:
+		run, nameField = SUITES[suite]
+		print('Running', suite, 'benchmarks...', file=sys.stderr)
+		records += Flatten(suite, run(quick, transport), nameField)
+	return {
+		'revision': GitRevision(),
+		'time': datetime.now(timezone.utc).isoformat(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'quick': quick,
+		'results': records,
+	}
+
+def _Key(record:dict):
+	return (record['suite'], record['name'], json.dumps(record['params'], sort_keys=True), record['metric'])
+
+def Compare(baseline:dict, current:dict, threshold:float):
+	'''
+	Returns: list[tuple] (record, baseline value, relative change towards better, True if worse than threshold) for the records in both runs
+	'''
+	before = {_Key(r): r['value'] for r in baseline['results']}
+	rows = []
+	for r in current['results']:
+		old = before.get(_Key(r))
+		if not old:
+			continue
+		change = (r['value'] - old) / old
+		if not r['higher_is_better']:
+			change = -change
+		rows.append((r, old, change, change < -threshold))
+	return rows
+
+def _Describe(record:dict):
+	params = ' '.join(str(k) + '=' + str(v) for k, v in record['params'].items())
+	return ('%s/%s %s %s' % (record['suite'], record['name'], params, record['metric'])).replace('  ', ' ')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Runs the gateway benchmarks with no hardware and writes the results as JSON')
+	parser.add_argument('--suite', action='append', choices=list(SUITES.keys()), help='suite to run (repeatable, default: all)')
+	parser.add_argument('--transport', choices=('pty', 'loop'), default=None, help='UART link (default: pty on POSIX, loop:// elsewhere)')
+	parser.add_argument('--quick', action='store_true', help='fewer iterations, for a smoke test')
+	parser.add_argument('--output', help='file to write the results to (default: stdout)')
+	parser.add_argument('--compare', help='results file of an earlier run to compare with')
+	parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown reported as a regression (default: 0.10)')
+	args = parser.parse_args()
+	
+	current = RunSuites(args.suite or list(SUITES.keys()), quick=args.quick, transport=args.transport)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(current, f, indent='\t')
+	elif not args.compare:
+		json.dump(current, sys.stdout, indent='\t')
+		print()
+	
+	if args.compare:
+		with open(args.compare, 'r') as f:
+			baseline = json.load(f)
+		regressions = 0
+		print('Compared with', baseline.get('revision'), 'from', baseline.get('time'))
+		for record, old, change, regressed in Compare(baseline, current, args.threshold):
+			regressions += regressed
+			print('%-80s %12.4g -> %12.4g %+7.1f%%%s' % (_Describe(record), old, record['value'], change * 100, '  REGRESSION' if regressed else ''))
+		print(regressions, 'regressions')
+		exit(1 if regressions else 0)
@@ -0,0 +1,144 @@
+# Routes cloud commands to end nodes over serial
+#
+# IoT Central SetState commands (the same commands as the flow definition's triggers, e.g. {"NAME":"SetState","TNID":"4","AID":"1","S":"1"}) are turned into activation packets for the gateway board:
+#	{"SNID":1,"TNID":4,"PID":301,"UT":1,"AL":[{"ID":1,"T":"SO","S":"1"}]}
+
+import json
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+class CommandRouter():
+	'''
+	Turns cloud commands into AL packets and queues them on a TxScheduler, one queue per target node, so the caller (e.g. the IoT Central command callback) never waits on serial. Packet IDs come from a NodeRegistry when each packet is actually written, so they increase in the order the node receives them.
+	
+	A node that hasn't been heard from since the gateway started may have been counting packet IDs for a long time, and would reject a packet ID taken from a guess as a replay. So commands for it are held (the newest per activation device) until its first packet is received, and then queued.
+	'''
+	# Public variables
+	SNID = 1	# The gateway's node ID
+	DefaultType = 'SO'	# Activation device type used when a command has no "T"
+	DeviceTypes = None	# dict of TNID -> activation device type, for nodes whose devices aren't DefaultType
+	
+	# Private variables
+	tx = None
+	registry = None
+	startTime = 0.0
+	held = None	# dict of TNID -> OrderedDict of AID -> (build function, trace), for nodes not heard from yet
+	lock = None
+	
+	routed = 0
+	rejected = 0
+	
+	
+	# Properties
+	@property
+	def Routed(self):
+		return self.routed
+	
+	@property
+	def Rejected(self):
+		return self.rejected
+	
+	@property
+	def Held(self):
+		'''
+		Returns: int (commands waiting for their node to be heard from)
+		'''
+		with self.lock:
+			return sum(len(h) for h in self.held.values())
+	
+	
+	# Constructor
+	def __init__(self, tx, registry, SNID:int=None, deviceTypes:dict=None):
+		'''
+		@tx: the TxScheduler packets are queued on
+		@registry: the NodeRegistry packet IDs are taken from, and that is told when a node is first heard from (feed it every received packet, e.g. through GatewayPipeline). Target nodes it doesn't know yet are added to it.
+		@SNID: the gateway's node ID. If None, SNID is used.
+		@deviceTypes: TNID -> activation device type
+		'''
+		self.tx = tx
+		self.registry = registry
+		if SNID is not None:
+			self.SNID = SNID
+		self.DeviceTypes = dict(deviceTypes) if deviceTypes is not None else dict()
+		self.startTime = monotonic()
+		self.held = dict()
+		self.lock = threading.Lock()
+		registry.OnHeard(self._OnHeard)
+		return
+	
+	
+	
+	
+	# Methods
+	def Route(self, command:dict, trace=None):
+		'''
+		Queues a SetState command for its target node (or holds it until the node has been heard from). Returns immediately; a newer command for the same activation device that arrives before the packet is written replaces it.
+		
+		@command: dict with "NAME", "TNID", "AID" and "S" (and optionally "T"). TNID and AID may be strings, as IoT Central sends them.
+		@trace: a latency_trace.Trace, marked written when the packet is written
+		
+		Returns: bool (True if the command was queued or held)
+		'''
+		if command.get('NAME', 'SetState') != 'SetState':
+			return self._Reject('Unsupported command ' + repr(command.get('NAME')))
+		try:
+			TNID = int(command['TNID'])
+			AID = int(command['AID'])
+		except (KeyError, TypeError, ValueError):
+			return self._Reject('SetState needs integer TNID and AID: ' + repr(command))
+		S = command.get('S')
+		if type(S) is not str:
+			return self._Reject('SetState S must be a string for serial nodes: ' + repr(command))
+		T = command.get('T') or self.DeviceTypes.get(TNID, self.DefaultType)
+		
+		record = self.registry.Get(TNID)
+		if record is None:
+			record = self.registry.Add(TNID, T)
+		
+		def Build():
+			# Runs on the TX scheduler's writer thread
+			d = {
+				'SNID': self.SNID,
+				'TNID': TNID,
+				'PID': self.registry.NextTxPID(TNID),
+				'UT': int((monotonic() - self.startTime) * 1000),
+				'AL': [
+					{
+						'ID': AID,
+						'T': T,
+						'S': S
+					}
+				]
+			}
+			return json.dumps(d, separators=(',', ':'))
+		
+		with self.lock:
+			if record.LastSeen is None:
+				if TNID not in self.held:
+					print('Node', TNID, 'has not been heard from yet, holding its commands')
+				self.held.setdefault(TNID, OrderedDict())[AID] = (Build, trace)
+				self.routed += 1
+				return True
+		self._Submit(TNID, AID, Build, trace)
+		self.routed += 1
+		return True
+	
+	def _Submit(self, TNID:int, AID:int, build, trace):
+		self.tx.Submit((TNID, AID), build, node=TNID, onSent=trace.Written if trace is not None else None)
+		return
+	
+	def _OnHeard(self, record):
+		# Called by the registry when the first packet from a node is received
+		with self.lock:
+			held = self.held.pop(record.ID, None)
+		if held is None:
+			return
+		for AID, (build, trace) in held.items():
+			self._Submit(record.ID, AID, build, trace)
+		return
+	
+	def _Reject(self, message:str):
+		print('ERROR:', message)
+		self.rejected += 1
+		return False
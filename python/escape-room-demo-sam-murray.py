@@ -1,186 +1,105 @@
 # Written by Sam Murray
 
 from UART import UART
-import json
-from time import sleep
+from flow_engine import FlowEngine, LoadFlow
+from tx_scheduler import TxScheduler
+from reliable_delivery import ReliableDelivery
+from room_gateway import RoomGateway, RegistryFromFlow
+from session_log import SessionRecorder
+from latency_trace import LatencyTracer
+from metrics import MetricsRegistry, MetricsServer, CollectUART, CollectTx, CollectRoom
+import os
 
 
 # Global variables
-EndNodeIDs = {
-	'server': 1,
-	'light': 3,
-	'SO': 4,
-	'BUTN': 5,
-	'LED': 6,
-	'STEP': 7
-}
-
-nodes = [
-	{
-		'ID': EndNodeIDs['light'],
-		'PID': 2,
-		'T': 'light'
-	},
-	{
-		'ID': EndNodeIDs['SO'],
-		'PID': 200,
-		'T': 'SO'
-	},
-	{
-		'ID': EndNodeIDs['BUTN'],
-		'PID': 2,
-		'T': 'BUTN'
-	},
-	{
-		'ID': EndNodeIDs['LED'],
-		'PID': 200,
-		'T': 'LED'
-	},
-	{
-		'ID': EndNodeIDs['STEP'],
-		'PID': 2,
-		'T': 'STEP'
-	}
-]	# {"ID": int, "PID": int, "T": str}
+FlowPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows', 'demo_flow.json')
+flow = FlowEngine(LoadFlow(FlowPath))
+EndNodeIDs = flow.NodeIDs
+
+registry = RegistryFromFlow(flow, PIDs={'light': 2, 'SO': 200, 'BUTN': 2, 'LED': 200, 'STEP': 2})
 
 def set_outlet_state(outletNum:int, state:bool):
 	# Get the switched outlet node
-	n = None
-	for _n in nodes:
-		if _n['ID'] == EndNodeIDs['SO'] and _n['T'] == 'SO':
-			n = _n
-			break
-		
-	n['PID'] += 100
-	
-	d = {
-		'SNID': 1,
-		'TNID': EndNodeIDs['SO'],
-		'PID': n['PID'],
-		'UT': 1,
-		'AL': [
-			{
-				'ID': outletNum,
-				'T': 'SO',
-				'S': str(int(state))
-			}
-		]
-	}
-	
-	s = json.dumps(d, separators=(',', ':'))
-	
-	sleep(0.5)
-	uart.WriteLine(s)
-	print('Sending:', s)
-	sleep(0.5)
-	
+	if registry.Get(EndNodeIDs['SO'], 'SO') is None:
+		print('ERROR: No SO node is registered')
+		return
+	print('Sending: outlet', outletNum, 'state', int(state))
+	delivery.Send(EndNodeIDs['SO'], outletNum, 'SO', str(int(state)))
+
 def set_led_state(state:bool):
 	# Get the LED node
-	n = None
-	for _n in nodes:
-		if _n['ID'] == EndNodeIDs['LED'] and _n['T'] == 'LED':
-			n = _n
-			break
-		
-	n['PID'] += 100
-	
-	d = {
-		'SNID': 1,
-		'TNID': EndNodeIDs['LED'],
-		'PID': n['PID'],
-		'UT': 1,
-		'AL': [
-			{
-				'ID': 1,
-				'T': 'SO',
-				'S': str(int(state))
-			}
-		]
-	}
-	
-	s = json.dumps(d, separators=(',', ':'))
-	
-	sleep(0.5)
-	uart.WriteLine(s)
-	print('Sending:', s)
-	sleep(0.5)
+	if registry.Get(EndNodeIDs['LED'], 'LED') is None:
+		print('ERROR: No LED node is registered')
+		return
+	print('Sending: LED state', int(state))
+	delivery.Send(EndNodeIDs['LED'], 1, 'SO', str(int(state)))
+
+# Rule for finding the gateway's serial port without asking (e.g. {'vid': 0x1B4F, 'pid': 0x214F, 'serialNumber': None}). Leave all None to choose interactively.
+GatewayPortRule = {'vid': None, 'pid': None, 'serialNumber': None}
+
+# Record the game's serial traffic to this file, to replay later with session_log.py (None to not record)
+SessionPath = os.environ.get('ESCAPE_ROOM_SESSION')
+
+# Serve UART and gateway metrics for Prometheus on this port (None to not serve them)
+MetricsPort = os.environ.get('ESCAPE_ROOM_METRICS_PORT')
 
 # Get UART port
 uart = UART()
-port = uart.InteractivePortChooser()
+if any(v is not None for v in GatewayPortRule.values()):
+	print('Waiting for the gateway serial port...')
+	port = uart.WaitForPort(**GatewayPortRule)
+else:
+	port = uart.InteractivePortChooser()
 
 if uart.Open(port, baudrate=115200) is not True:
 	print('ERROR: Failed to open serial port', port)
 	exit()
+if SessionPath:
+	uart.Recorder = SessionRecorder(SessionPath)
+
+# Keep receiving while the main loop is busy sending commands
+uart.StartReaderThread()
+
+# Send commands from a writer thread, at most two a second so the gateway can keep up
+tx = TxScheduler(uart, rate=2.0)
+
+# Resend commands until the nodes report the new state
+delivery = ReliableDelivery(tx, registry)
+
+# Time each trigger from the frame arriving to its commands being written
+tracer = LatencyTracer()
+
+# The room sends the flow's SetState commands itself, so each one carries the trace of the trigger that sent it
+room = RoomGateway('demo', flow, registry, delivery, tracer=tracer)
+room.DeviceTypes[EndNodeIDs['SO']] = 'SO'
+room.DeviceTypes[EndNodeIDs['LED']] = 'SO'	# The LED node's activation device is an SO device, as in LED200_main.ino
+
+if MetricsPort:
+	metrics = MetricsRegistry()
+	metrics.Add(CollectUART, uart, room='demo')
+	metrics.Add(CollectTx, tx, room='demo')
+	metrics.Add(CollectRoom, room)
+	MetricsServer(metrics, port=int(MetricsPort)).Start()
 
 
 set_outlet_state(1, False)
 set_led_state(False)
 
-state = 0
-while True:
-	# Wait for a line to come in from serial
-	s = uart.ReadLine()
+# Handle each line as soon as it comes in from serial
+while uart.ReaderThreadRunning:
+	# Wake up regularly to resend unconfirmed commands
+	s = uart.ReadLine(timeout=0.1)
+	room.Poll()
 	if s is None:
 		continue
 	
-	print('Received:', s.strip())
-	
-	# Decode JSON string to dictionary
-	try:
-		d = json.loads(s)
-	except:
-		print('ERROR: Unable to decode JSON string:', s)
-		continue
-	
-	if 'SNID' not in d:
-		print('ERROR: SNID not in JSON string:', s)
-		continue
-	
-	if 'PID' not in d:
-		print('ERROR: PID not in JSON string:', s)
-		continue
-	
-	TL = None
-	if 'TL' in d:
-		TL = d['TL']
-	
-	# Get the node
-	n = None
-	for _n in nodes:
-		if _n['ID'] == d['SNID']:
-			n = _n
-			break
-		
-	n['PID'] = d['PID']
-	
-	if state == 0:
-		# Waiting for step trigger
-		if d['SNID'] == EndNodeIDs['STEP']:
-			if TL is not None and len(TL) > 0:
-				S = TL[0]['S']
-				if S == '1':
-					state = 1
-					set_outlet_state(1, True)
-					print('Advancing to state', state)
-	elif state == 1:
-		# Waiting for light sensor trigger
-		if d['SNID'] == EndNodeIDs['light']:
-			if TL is not None and len(TL) > 0:
-				S = TL[0]['S']
-				if 'Trig:1' in S:
-					state = 2
-					set_led_state(True)
-					set_led_state(True)
-					set_led_state(True)
-					print('Advancing to state', state)
-	elif state == 2:
-		# Waiting for book to be removed
-		if d['SNID'] == EndNodeIDs['BUTN']:
-			if TL is not None and len(TL) > 0:
-				S = TL[0]['S']
-				if S == '0':
-					state = 3
-					print('ESCAPED!')
-					exit(0)
-					
\ No newline at end of file
+	room.HandleLine(s, uart.LastLineTime)
+	if flow.Complete:
+		print('ESCAPED!')
+		tx.Stop(timeout=5)
+		if uart.Recorder is not None:
+			uart.Recorder.Close()
+		print('Sent', tx.Sent, 'commands (%d merged), average queue latency %.2f s' % (tx.Coalesced, tx.AverageLatency or 0))
+		print('Delivered', delivery.Delivered, 'commands with', delivery.Retransmits, 'retransmissions, average latency %.2f s' % (delivery.AverageLatency or 0))
+		print(tracer.Report())
+		exit(0)
@@ -11,147 +11,330 @@
 #
 # The Gateway portion of the application receives and sends serial
 # messages with a microcontroller on a LoRaWAN network.
+#
+# Start-up shows the GUI first and does the slow work in the background:
+# the gateway board is opened and IoT Central is connected on their own
+# threads. The last GUI state from the cloud is saved, so after a reboot
+# during a game the room comes back as it was before the cloud answers.
+# Each start-up phase is printed with the time it was reached.
 
-import random 
 import time
+STARTUP_START = time.perf_counter()
+
+import json
+import os
+import random
+import threading
 
 # Library for GUI
 from guizero import App, Text, TextBox, PushButton
 
-# Library for USB Serial Connection
-import serial
+# Libraries for USB Serial Connection to the gateway board
+from UART import UART
+from flow_engine import FlowEngine, LoadFlow
+from gateway_pipeline import GatewayPipeline
+from node_registry import NodeRegistry
+from tx_scheduler import TxScheduler
+from command_router import CommandRouter
+from telemetry_aggregator import TelemetryAggregator
+from latency_trace import LatencyTracer
+from metrics import MetricsRegistry, MetricsServer, CollectUART, CollectPipeline
 
 # Libraries for Cloud Connection
-import threading
-import requests
-from iotc.models import Command, Property 
-from iotc import IoTCClient, IOTCConnectType, IOTCEvents 
+# (iotc is imported by connect_cloud, in the background)
+from outbound_dispatcher import OutboundDispatcher
 
-is_complete = False
+startup_phases = []
 
-# GUI Setup
-app = App(title="Escape Room")
+def startup_phase(name):
+    """Record and print the time since start-up at which a phase was reached."""
+    elapsed = time.perf_counter() - STARTUP_START
+    startup_phases.append((name, elapsed))
+    print(f"Startup: {name} at {elapsed * 1000:.0f} ms")
 
-header = Text(app,
-                    text="",
-                    size=60,
-                    font="Times New Roman",
-                    color="lightblue",
-                    visible = False)
+startup_phase("imports done")
 
-instructions = Text(app,
-                    text="",
-                    size=40,
-                    font="Times New Roman",
-                    color="lightblue",
-                    visible = False)
+is_complete = False
 
-code_box = TextBox(app, visible = False)
+# GUI Setup (see build_gui)
+app = None
+header = None
+instructions = None
+code_box = None
+submit_button = None
 code = ""
 failed_attempts = 0
+start_time = None
+
+def build_gui():
+    global app, header, instructions, code_box, submit_button
+    app = App(title="Escape Room")
+
+    header = Text(app,
+                        text="",
+                        size=60,
+                        font="Times New Roman",
+                        color="lightblue",
+                        visible = False)
+
+    instructions = Text(app,
+                        text="",
+                        size=40,
+                        font="Times New Roman",
+                        color="lightblue",
+                        visible = False)
+
+    code_box = TextBox(app, visible = False)
+
+    submit_button = PushButton(app, command=submit_code, text="", visible = False)
 
 def submit_code():
+    global failed_attempts
     if code_box.value == code:
-        device.send_telemetry({ 
+        # Both calls return immediately; the GUI never waits on the cloud
+        outbound.submit(send_telemetry, {
             'PasscodeTimeToComplete': time.time() - start_time
         })
-        thread = threading.Thread(target=azure_trigger)
-        thread.start()
+        azure_trigger()
     else:
         failed_attempts += 1
 
-submit_button = PushButton(app, command=submit_code, text="", visible = False)
+
+# Saved GUI state, so a restart mid-game doesn't wait for the cloud.
+# State older than STATE_MAX_AGE seconds is from an earlier game and is
+# not restored, and neither is a game that was already completed.
+STATE_PATH = os.environ.get("ESCAPE_ROOM_STATE_PATH", os.path.join(os.path.expanduser("~"), ".escape_room_state.json"))
+STATE_MAX_AGE = 2 * 60 * 60
+
+def apply_state(state):
+    """Show a GUI state sent by the cloud (the S of a SetState command for the app)."""
+    global is_complete, code
+    is_complete = state["IsComplete"] == "1"
+    header.value = state["HeaderText"]
+    header.visible = state["HeaderVisible"] == "1"
+    instructions.value = state["InstructionsText"]
+    instructions.visible = state["InstructionsVisible"] == "1"
+    code = state["Passcode"]
+    code_box.visible = state["PasscodeVisible"] == "1"
+    submit_button.text = state["ButtonText"]
+    submit_button.visible = state["ButtonVisible"] == "1"
+
+def save_state(state):
+    try:
+        with open(STATE_PATH + ".tmp", "w") as f:
+            json.dump({"saved": time.time(), "start_time": start_time, "state": state}, f)
+        # Replace the old file in one step, so a power cut never leaves half a file
+        os.replace(STATE_PATH + ".tmp", STATE_PATH)
+    except OSError as e:
+        print("Could not save the GUI state:", e)
+
+def restore_state():
+    """Show the saved GUI state if it is from a game still in progress.
+
+    returns True if it was restored
+    """
+    global start_time
+    try:
+        with open(STATE_PATH, "r") as f:
+            saved = json.load(f)
+        if time.time() - saved["saved"] > STATE_MAX_AGE:
+            return False
+        if saved["state"]["IsComplete"] == "1":
+            # That group escaped; the next one starts a new game
+            return False
+        apply_state(saved["state"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    start_time = saved.get("start_time") or start_time
+    return True
 
 
 # USB Serial Communication Setup
-# TODO
-def serial_listener():
-    ser = serial.Serial("portname?", 9600, timeout=0.1)
-    while not is_complete:
-        time.sleep(0.5)
-        line = ser.readline()
-        print(line)
+# Set ESCAPE_ROOM_SERIAL_PORT to the gateway board's port, or
+# ESCAPE_ROOM_GATEWAY_VID/ESCAPE_ROOM_GATEWAY_PID (e.g. 0x1B4F) to find it
+# by its USB IDs. Otherwise a USB serial port is only taken if it is the
+# only one, so an unrelated device is never opened by mistake.
+SERIAL_PORT = os.environ.get("ESCAPE_ROOM_SERIAL_PORT")
+GATEWAY_PORT_RULE = {
+    "vid": int(os.environ["ESCAPE_ROOM_GATEWAY_VID"], 0) if os.environ.get("ESCAPE_ROOM_GATEWAY_VID") else None,
+    "pid": int(os.environ["ESCAPE_ROOM_GATEWAY_PID"], 0) if os.environ.get("ESCAPE_ROOM_GATEWAY_PID") else None,
+}
+FLOW_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flows", "escape_room_flow.json")
+gateway = None
+router = None
+aggregator = TelemetryAggregator()
+# Trigger-to-actuation latency, through the Azure function and back
+tracer = LatencyTracer()
+# Set ESCAPE_ROOM_METRICS_PORT to serve UART and gateway metrics for
+# Prometheus on that port (localhost only)
+METRICS_PORT = os.environ.get("ESCAPE_ROOM_METRICS_PORT")
+
+def find_gateway_port(uart):
+    """Find the gateway board's port by GATEWAY_PORT_RULE, or take the only
+    free USB serial port (ports with no VID/PID, like COM1 or /dev/ttyS0,
+    are never taken).
+
+    returns the port, or None
+    """
+    if any(v is not None for v in GATEWAY_PORT_RULE.values()):
+        return uart.FindPort(**GATEWAY_PORT_RULE)
+    ports = uart.GetAvailableSerialPorts(removeConnectedPorts=True, removeBlankPorts=True)
+    if len(ports) > 1:
+        print("Gateway: several serial ports found", ports, "- set ESCAPE_ROOM_SERIAL_PORT or ESCAPE_ROOM_GATEWAY_VID/PID to choose one")
+        return None
+    return ports[0] if ports else None
+
+def start_gateway():
+    """Open the gateway board, start forwarding its packets to the cloud
+    and route cloud commands for the end nodes to it."""
+    global gateway, router
+    uart = UART()
+    port = SERIAL_PORT or find_gateway_port(uart)
+    if port is None or uart.Open(port, baudrate=115200) is not True:
+        print("Gateway: no serial port, running without the gateway board")
+        return
+    flow = FlowEngine(LoadFlow(FLOW_PATH))
+    registry = NodeRegistry()
+    for name, node_id in flow.NodeIDs.items():
+        if name not in ("server", "app"):
+            registry.Add(node_id, name)
+    # At most two packets a second, taking turns between target nodes
+    router = CommandRouter(TxScheduler(uart, rate=2.0), registry)
+    gateway = GatewayPipeline(uart,
+                              flow,
+                              outbound,
+                              send_telemetry,
+                              CLOUD_ENDPOINT,
+                              registry=registry,
+                              aggregator=aggregator,
+                              tracer=tracer)
+    gateway.Start()
+    print(f"Gateway: listening on {port}")
+    startup_phase("gateway listening")
+    if METRICS_PORT:
+        metrics = MetricsRegistry()
+        metrics.Add(CollectUART, uart, port=port)
+        metrics.Add(CollectPipeline, gateway)
+        MetricsServer(metrics, port=int(METRICS_PORT)).Start()
 
 
 # Cloud Setup - Azure Function
 #LOCAL_ENDPOINT = "http://localhost:7071/api/Trigger"
-CLOUD_ENDPOINT = "https://csce838escaperoomtrigger.azurewebsites.net/api/trigger"
+# Set ESCAPE_ROOM_TRIGGER_URL to call a different deployment (or a local function host)
+CLOUD_ENDPOINT = os.environ.get("ESCAPE_ROOM_TRIGGER_URL", "https://csce838escaperoomtrigger.azurewebsites.net/api/trigger")
+
+# Outbound cloud calls run on a small bounded pool with one keep-alive session
+outbound = OutboundDispatcher(workers=2, max_pending=16)
 
 def azure_trigger():
-    # The request will timeout (regardless of the timeout duration)
-    # because calling the azure function sends a command to this
-    # device. If this device is waiting on a response then it can't
-    # receive the command.
-    # An alternative (better) implementation would be to use a separate
-    # thread for the HTTP Triggered Azure Function call and response.
-    try:
-        r = requests.post(url = CLOUD_ENDPOINT, json = {"NAME":"PasscodeTrigger"})
-    except:
-        pass
+    # Calling the azure function sends a command back to this device,
+    # so the call is made on the outbound pool (with a timeout) and the
+    # GUI and command handler are free to receive it.
+    if not outbound.post(CLOUD_ENDPOINT, json = {"NAME":"PasscodeTrigger"}):
+        print("PasscodeTrigger dropped: outbound calls are backed up")
 
 # Cloud Setup - IoT Central
 scopeId = '0ne0086041B'
-device_id = 'EscapeRoomApp' 
+device_id = 'EscapeRoomApp'
 device_key = 'bvs67YYVkDh7NZDuTv5fiXL9BCi6NbxO5SPV3ujxAZA='
+# Set once connect_cloud has connected
+device = None
+POWER_ON_TIME = time.time()
 
-def on_commands(command: Command):
+def send_telemetry(telemetry):
+    """Send telemetry to IoT Central. Raises until the connection is up,
+    so the outbound pool counts the call as failed instead of waiting."""
+    if device is None:
+        raise ConnectionError("IoT Central is not connected yet")
+    device.send_telemetry(telemetry)
+
+def on_commands(command):
     print(f"{command.name} command was received")
     if not command.name == "SetState":
         return
 
     state = command.value["S"]
     print(command.value)
-    
+
+    # Commands sent because of a gateway trigger carry its trace ID
+    trace = tracer.Get(command.value.get("TRID"))
+    if trace is not None:
+        trace.CommandReceived()
+
     if command.value["TNID"] == '8': # The GUI application
-        is_complete = state["IsComplete"] == "1"
-        header.value = state["HeaderText"]
-        header.visible = state["HeaderVisible"] == "1"
-        instructions.value = state["InstructionsText"]
-        instructions.visible = state["InstructionsVisible"] == "1"
-        global code
-        code = state["Passcode"]
-        code_box.visible = state["PasscodeVisible"] == "1"
-        submit_button.text = state["ButtonText"]
-        submit_button.visible = state["ButtonVisible"] == "1"
-        
+        apply_state(state)
+        save_state(state)
+
+    elif router is not None:
+        # Queued for the end node; never waits on serial
+        router.Route(command.value, trace=trace)
     else:
-        # TODO: pass the command through USB serial.
-        # SERIAL WRITE
-        pass
-    
-    command.reply() 
-
-
-device = IoTCClient(device_id,  
-                    scopeId, 
-                    IOTCConnectType.IOTC_CONNECT_DEVICE_KEY, 
-                    device_key) 
- 
-device.connect() 
- 
-device.on(IOTCEvents.IOTC_COMMAND, on_commands) 
- 
-device.send_property({ 
-    "LastPowerOn8": time.time() 
-}) 
+        print("No gateway board: command for node", command.value["TNID"], "dropped")
 
+    command.reply()
 
-def heartbeat():
-    device.send_telemetry({ 
-        'PasscodeFailedAttempts': code_box.value,
-        'AverageLightLevel': 0,
-        'StepState': 0,
-        'ButtonState': 0
+def connect_cloud():
+    """Connect to IoT Central, retrying with a growing delay until it
+    works. Runs on its own thread, so the GUI is up in the meantime."""
+    global device
+    from iotc import IoTCClient, IOTCConnectType, IOTCEvents
+    startup_phase("iotc imported")
+
+    client = IoTCClient(device_id,
+                        scopeId,
+                        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+                        device_key)
+    client.on(IOTCEvents.IOTC_COMMAND, on_commands)
+
+    delay = 1
+    while True:
+        try:
+            client.connect()
+        except Exception as e:
+            print(f"IoT Central: could not connect ({type(e).__name__}: {e})")
+        if client.is_connected():
+            break
+        print(f"IoT Central: retrying in {delay} s")
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
+    device = client
+    startup_phase("IoT Central connected")
+    outbound.submit(device.send_property, {
+        "LastPowerOn8": POWER_ON_TIME
     })
-    
-    print("Heartbeat: telemtry sent")
 
 
-if device.is_connected(): 
-    code_box.repeat(60000, heartbeat)
+def heartbeat():
+    # Aggregates of the sensor readings received since start-up; reading
+    # them is O(1) per sensor however fast the sensors report
+    telemetry = {'PasscodeFailedAttempts': failed_attempts}
+    telemetry.update(aggregator.Heartbeat())
+    outbound.submit(send_telemetry, telemetry)
+
+    stats = outbound.stats()
+    print(f"Heartbeat: telemtry sent ({stats['in_flight']} cloud calls in flight, {stats['failed']} failed, {stats['dropped']} dropped)")
+    if tracer.Summary():
+        print(tracer.Report())
+
+
+def main():
+    global start_time
     start_time = time.time()
+    build_gui()
+    startup_phase("GUI built")
+    if restore_state():
+        startup_phase("game state restored")
+
+    # The serial port search and the cloud connection can each take
+    # seconds, so neither holds up the GUI (or each other)
+    threading.Thread(target=start_gateway, name="Gateway start-up", daemon=True).start()
+    threading.Thread(target=connect_cloud, name="IoT Central connect", daemon=True).start()
+
+    code_box.repeat(60000, heartbeat)
+    app.after(0, startup_phase, args=["GUI shown"])
     app.display()
-    
 
- 
-    
+
+if __name__ == "__main__":
+    main()
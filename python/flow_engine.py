@@ -0,0 +1,184 @@
+# Table-driven escape room flow
+#
+# A flow definition is a JSON document (see flows/escape_room_flow.json):
+#	"nodes": node name -> node ID
+#	"initial": the starting state
+#	"final": the state in which the room is escaped
+#	"steps": list of {"state", "source", "match", "trigger", "next"}: while in "state", a packet from node "source" whose device entry satisfies "match" fires "trigger" and moves to state "next"
+#	"triggers": trigger name -> list of commands ({"NAME", "TNID", "AID", "S"}), the same commands the Azure Trigger Function sends through IoT Central
+#
+# A "match" looks at one AL/TL entry of the packet: {"list": "TL" (default) or "AL", "index": 0 (default), "field": "S" (default), and one of "equals": str or "contains": str}.
+# Steps without a "match" (e.g. the passcode entered on the GUI app) are fired by name with FireTrigger instead of by packets.
+
+import json
+
+class FlowError(Exception):
+	pass
+
+def LoadFlow(path:str):
+	'''
+	Returns: dict (the flow definition in the JSON file at path)
+	'''
+	with open(path, 'r') as f:
+		return json.load(f)
+
+def CompileMatch(match:dict):
+	'''
+	Turns a step's "match" into a predicate on a received packet
+	
+	Returns: function(packet) -> bool
+	'''
+	listName = match.get('list', 'TL')
+	index = match.get('index', 0)
+	field = match.get('field', 'S')
+	if 'equals' in match:
+		value = match['equals']
+		test = lambda v: v == value
+	elif 'contains' in match:
+		value = match['contains']
+		test = lambda v: (v is not None) and (value in v)
+	else:
+		raise FlowError('match needs "equals" or "contains"')
+	
+	def Predicate(packet):
+		entries = getattr(packet, listName)
+		if (entries is None) or (len(entries) <= index):
+			return False
+		return test(getattr(entries[index], field))
+	return Predicate
+
+class FlowEngine():
+	'''
+	Runs a flow definition. The steps are compiled into a transition table keyed by (state, source node ID), so each received packet costs one dictionary lookup plus the predicates of the steps waiting on that node in the current state (usually one).
+	'''
+	# Private variables
+	definition = None
+	state = None
+	table = None	# dict of (state, source node ID) -> list of (predicate, step)
+	triggerSteps = None	# dict of (state, trigger name) -> step, for steps fired by name
+	triggers = None	# dict of trigger name -> list of commands
+	commandHandlers = None	# dict of command NAME -> function(command)
+	triggerHandlers = None	# list of function(trigger name, step)
+	
+	
+	# Properties
+	@property
+	def State(self):
+		return self.state
+	
+	@property
+	def Complete(self):
+		return self.state == self.definition.get('final')
+	
+	@property
+	def NodeIDs(self):
+		return dict(self.definition.get('nodes', {}))
+	
+	
+	# Constructor
+	def __init__(self, definition:dict):
+		'''
+		@definition: the flow definition (see LoadFlow)
+		'''
+		self.definition = definition
+		self.triggers = definition.get('triggers', {})
+		self.commandHandlers = dict()
+		self.triggerHandlers = []
+		self.Compile()
+		self.Reset()
+		return
+	
+	
+	
+	
+	# Methods
+	def Compile(self):
+		'''
+		Builds the transition table from the definition
+		'''
+		nodes = self.definition.get('nodes', {})
+		self.table = dict()
+		self.triggerSteps = dict()
+		for step in self.definition.get('steps', []):
+			if step.get('trigger') not in self.triggers:
+				raise FlowError('Step in state ' + str(step.get('state')) + ' fires unknown trigger ' + repr(step.get('trigger')))
+			if 'match' in step:
+				if step['source'] not in nodes:
+					raise FlowError('Unknown source node ' + repr(step['source']))
+				key = (step['state'], nodes[step['source']])
+				self.table.setdefault(key, []).append((CompileMatch(step['match']), step))
+			else:
+				self.triggerSteps[(step['state'], step['trigger'])] = step
+		return
+	
+	def Reset(self, state=None):
+		'''
+		@state: the state to continue from (e.g. after a gateway restart). If None, the flow starts over at its initial state.
+		'''
+		if state is None:
+			state = self.definition.get('initial', 0)
+		self.state = state
+		return
+	
+	def OnCommand(self, commandName:str, handler):
+		'''
+		Registers the function that carries out commands with this NAME (e.g. "SetState"). Commands with no handler are skipped.
+		
+		@handler: function(command:dict)
+		'''
+		self.commandHandlers[commandName] = handler
+		return
+	
+	def OnTrigger(self, handler):
+		'''
+		Registers a function called whenever a trigger fires, before its commands are run
+		
+		@handler: function(triggerName:str, step:dict)
+		'''
+		self.triggerHandlers.append(handler)
+		return
+	
+	def Commands(self, triggerName:str):
+		'''
+		Returns: list[dict] (the commands of a trigger), or None (if there is no such trigger)
+		'''
+		return self.triggers.get(triggerName)
+	
+	def Dispatch(self, packet):
+		'''
+		Advances the flow with a received packet
+		
+		@packet: a Packet from PacketDecoder
+		
+		Returns: str (the name of the trigger that fired), or None (if the packet didn't advance the flow)
+		'''
+		candidates = self.table.get((self.state, packet.SNID))
+		if candidates is None:
+			return None
+		for predicate, step in candidates:
+			if predicate(packet):
+				self._Fire(step)
+				return step['trigger']
+		return None
+	
+	def FireTrigger(self, triggerName:str):
+		'''
+		Fires a trigger that doesn't come from a packet (e.g. the passcode on the GUI app). The flow only advances if the current state is waiting for this trigger.
+		
+		Returns: bool (True if the trigger fired)
+		'''
+		step = self.triggerSteps.get((self.state, triggerName))
+		if step is None:
+			return False
+		self._Fire(step)
+		return True
+	
+	def _Fire(self, step):
+		self.state = step['next']
+		for handler in self.triggerHandlers:
+			handler(step['trigger'], step)
+		for command in self.triggers[step['trigger']]:
+			handler = self.commandHandlers.get(command['NAME'])
+			if handler is not None:
+				handler(command)
+		return
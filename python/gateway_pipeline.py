@@ -0,0 +1,272 @@
+# Serial-to-cloud gateway pipeline
+#
+# Lines from the gateway board are read as they arrive (by the UART's reader thread), decoded, and run through the puzzle flow. A packet that fires a trigger is forwarded to the Azure Trigger Function right away; sensor readings are sent to IoT Central as telemetry, merged into batches.
+
+import threading
+from collections import deque
+from time import monotonic
+from packet_decoder import PacketDecoder, PacketError
+from node_registry import PID_REPLAYED
+
+def SensorValue(device):
+	'''
+	Converts the state of a trigger device to a telemetry value. Light sensors report "Tel:<lux>,Trig:<0 or 1>", other devices a number.
+	
+	Returns: float or int, or None (if the state is not a number)
+	'''
+	S = device.S
+	if S is None:
+		return None
+	if S.startswith('Tel:'):
+		S = S[4:].split(',', 1)[0]
+	try:
+		return int(S)
+	except ValueError:
+		pass
+	try:
+		return float(S)
+	except ValueError:
+		return None
+
+class GatewayPipeline():
+	'''
+	Runs on its own thread: UART lines -> PacketDecoder -> FlowEngine -> cloud.
+	
+	The cloud link is allowed to be slow without holding up serial:
+	- Triggers are posted to the Azure Trigger Function through an OutboundDispatcher as soon as they fire. If the dispatcher is saturated they are held (in order) and retried, never dropped.
+	- Telemetry is merged into one pending batch (the newest value of each name wins) and sent at most every TelemetryInterval seconds, with at most one telemetry call in flight. While the link is slow, readings are merged instead of queued, so nothing builds up.
+	'''
+	# Public variables
+	TelemetryInterval = 1.0	# Seconds between telemetry sends
+	TelemetryNames = {'light': 'AverageLightLevel', 'STEP': 'StepState', 'BUTN': 'ButtonState'}	# Trigger device type -> telemetry name in the IoT Central device template
+	PollInterval = 0.1	# Longest time the pipeline thread waits for a line before checking timers
+	
+	# Private variables
+	uart = None
+	flow = None
+	dispatcher = None
+	sendTelemetry = None
+	triggerURL = None
+	decoder = None
+	registry = None
+	aggregator = None
+	tracer = None
+	thread = None
+	running = False
+	lock = None
+	
+	pendingTelemetry = None	# dict of telemetry name -> newest value
+	telemetryInFlight = False
+	nextTelemetryTime = 0.0
+	heldTriggers = None	# deque of (trigger request body, receive time) waiting for room in the dispatcher
+	
+	framesReceived = 0
+	decodeErrors = 0
+	triggersForwarded = 0
+	telemetryBatches = 0
+	enqueueLatencyTotal = 0.0
+	enqueueLatencyMax = 0.0
+	
+	
+	# Properties
+	@property
+	def Running(self):
+		return (self.thread is not None) and self.thread.is_alive()
+	
+	@property
+	def Registry(self):
+		return self.registry
+	
+	@property
+	def FramesReceived(self):
+		return self.framesReceived
+	
+	@property
+	def DecodeErrors(self):
+		return self.decodeErrors
+	
+	@property
+	def TriggersForwarded(self):
+		return self.triggersForwarded
+	
+	@property
+	def TriggersHeld(self):
+		return len(self.heldTriggers)
+	
+	@property
+	def TelemetryBatches(self):
+		return self.telemetryBatches
+	
+	@property
+	def AverageEnqueueLatency(self):
+		'''
+		Average seconds from a trigger packet being taken from the UART to its cloud call being queued
+		'''
+		if self.triggersForwarded <= 0:
+			return None
+		return self.enqueueLatencyTotal / self.triggersForwarded
+	
+	@property
+	def MaxEnqueueLatency(self):
+		return self.enqueueLatencyMax
+	
+	
+	# Constructor
+	def __init__(self, uart, flow, dispatcher, sendTelemetry, triggerURL:str, decoder=None, registry=None, aggregator=None, tracer=None):
+		'''
+		@uart: an open UART (its reader thread is started if it isn't running)
+		@flow: the FlowEngine whose triggers are forwarded
+		@dispatcher: the OutboundDispatcher cloud calls are made on
+		@sendTelemetry: function(dict) that sends telemetry to IoT Central (e.g. IoTCClient.send_telemetry)
+		@triggerURL: the Azure Trigger Function's URL
+		@decoder: the PacketDecoder to use. If None, a validating one is created.
+		@registry: a NodeRegistry used to drop replayed packets, or None
+		@aggregator: a TelemetryAggregator fed with every packet, or None
+		@tracer: a LatencyTracer that opens a trace for every trigger and sends its ID with the trigger ("TRID"), or None
+		'''
+		self.uart = uart
+		self.flow = flow
+		self.dispatcher = dispatcher
+		self.sendTelemetry = sendTelemetry
+		self.triggerURL = triggerURL
+		self.decoder = decoder if decoder is not None else PacketDecoder()
+		self.registry = registry
+		self.aggregator = aggregator
+		self.tracer = tracer
+		self.lock = threading.Lock()
+		self.pendingTelemetry = dict()
+		self.heldTriggers = deque()
+		return
+	
+	
+	
+	
+	# Methods
+	def Start(self):
+		'''
+		Returns: bool (True if the pipeline is running)
+		'''
+		if self.Running:
+			return True
+		if not self.uart.StartReaderThread():
+			return False
+		self.running = True
+		self.thread = threading.Thread(target=self._Run, name='Gateway pipeline', daemon=True)
+		self.thread.start()
+		return True
+	
+	def Stop(self):
+		self.running = False
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		return
+	
+	def HandleLine(self, line:str, received:float=None):
+		'''
+		Runs one received line through the pipeline (called by the pipeline thread for every line)
+		
+		@received: monotonic() time the line was received. If None, monotonic() is used.
+		
+		Returns: str (the name of the trigger that fired), or None
+		'''
+		if received is None:
+			received = monotonic()
+		self.framesReceived += 1
+		try:
+			packet = self.decoder.Decode(line)
+		except PacketError as e:
+			self.decodeErrors += 1
+			print('ERROR:', e, 'in JSON string:', line.strip())
+			return None
+		decoded = monotonic() if self.tracer is not None else None
+		
+		if self.registry is not None:
+			if self.registry.Observe(packet.SNID, packet.PID, UT=packet.UT, now=received) == PID_REPLAYED:
+				return None
+		
+		trigger = self.flow.Dispatch(packet)
+		if trigger is not None:
+			body = {'NAME': trigger}
+			if self.tracer is not None:
+				body['TRID'] = self.tracer.Begin(trigger, received, decoded).ID
+			self._ForwardTrigger(body, received)
+		
+		if self.aggregator is not None:
+			self.aggregator.Observe(packet, received)
+		
+		if packet.TL:
+			for device in packet.TL:
+				name = self.TelemetryNames.get(device.T)
+				if name is None:
+					continue
+				value = SensorValue(device)
+				if value is not None:
+					with self.lock:
+						self.pendingTelemetry[name] = value
+		return trigger
+	
+	def _ForwardTrigger(self, body:dict, received:float):
+		if self.heldTriggers or not self.dispatcher.post(self.triggerURL, json=body):
+			# Keep triggers in order behind any that are already held
+			self.heldTriggers.append((body, received))
+			return
+		self._CountForwarded(received)
+		return
+	
+	def _CountForwarded(self, received:float):
+		latency = monotonic() - received
+		self.triggersForwarded += 1
+		self.enqueueLatencyTotal += latency
+		self.enqueueLatencyMax = max(self.enqueueLatencyMax, latency)
+		return
+	
+	def _RetryHeldTriggers(self):
+		while self.heldTriggers:
+			body, received = self.heldTriggers[0]
+			if not self.dispatcher.post(self.triggerURL, json=body):
+				return
+			self.heldTriggers.popleft()
+			self._CountForwarded(received)
+		return
+	
+	def _FlushTelemetry(self, now:float):
+		if (now < self.nextTelemetryTime) or self.telemetryInFlight:
+			return
+		with self.lock:
+			if len(self.pendingTelemetry) <= 0:
+				return
+			batch = self.pendingTelemetry
+			self.pendingTelemetry = dict()
+		self.telemetryInFlight = True
+		if not self.dispatcher.submit(self._SendTelemetry, batch):
+			self.telemetryInFlight = False
+			with self.lock:
+				# Put the batch back, keeping any newer values
+				batch.update(self.pendingTelemetry)
+				self.pendingTelemetry = batch
+		self.nextTelemetryTime = now + self.TelemetryInterval
+		return
+	
+	def _SendTelemetry(self, batch:dict):
+		# Runs on a dispatcher worker
+		try:
+			self.sendTelemetry(batch)
+			self.telemetryBatches += 1
+		finally:
+			self.telemetryInFlight = False
+		return
+	
+	def _Run(self):
+		while self.running:
+			line = self.uart.ReadLine(timeout=self.PollInterval)
+			if line is not None:
+				self.HandleLine(line, self.uart.LastLineTime)
+			elif not self.uart.ReaderThreadRunning:
+				print('ERROR: Serial port closed, gateway pipeline stopped')
+				self.running = False
+				return
+			if self.heldTriggers:
+				self._RetryHeldTriggers()
+			self._FlushTelemetry(monotonic())
+		return
@@ -0,0 +1,287 @@
+# Trigger-to-actuation latency tracing
+#
+# A trace follows one trigger through the gateway: the frame is received by UART, decoded, causes a state transition, and (directly, or through the Azure Trigger Function and IoT Central) the resulting commands are written to the gateway board. Each stage is timestamped with monotonic(), and the time since the frame was received is recorded in a histogram per puzzle step and stage:
+#	decode	frame received -> packet decoded
+#	transition	frame received -> flow state changed
+#	command	frame received -> cloud command received back from IoT Central (cloud round trips only)
+#	write	frame received -> WriteLine of a resulting command returned
+#
+# Across the cloud, a trace is identified by its ID, sent as "TRID" with the trigger and copied into each command by the Azure function.
+
+import itertools
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from time import monotonic
+
+STAGES = ('decode', 'transition', 'command', 'write')
+
+class LatencyHistogram():
+	'''
+	HDR-style log-linear histogram of latencies in microseconds: values below 2**SubBucketBits get one bucket each, and each doubling above that is split into 2**(SubBucketBits - 1) buckets, so every value is kept to within 1 part in 2**(SubBucketBits - 1) (under 2% by default) with a few hundred counters from 1 us to minutes. Recording is O(1).
+	'''
+	# Public variables
+	SubBucketBits = 7
+	
+	# Private variables
+	counts = None	# array of the count in each bucket
+	count = 0
+	total = 0	# Sum of the recorded values (us)
+	min = None
+	max = None
+	
+	
+	# Properties
+	@property
+	def Count(self):
+		return self.count
+	
+	@property
+	def Min(self):
+		'''
+		Returns: float (seconds), or None (if nothing has been recorded)
+		'''
+		return self.min / 1e6 if self.min is not None else None
+	
+	@property
+	def Max(self):
+		return self.max / 1e6 if self.max is not None else None
+	
+	@property
+	def Mean(self):
+		return self.total / self.count / 1e6 if self.count > 0 else None
+	
+	
+	# Constructor
+	def __init__(self):
+		self.counts = array('q')
+		return
+	
+	
+	
+	
+	# Methods
+	def _Index(self, value:int):
+		if value < (1 << self.SubBucketBits):
+			return value
+		shift = value.bit_length() - self.SubBucketBits
+		return (shift << (self.SubBucketBits - 1)) + (value >> shift)
+	
+	def _Bounds(self, index:int):
+		'''
+		Returns: tuple (the lowest and highest value in a bucket, in us)
+		'''
+		if index < (1 << self.SubBucketBits):
+			return index, index
+		shift = (index >> (self.SubBucketBits - 1)) - 1
+		m = index - (shift << (self.SubBucketBits - 1))
+		return m << shift, ((m + 1) << shift) - 1
+	
+	def Record(self, seconds:float):
+		value = max(0, int(seconds * 1e6))
+		index = self._Index(value)
+		if index >= len(self.counts):
+			self.counts.extend([0] * (index + 1 - len(self.counts)))
+		self.counts[index] += 1
+		self.count += 1
+		self.total += value
+		if (self.min is None) or (value < self.min):
+			self.min = value
+		if (self.max is None) or (value > self.max):
+			self.max = value
+		return
+	
+	def Merge(self, other):
+		'''
+		Adds the values recorded in another LatencyHistogram
+		'''
+		if len(other.counts) > len(self.counts):
+			self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+		for index, c in enumerate(other.counts):
+			self.counts[index] += c
+		self.count += other.count
+		self.total += other.total
+		if other.min is not None:
+			self.min = other.min if self.min is None else min(self.min, other.min)
+			self.max = other.max if self.max is None else max(self.max, other.max)
+		return
+	
+	def Percentile(self, percentile:float):
+		'''
+		@percentile: 0 to 100
+		
+		Returns: float (seconds, the highest value of the bucket the percentile falls in), or None (if nothing has been recorded)
+		'''
+		if self.count <= 0:
+			return None
+		target = max(1, int(self.count * percentile / 100.0 + 0.5))
+		seen = 0
+		for index, c in enumerate(self.counts):
+			seen += c
+			if seen >= target:
+				return min(self._Bounds(index)[1], self.max) / 1e6
+		return self.max / 1e6
+	
+	def Summary(self, percentiles=(50, 90, 99, 99.9)):
+		'''
+		Returns: dict (count, min, mean, max and the percentiles, in seconds)
+		'''
+		summary = {'count': self.count, 'min': self.Min, 'mean': self.Mean, 'max': self.Max}
+		for p in percentiles:
+			summary['p' + ('%g' % p)] = self.Percentile(p)
+		return summary
+	
+	def Distribution(self):
+		'''
+		Returns: list[tuple] (value in seconds, percentile, count up to it) for every non-empty bucket, as in an HDR histogram percentile distribution
+		'''
+		rows = []
+		seen = 0
+		for index, c in enumerate(self.counts):
+			if c <= 0:
+				continue
+			seen += c
+			rows.append((self._Bounds(index)[1] / 1e6, 100.0 * seen / self.count, seen))
+		return rows
+
+class Trace():
+	'''
+	The timestamps of one trigger, from the frame that caused it to the commands it sent
+	'''
+	__slots__ = ('ID', 'Step', 'Received', 'Decoded', 'Transitioned', 'CommandsReceived', 'Writes', 'tracer')
+	
+	def __init__(self, tracer, ID:str, step:str, received:float, decoded:float, transitioned:float):
+		self.tracer = tracer
+		self.ID = ID
+		self.Step = step	# The trigger's name
+		self.Received = received
+		self.Decoded = decoded
+		self.Transitioned = transitioned
+		self.CommandsReceived = 0
+		self.Writes = 0
+		return
+	
+	def CommandReceived(self, now:float=None):
+		'''
+		Marks a command of this trigger coming back from the cloud
+		'''
+		self.tracer._Mark(self, 'command', now)
+		return
+	
+	def Written(self, now:float=None):
+		'''
+		Marks a command of this trigger written to the gateway board (e.g. as a TxScheduler onSent callback)
+		'''
+		self.tracer._Mark(self, 'write', now)
+		return
+
+class LatencyTracer():
+	'''
+	Opens a Trace for every trigger and keeps the latency histograms of each puzzle step. Traces are kept (by ID, for commands coming back from the cloud) until MaxTraces newer ones have been opened or they are TraceTimeout old.
+	'''
+	# Public variables
+	MaxTraces = 256
+	TraceTimeout = 60.0	# Seconds a trace waits for its commands
+	
+	# Private variables
+	traces = None	# OrderedDict of trace ID -> Trace, oldest first
+	histograms = None	# dict of (step, stage) -> LatencyHistogram
+	lock = None
+	prefix = None
+	counter = None
+	
+	
+	# Constructor
+	def __init__(self):
+		self.traces = OrderedDict()
+		self.histograms = dict()
+		self.lock = threading.Lock()
+		self.prefix = '%x-' % (os.getpid() & 0xFFFF)
+		self.counter = itertools.count(1)
+		return
+	
+	
+	
+	
+	# Methods
+	def Begin(self, step:str, received:float, decoded:float=None, transitioned:float=None):
+		'''
+		Opens the trace of a trigger that fired
+		
+		@step: the trigger's name
+		@received: monotonic() time the frame that caused it was received (e.g. UART.LastLineTime)
+		@decoded: monotonic() time it was decoded
+		@transitioned: monotonic() time the flow changed state. If None, monotonic() is used.
+		
+		Returns: Trace
+		'''
+		if transitioned is None:
+			transitioned = monotonic()
+		trace = Trace(self, self.prefix + str(next(self.counter)), step, received, decoded, transitioned)
+		with self.lock:
+			if decoded is not None:
+				self._Record(step, 'decode', decoded - received)
+			self._Record(step, 'transition', transitioned - received)
+			self.traces[trace.ID] = trace
+			while (len(self.traces) > self.MaxTraces) or (transitioned - next(iter(self.traces.values())).Transitioned > self.TraceTimeout):
+				self.traces.popitem(last=False)
+		return trace
+	
+	def Get(self, ID:str):
+		'''
+		Returns: Trace (the open trace with this ID, e.g. a command's TRID), or None
+		'''
+		if ID is None:
+			return None
+		with self.lock:
+			return self.traces.get(ID)
+	
+	def Histogram(self, step:str, stage:str):
+		'''
+		Returns: LatencyHistogram, or None (if nothing has been recorded for the step and stage)
+		'''
+		return self.histograms.get((step, stage))
+	
+	def Summary(self):
+		'''
+		Returns: dict (step -> stage -> LatencyHistogram.Summary())
+		'''
+		with self.lock:
+			summary = dict()
+			for (step, stage), histogram in self.histograms.items():
+				summary.setdefault(step, dict())[stage] = histogram.Summary()
+			return summary
+	
+	def Report(self):
+		'''
+		Returns: str (a table of each step's latencies in milliseconds)
+		'''
+		lines = ['%-16s %-10s %7s %9s %9s %9s %9s %9s' % ('step', 'stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms', 'max ms')]
+		for step, stages in sorted(self.Summary().items()):
+			for stage in STAGES:
+				s = stages.get(stage)
+				if s is None:
+					continue
+				lines.append('%-16s %-10s %7d %9.2f %9.2f %9.2f %9.2f %9.2f' % (step, stage, s['count'], s['p50'] * 1e3, s['p90'] * 1e3, s['p99'] * 1e3, s['p99.9'] * 1e3, s['max'] * 1e3))
+		return '\n'.join(lines)
+	
+	def _Record(self, step:str, stage:str, seconds:float):
+		# Call with the lock held
+		histogram = self.histograms.get((step, stage))
+		if histogram is None:
+			histogram = LatencyHistogram()
+			self.histograms[(step, stage)] = histogram
+		histogram.Record(seconds)
+		return
+	
+	def _Mark(self, trace, stage:str, now:float=None):
+		if now is None:
+			now = monotonic()
+		with self.lock:
+			if stage == 'command':
+				trace.CommandsReceived += 1
+			else:
+				trace.Writes += 1
+			self._Record(trace.Step, stage, now - trace.Received)
+		return
@@ -0,0 +1,349 @@
+# Metrics of the UART and gateway internals, served for Prometheus
+#
+# Nothing is measured when a scrape comes in: UART, RoomGateway, NodeRegistry, TxScheduler, ReliableDelivery and GatewayPipeline keep plain counters as they go (an integer add per byte batch, line or packet), and a scrape only reads them and formats them in the Prometheus text format. So metrics can be left on in production at no cost between scrapes.
+#
+#	registry = MetricsRegistry()
+#	registry.Add(CollectUART, uart, room='Library')
+#	registry.Add(CollectRoom, room)
+#	server = MetricsServer(registry)
+#	server.Start()	# http://127.0.0.1:9838/metrics
+#
+# Counters only go up, so packet rates come from PromQL, e.g. rate(escape_room_node_packets_total[1m]); escape_room_node_packet_rate is the gateway's own moving average, for when there is no Prometheus to ask.
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _EscapeLabel(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _FormatValue(value):
+	if (value is True) or (value is False):
+		return '1' if value else '0'
+	if type(value) is int:
+		return str(value)
+	value = float(value)
+	if value != value:
+		return 'NaN'
+	if value in (float('inf'), float('-inf')):
+		return '+Inf' if value > 0 else '-Inf'
+	return repr(value)
+
+class MetricFamily():
+	'''
+	A metric's name, type and help, and its samples (one per set of labels)
+	'''
+	__slots__ = ('Name', 'Type', 'Help', 'Samples')
+	
+	def __init__(self, name:str, type:str, help:str):
+		self.Name = name
+		self.Type = type	# 'counter' or 'gauge'
+		self.Help = help
+		self.Samples = []	# list of (labels dict, value)
+		return
+	
+	def Add(self, value, labels:dict=None):
+		'''
+		Adds a sample. Samples whose value is None are skipped.
+		'''
+		if value is not None:
+			self.Samples.append((labels or {}, value))
+		return
+
+class Families():
+	'''
+	The metric families of one scrape, by name, in the order they were first used
+	'''
+	def __init__(self, prefix:str=''):
+		self.prefix = prefix
+		self.families = dict()
+		return
+	
+	def _Get(self, name:str, type:str, help:str):
+		name = self.prefix + name
+		family = self.families.get(name)
+		if family is None:
+			family = MetricFamily(name, type, help)
+			self.families[name] = family
+		return family
+	
+	def Counter(self, name:str, help:str):
+		return self._Get(name, 'counter', help)
+	
+	def Gauge(self, name:str, help:str):
+		return self._Get(name, 'gauge', help)
+	
+	def List(self):
+		return [f for f in self.families.values() if f.Samples]
+
+class MetricsRegistry():
+	'''
+	The collectors whose metrics are served. A collector is a function(Families, *args, labels) called on every scrape that adds samples, e.g. CollectUART.
+	'''
+	# Public variables
+	Prefix = 'escape_room_'	# Prepended to every metric name
+	
+	# Private variables
+	collectors = None	# list of (function, args, labels)
+	lock = None
+	
+	
+	# Constructor
+	def __init__(self):
+		self.collectors = []
+		self.lock = threading.Lock()
+		return
+	
+	
+	
+	
+	# Methods
+	def Add(self, collector, *args, **labels):
+		'''
+		Adds a collector
+		
+		@collector: function(families, *args, labels), e.g. CollectUART
+		@args: passed to the collector, e.g. the UART
+		@labels: labels added to every sample of the collector, e.g. room='Library'
+		'''
+		with self.lock:
+			self.collectors.append((collector, args, labels))
+		return
+	
+	def Remove(self, *args):
+		'''
+		Removes the collectors that were added with these arguments (e.g. a UART that has been closed for good)
+		'''
+		with self.lock:
+			self.collectors = [c for c in self.collectors if c[1] != args]
+		return
+	
+	def Collect(self):
+		'''
+		Returns: list[MetricFamily] (every collector's samples, with the samples of each metric name together)
+		'''
+		families = Families(self.Prefix)
+		with self.lock:
+			collectors = list(self.collectors)
+		for collector, args, labels in collectors:
+			try:
+				collector(families, *args, labels)
+			except Exception as e:
+				# One broken collector must not take the whole endpoint down
+				print('ERROR: Metrics collector', collector.__name__, 'failed:', e)
+				families.Gauge('collector_errors', 'Collectors that raised an exception during this scrape').Add(1, {'collector': collector.__name__})
+		return families.List()
+	
+	def Render(self):
+		'''
+		Returns: str (every metric in the Prometheus text exposition format)
+		'''
+		lines = []
+		for family in self.Collect():
+			lines.append('# HELP ' + family.Name + ' ' + family.Help)
+			lines.append('# TYPE ' + family.Name + ' ' + family.Type)
+			for labels, value in family.Samples:
+				if labels:
+					name = family.Name + '{' + ','.join(k + '="' + _EscapeLabel(v) + '"' for k, v in labels.items()) + '}'
+				else:
+					name = family.Name
+				lines.append(name + ' ' + _FormatValue(value))
+		return '\n'.join(lines) + '\n'
+
+def CollectUART(families, uart, labels:dict):
+	'''
+	Byte and line counters, read timeouts, port failures and buffer levels of a UART
+	'''
+	families.Counter('uart_received_bytes_total', 'Bytes received from the serial port').Add(uart.BytesReceived, labels)
+	families.Counter('uart_sent_bytes_total', 'Bytes written to the serial port').Add(uart.BytesSent, labels)
+	families.Counter('uart_received_lines_total', 'Lines read from the serial port').Add(uart.LinesReceived, labels)
+	families.Counter('uart_sent_lines_total', 'Lines written to the serial port').Add(uart.LinesSent, labels)
+	families.Counter('uart_read_timeouts_total', 'Reads that waited the whole timeout for a byte').Add(uart.ReadTimeouts, labels)
+	families.Counter('uart_serial_errors_total', 'Times the serial port failed with a SerialException and was closed').Add(uart.SerialErrors, labels)
+	families.Counter('uart_line_queue_overflows_total', 'Lines dropped because the reader thread queue was full').Add(uart.QueueOverflowCount, labels)
+	families.Gauge('uart_open', 'Whether the serial port is open').Add(uart.IsOpen, labels)
+	families.Gauge('uart_read_buffer_bytes', 'Unread bytes in the read buffer').Add(uart.BytesInReadBuffer, labels)
+	families.Gauge('uart_read_buffer_high_water_bytes', 'Most unread bytes the read buffer has held').Add(uart.ReadBufferHighWater, labels)
+	families.Gauge('uart_line_queue_depth', 'Lines waiting in the reader thread queue').Add(uart.QueueDepth, labels)
+	return
+
+def CollectRegistry(families, registry, labels:dict, now:float=None):
+	'''
+	Per-node packet counters, packet ID gaps, packet rate and link quality of a NodeRegistry
+	'''
+	if now is None:
+		now = monotonic()
+	packets = families.Counter('node_packets_total', 'Packets received from the end node')
+	missed = families.Counter('node_missed_packets_total', 'Packets skipped in the end node\'s packet IDs')
+	gaps = families.Counter('node_pid_gaps_total', 'Times packets were skipped in the end node\'s packet IDs')
+	replayed = families.Counter('node_replayed_packets_total', 'Packets from the end node whose packet ID had already been received')
+	rate = families.Gauge('node_packet_rate', 'Moving average of the packets per second received from the end node')
+	quality = families.Gauge('node_link_quality', 'Moving average of the fraction of the end node\'s packets that arrived')
+	age = families.Gauge('node_last_seen_seconds', 'Seconds since the last packet from the end node')
+	for record in list(registry):
+		nodeLabels = dict(labels, node=record.ID, type=record.T)
+		packets.Add(record.Received, nodeLabels)
+		missed.Add(record.Missed, nodeLabels)
+		gaps.Add(record.Gaps, nodeLabels)
+		replayed.Add(record.Replayed, nodeLabels)
+		rate.Add(record.Rate, nodeLabels)
+		quality.Add(record.LinkQuality, nodeLabels)
+		if record.LastSeen is not None:
+			age.Add(now - record.LastSeen, nodeLabels)
+	return
+
+def CollectTx(families, tx, labels:dict):
+	'''
+	Lines sent, skipped, merged and waiting in a TxScheduler
+	'''
+	families.Counter('tx_sent_lines_total', 'Lines written by the TX scheduler').Add(tx.Sent, labels)
+	families.Counter('tx_skipped_lines_total', 'Lines not written because their function returned None').Add(tx.Skipped, labels)
+	families.Counter('tx_coalesced_lines_total', 'Lines replaced by a newer line for the same key before being sent').Add(tx.Coalesced, labels)
+	families.Gauge('tx_pending_lines', 'Lines waiting in the TX scheduler').Add(tx.Pending, labels)
+	families.Gauge('tx_max_latency_seconds', 'Longest time a line waited in the TX scheduler').Add(tx.MaxLatency, labels)
+	return
+
+def CollectDelivery(families, delivery, labels:dict):
+	'''
+	Command delivery counters of a ReliableDelivery
+	'''
+	families.Counter('commands_delivered_total', 'Commands confirmed by their end node').Add(delivery.Delivered, labels)
+	families.Counter('commands_retransmitted_total', 'Command retransmissions').Add(delivery.Retransmits, labels)
+	families.Counter('commands_failed_total', 'Commands that were never confirmed').Add(delivery.Failed, labels)
+	families.Gauge('commands_pending', 'Commands waiting to be confirmed').Add(delivery.Pending, labels)
+	return
+
+def CollectRoom(families, room, labels:dict):
+	'''
+	Frame counters and flow state of a RoomGateway, with its registry and delivery
+	'''
+	labels = dict(labels, room=room.Name)
+	families.Counter('frames_total', 'Lines handled by the gateway').Add(room.FramesReceived, labels)
+	families.Counter('decode_errors_total', 'Lines that were not a valid packet').Add(room.DecodeErrors, labels)
+	families.Counter('unknown_node_packets_total', 'Packets from nodes that are not registered').Add(room.UnknownNodes, labels)
+	families.Counter('replayed_packets_total', 'Packets dropped because their packet ID had already been received').Add(room.Replayed, labels)
+	families.Gauge('room_complete', 'Whether the room has been escaped').Add(room.Complete, labels)
+	CollectRegistry(families, room.Registry, labels)
+	if room.Delivery is not None:
+		CollectDelivery(families, room.Delivery, labels)
+	return
+
+def CollectPipeline(families, pipeline, labels:dict):
+	'''
+	Frame, trigger and telemetry counters of a GatewayPipeline, with its registry
+	'''
+	families.Counter('frames_total', 'Lines handled by the gateway').Add(pipeline.FramesReceived, labels)
+	families.Counter('decode_errors_total', 'Lines that were not a valid packet').Add(pipeline.DecodeErrors, labels)
+	families.Counter('triggers_forwarded_total', 'Triggers posted to the Azure Trigger Function').Add(pipeline.TriggersForwarded, labels)
+	families.Counter('telemetry_batches_total', 'Telemetry batches sent to IoT Central').Add(pipeline.TelemetryBatches, labels)
+	families.Gauge('triggers_held', 'Triggers waiting for room in the outbound dispatcher').Add(pipeline.TriggersHeld, labels)
+	families.Gauge('trigger_enqueue_max_seconds', 'Longest time from a trigger packet being read to its cloud call being queued').Add(pipeline.MaxEnqueueLatency, labels)
+	if pipeline.Registry is not None:
+		CollectRegistry(families, pipeline.Registry, labels)
+	return
+
+def CollectMultiRoom(families, gateway, labels:dict):
+	'''
+	Every room of a MultiRoomGateway, with its UART and TX scheduler. Rooms added or removed later are picked up on the next scrape.
+	'''
+	for roomPort in gateway.RoomPorts:
+		roomLabels = dict(labels, room=roomPort.Room.Name)
+		CollectUART(families, roomPort.UART, roomLabels)
+		CollectTx(families, roomPort.Tx, roomLabels)
+		CollectRoom(families, roomPort.Room, labels)
+	return
+
+class MetricsServer():
+	'''
+	Serves a MetricsRegistry at /metrics over HTTP from a daemon thread. It listens on localhost only by default; put a reverse proxy or an SSH tunnel in front of it to scrape from elsewhere.
+	'''
+	# Public variables
+	Host = '127.0.0.1'
+	Port = 9838
+	
+	# Private variables
+	registry = None
+	server = None
+	thread = None
+	
+	
+	# Properties
+	@property
+	def Running(self):
+		return (self.thread is not None) and self.thread.is_alive()
+	
+	@property
+	def Address(self):
+		'''
+		Returns: tuple (the host and port being listened on, e.g. when Port was 0), or None
+		'''
+		if self.server is None:
+			return None
+		return self.server.server_address[:2]
+	
+	
+	# Constructor
+	def __init__(self, registry, host:str=None, port:int=None):
+		'''
+		@registry: the MetricsRegistry to serve
+		@host: the address to listen on. If None, Host is used.
+		@port: the TCP port to listen on (0 for any free port). If None, Port is used.
+		'''
+		self.registry = registry
+		if host is not None:
+			self.Host = host
+		if port is not None:
+			self.Port = port
+		return
+	
+	
+	
+	
+	# Methods
+	def Start(self):
+		'''
+		Returns: bool (True if the server is listening)
+		'''
+		if self.Running:
+			return True
+		registry = self.registry
+		
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+					self.send_error(404)
+					return
+				body = registry.Render().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', CONTENT_TYPE)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+				return
+			
+			def log_message(self, format, *args):
+				# Scrapes are regular, don't print every one
+				return
+		
+		try:
+			self.server = ThreadingHTTPServer((self.Host, self.Port), Handler)
+		except OSError as e:
+			print('ERROR: Could not serve metrics on', str(self.Host) + ':' + str(self.Port) + ':', e)
+			self.server = None
+			return False
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target=self.server.serve_forever, name='Metrics server', daemon=True)
+		self.thread.start()
+		return True
+	
+	def Stop(self):
+		if self.server is None:
+			return
+		self.server.shutdown()
+		self.server.server_close()
+		self.thread.join()
+		self.server = None
+		self.thread = None
+		return
@@ -0,0 +1,247 @@
+# Serves several escape rooms, each with its own gateway board on its own serial port, from one thread
+#
+# The serial ports are multiplexed with selectors (epoll on Linux): the loop sleeps until a port has bytes or a timer is due, reads only what is waiting, and hands each complete line to that room's RoomGateway. Each room has its own flow, node registry, TX scheduler and acknowledged delivery.
+#
+# Rooms are listed in a JSON file:
+#	[{"name": "Library", "port": "/dev/ttyACM0", "flow": "flows/demo_flow.json"}, ...]
+# "port" may also be a USB rule ({"vid": 6991, "pid": 8527, "serialNumber": "..."}), and "flow" is relative to the file. An optional "record" names a file the room's serial traffic is recorded to (see session_log.py).
+#
+#	python multi_room_gateway.py rooms.json
+#
+# Set ESCAPE_ROOM_METRICS_PORT to serve every room's metrics for Prometheus on that port (see metrics.py).
+
+import json
+import os
+import selectors
+import sys
+from time import monotonic
+from UART import UART
+from flow_engine import FlowEngine, LoadFlow
+from tx_scheduler import TxScheduler
+from reliable_delivery import ReliableDelivery
+from room_gateway import RoomGateway, RegistryFromFlow
+from session_log import SessionRecorder
+from metrics import MetricsRegistry, MetricsServer, CollectMultiRoom
+
+class RoomPort():
+	'''
+	A room's gateway logic and the serial port it is served on
+	'''
+	__slots__ = ('Room', 'UART', 'Tx', 'FileDescriptor')
+	
+	def __init__(self, room, uart, tx):
+		self.Room = room
+		self.UART = uart
+		self.Tx = tx
+		self.FileDescriptor = uart.FileDescriptor
+		return
+
+class MultiRoomGateway():
+	'''
+	Event loop for N rooms. Every port is served fairly: a readable port has at most MaxLinesPerTurn lines handled before the other ready ports get their turn, and any lines left over are handled on the next turn without waiting for new bytes.
+	'''
+	# Public variables
+	MaxLinesPerTurn = 16	# Lines handled from one port before moving on to the next
+	PollInterval = 0.1	# Longest time the loop sleeps before resending unconfirmed commands
+	TxRate = 2.0	# Lines per second written to each gateway board
+	
+	# Private variables
+	selector = None
+	rooms = None	# dict of file descriptor -> RoomPort
+	backlog = None	# list of RoomPorts with lines left in their read buffers
+	running = False
+	
+	
+	# Properties
+	@property
+	def Rooms(self):
+		return [r.Room for r in self.rooms.values()]
+	
+	@property
+	def RoomPorts(self):
+		return list(self.rooms.values())
+	
+	
+	# Constructor
+	def __init__(self):
+		self.selector = selectors.DefaultSelector()
+		self.rooms = dict()
+		self.backlog = []
+		return
+	
+	
+	
+	
+	# Methods
+	def AddRoom(self, name:str, port, flowDefinition:dict, baudrate:int=115200, verbose:bool=False, record:str=None, portTimeout:float=None):
+		'''
+		Opens a room's gateway board and sets up its gateway logic
+		
+		@name: the room's name
+		@port: the gateway board's serial port, or a USB rule (see ResolvePort)
+		@flowDefinition: the room's flow definition (see LoadFlow)
+		@record: a session file to record the room's serial traffic to. If None, nothing is recorded.
+		@portTimeout: seconds to wait for a port matching a USB rule. If None, waits forever.
+		
+		Returns: RoomGateway, or None (if no port matched, or the port could not be opened or can't be multiplexed)
+		'''
+		rule = port
+		port = ResolvePort(rule, timeout=portTimeout)
+		if port is None:
+			print('[' + name + '] ERROR: No free serial port matches', rule)
+			return None
+		uart = UART()
+		if uart.Open(port, baudrate=baudrate) is not True:
+			print('[' + name + '] ERROR: Failed to open serial port', port)
+			return None
+		if record is not None:
+			uart.Recorder = SessionRecorder(record)
+		flow = FlowEngine(flowDefinition)
+		registry = RegistryFromFlow(flow)
+		tx = TxScheduler(uart, rate=self.TxRate, autostart=False)
+		room = RoomGateway(name, flow, registry, ReliableDelivery(tx, registry), verbose=verbose)
+		if self.AddRoomPort(RoomPort(room, uart, tx)) is False:
+			uart.Close()
+			if uart.Recorder is not None:
+				uart.Recorder.Close()
+			return None
+		return room
+	
+	def AddRoomPort(self, roomPort):
+		'''
+		Adds a room whose UART is already open. Its TxScheduler must not run its writer thread (autostart=False); the loop sends for it.
+		
+		Returns: bool (False if the port has no file descriptor to wait on, e.g. on Windows)
+		'''
+		if roomPort.FileDescriptor is None:
+			print('[' + roomPort.Room.Name + '] ERROR: Serial port can not be multiplexed')
+			return False
+		self.rooms[roomPort.FileDescriptor] = roomPort
+		self.selector.register(roomPort.FileDescriptor, selectors.EVENT_READ, roomPort)
+		return True
+	
+	def RemoveRoom(self, roomPort):
+		if self.rooms.pop(roomPort.FileDescriptor, None) is None:
+			return
+		self.selector.unregister(roomPort.FileDescriptor)
+		if roomPort.UART.IsOpen:
+			roomPort.UART.Close()
+		if roomPort.UART.Recorder is not None:
+			roomPort.UART.Recorder.Close()
+		return
+	
+	def Stop(self):
+		self.running = False
+		return
+	
+	def Close(self):
+		'''
+		Removes every room, closing its serial port and session recorder
+		'''
+		for roomPort in list(self.rooms.values()):
+			self.RemoveRoom(roomPort)
+		return
+	
+	def _ServePort(self, roomPort, now:float):
+		'''
+		Returns: bool (True if lines were left in the read buffer for the next turn), or None (if the port closed)
+		'''
+		lines = roomPort.UART.ReadAvailableLines(maxLines=self.MaxLinesPerTurn)
+		if lines is None:
+			return None
+		room = roomPort.Room
+		for line in lines:
+			room.HandleLine(line, now)
+		return len(lines) >= self.MaxLinesPerTurn
+	
+	def RunOnce(self, timeout:float=None):
+		'''
+		Waits for readable ports (or for timeout) and serves each one a turn, then runs every room's timers
+		
+		@timeout: the longest time to wait for a port. If None, PollInterval (or less if a TX scheduler is due sooner).
+		
+		Returns: int (the number of ports served)
+		'''
+		if timeout is None:
+			timeout = self.PollInterval
+			for roomPort in self.rooms.values():
+				wait = roomPort.Tx.Poll()
+				if wait is not None:
+					timeout = min(timeout, wait)
+		if self.backlog:
+			timeout = 0
+		
+		ready = dict()
+		for roomPort in self.backlog:
+			ready[roomPort.FileDescriptor] = roomPort
+		self.backlog = []
+		for key, events in self.selector.select(timeout):
+			ready[key.fd] = key.data
+		
+		now = monotonic()
+		for roomPort in ready.values():
+			leftOver = self._ServePort(roomPort, now)
+			if leftOver is None:
+				print('[' + roomPort.Room.Name + '] ERROR: Serial port closed')
+				self.RemoveRoom(roomPort)
+			elif leftOver:
+				self.backlog.append(roomPort)
+		
+		for roomPort in list(self.rooms.values()):
+			roomPort.Room.Poll(now)
+			roomPort.Tx.Poll()
+		return len(ready)
+	
+	def Run(self):
+		'''
+		Serves the rooms until Stop is called or every port has closed
+		'''
+		self.running = True
+		while self.running and self.rooms:
+			self.RunOnce()
+		return
+
+def ResolvePort(port, timeout:float=None):
+	'''
+	Turns a room's "port" into a serial port. A dict is a USB rule ("vid", "pid" and/or "serialNumber"), waited for with UART.WaitForPort.
+	
+	@timeout: seconds to wait for a port matching a rule. If None, waits forever.
+	
+	Returns: str (the port), or None (if no free port matched the rule within timeout)
+	'''
+	if type(port) is dict:
+		return UART().WaitForPort(timeout=timeout, **port)
+	return port
+
+def LoadRooms(path:str):
+	'''
+	Returns: list[dict] (the rooms in a JSON rooms file, with each "flow" loaded)
+	'''
+	with open(path, 'r') as f:
+		rooms = json.load(f)
+	base = os.path.dirname(os.path.abspath(path))
+	for room in rooms:
+		room['flow'] = LoadFlow(os.path.join(base, room['flow']))
+	return rooms
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print('Usage: python multi_room_gateway.py rooms.json')
+		exit(1)
+	gateway = MultiRoomGateway()
+	for config in LoadRooms(sys.argv[1]):
+		if type(config['port']) is dict:
+			print('[' + config['name'] + '] Waiting for the gateway serial port...')
+		gateway.AddRoom(config['name'], config['port'], config['flow'], baudrate=config.get('baudrate', 115200), verbose=config.get('verbose', False), record=config.get('record'))
+	print('Serving', len(gateway.Rooms), 'rooms')
+	if os.environ.get('ESCAPE_ROOM_METRICS_PORT'):
+		metrics = MetricsRegistry()
+		metrics.Add(CollectMultiRoom, gateway)
+		MetricsServer(metrics, port=int(os.environ['ESCAPE_ROOM_METRICS_PORT'])).Start()
+	try:
+		gateway.Run()
+	except KeyboardInterrupt:
+		pass
+	for room in gateway.Rooms:
+		print('[' + room.Name + ']', room.FramesReceived, 'frames,', room.DecodeErrors, 'decode errors, flow state', room.Flow.State, '(escaped)' if room.Complete else '')
+	gateway.Close()
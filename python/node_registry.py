@@ -0,0 +1,190 @@
+# Registry of the end nodes a gateway talks to
+
+from time import monotonic
+
+# Results of NodeRegistry.Observe
+PID_OK = 'ok'
+PID_MISSED = 'missed'	# Packets were skipped between this one and the previous one
+PID_REPLAYED = 'replayed'	# This packet ID has already been received
+PID_RESTARTED = 'restarted'	# The node's uptime went backwards, so it rebooted and started counting again
+
+class NodeRecord():
+	'''
+	What the gateway knows about one end node
+	'''
+	__slots__ = ('ID', 'T', 'PID', 'TxPID', 'UT', 'LastSeen', 'LinkQuality', 'Interval', 'Received', 'Missed', 'Gaps', 'Replayed')
+	
+	def __init__(self, ID:int, T:str, PID:int=0):
+		self.ID = ID
+		self.T = T
+		self.PID = PID	# The last packet ID received from the node
+		self.TxPID = PID	# The last packet ID sent to the node
+		self.UT = None	# The node's uptime in the last packet received from it
+		self.LastSeen = None	# monotonic() time of the last packet received from the node
+		self.LinkQuality = 1.0	# Moving average of the fraction of the node's packets that arrived
+		self.Interval = None	# Moving average of the seconds between the node's packets
+		self.Received = 0
+		self.Missed = 0	# Packets skipped in the node's packet IDs
+		self.Gaps = 0	# Times packets were skipped
+		self.Replayed = 0
+		return
+	
+	@property
+	def Rate(self):
+		'''
+		Returns: float (packets per second received from the node, averaged like LinkQuality), or None (until two packets have been received)
+		'''
+		if not self.Interval:
+			return None
+		return 1.0 / self.Interval
+	
+	def __repr__(self):
+		return 'NodeRecord(ID=%r, T=%r, PID=%r, TxPID=%r, LinkQuality=%.2f, Received=%d, Missed=%d, Replayed=%d)' % (self.ID, self.T, self.PID, self.TxPID, self.LinkQuality, self.Received, self.Missed, self.Replayed)
+
+class NodeRegistry():
+	'''
+	End nodes keyed by node ID (with an index by type), tracking packet IDs the same way EscapeRoomEndNode does on the device.
+	
+	An end node uses one packet ID counter for both directions: it sets its counter to the ID of every packet addressed to it, and increments it for every packet it sends. So the gateway jumps ahead by TxPIDStep when it sends, and a node that heard the gateway continues from the gateway's ID.
+	'''
+	# Public variables
+	TxPIDStep = 100	# How far ahead of the node's counter the gateway's packet IDs are
+	LinkQualityWeight = 0.1	# Weight of the newest packet in LinkQuality
+	
+	# Private variables
+	nodes = None	# dict of ID -> NodeRecord
+	nodesByType = None	# dict of T -> list of NodeRecord
+	heardHandlers = None	# list of function(NodeRecord)
+	
+	
+	# Constructor
+	def __init__(self):
+		self.nodes = dict()
+		self.nodesByType = dict()
+		self.heardHandlers = []
+		return
+	
+	
+	
+	
+	# Methods
+	def __len__(self):
+		return len(self.nodes)
+	
+	def __contains__(self, ID):
+		return ID in self.nodes
+	
+	def __iter__(self):
+		return iter(self.nodes.values())
+	
+	def Add(self, ID:int, T:str, PID:int=0):
+		'''
+		Registers an end node (replacing any node with the same ID)
+		
+		@ID: the node ID
+		@T: the node type (e.g. 'SO', 'LED', 'STEP')
+		@PID: the packet ID to start counting from
+		
+		Returns: NodeRecord
+		'''
+		self.Remove(ID)
+		record = NodeRecord(ID, T, PID)
+		self.nodes[ID] = record
+		self.nodesByType.setdefault(T, []).append(record)
+		return record
+	
+	def OnHeard(self, handler):
+		'''
+		Registers a function called when the first packet from a node is received (its packet IDs are known from then on)
+		
+		@handler: function(NodeRecord), called on the thread that calls Observe
+		'''
+		self.heardHandlers.append(handler)
+		return
+	
+	def Remove(self, ID:int):
+		record = self.nodes.pop(ID, None)
+		if record is not None:
+			self.nodesByType[record.T].remove(record)
+		return
+	
+	def Get(self, ID:int, T:str=None):
+		'''
+		Returns: NodeRecord, or None (if there is no node with this ID, or it is not of type T)
+		'''
+		record = self.nodes.get(ID)
+		if (record is None) or ((T is not None) and (record.T != T)):
+			return None
+		return record
+	
+	def GetByType(self, T:str):
+		'''
+		Returns: list[NodeRecord] (every node of type T)
+		'''
+		return list(self.nodesByType.get(T, []))
+	
+	def Observe(self, ID:int, PID:int, UT:int=None, now:float=None):
+		'''
+		Records a packet received from a node and checks its packet ID. The first packet from a node (or the first after it restarts) is taken as the new starting point.
+		
+		@ID: the packet's SNID
+		@PID: the packet's PID
+		@UT: the packet's UT (used to notice node restarts), or None
+		@now: the receive time (monotonic seconds). If None, monotonic() is used.
+		
+		Returns: str (PID_OK, PID_MISSED, PID_REPLAYED or PID_RESTARTED), or None (if the node is unknown)
+		'''
+		record = self.nodes.get(ID)
+		if record is None:
+			return None
+		if now is None:
+			now = monotonic()
+		
+		firstPacket = record.LastSeen is None
+		if firstPacket:
+			status = PID_OK
+			record.TxPID = max(record.TxPID, PID)
+		elif (UT is not None) and (record.UT is not None) and (UT < record.UT):
+			status = PID_RESTARTED
+			record.TxPID = PID
+		elif PID <= record.PID:
+			record.Replayed += 1
+			return PID_REPLAYED
+		else:
+			expected = record.PID + 1
+			if (record.TxPID > record.PID) and (PID > record.TxPID):
+				# The node heard the gateway's last packet and continued from its ID
+				expected = record.TxPID + 1
+			missed = max(0, PID - expected)
+			if missed > 0:
+				record.Missed += missed
+				record.Gaps += 1
+			record.LinkQuality += self.LinkQualityWeight * ((1.0 / (1 + missed)) - record.LinkQuality)
+			status = PID_MISSED if missed > 0 else PID_OK
+		
+		if record.LastSeen is not None:
+			interval = now - record.LastSeen
+			if record.Interval is None:
+				record.Interval = interval
+			else:
+				record.Interval += self.LinkQualityWeight * (interval - record.Interval)
+		record.PID = PID
+		record.UT = UT
+		record.LastSeen = now
+		record.Received += 1
+		if firstPacket:
+			for handler in self.heardHandlers:
+				handler(record)
+		return status
+	
+	def NextTxPID(self, ID:int):
+		'''
+		Reserves the packet ID for the next packet sent to a node
+		
+		Returns: int (the packet ID), or None (if the node is unknown)
+		'''
+		record = self.nodes.get(ID)
+		if record is None:
+			return None
+		record.TxPID = max(record.PID, record.TxPID) + self.TxPIDStep
+		return record.TxPID
@@ -0,0 +1,117 @@
+# Escape Room Project
+#
+# Outbound Dispatcher for Cloud Calls
+#
+# Description:
+# Runs outbound cloud calls (Azure Function triggers, IoT Central telemetry)
+# on a small fixed pool of worker threads sharing one keep-alive HTTP session.
+# Calls are fire-and-forget: submitting returns immediately, and when the
+# pool and its queue are full new calls are dropped and counted instead of
+# starting more threads or blocking the GUI.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class OutboundDispatcher:
+    """Bounded worker pool for outbound cloud calls.
+
+    workers : number of calls that run at once
+    max_pending : calls that may wait for a worker before new ones are dropped
+    timeout : requests timeout for post(), (connect, read) seconds
+    """
+
+    def __init__(self, workers=2, max_pending=16, timeout=(3.05, 10)):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbound")
+        self.lock = threading.Lock()
+        self.queued = 0  # submitted and not finished (waiting or running)
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_error = None
+
+    @property
+    def in_flight(self):
+        """Calls submitted and not yet finished."""
+        return self.queued
+
+    def submit(self, function, *args, **kwargs):
+        """Run function(*args, **kwargs) on a worker thread.
+
+        returns True if the call was queued, False if it was dropped because
+        the pool is saturated
+        """
+        with self.lock:
+            if self.queued >= self.workers + self.max_pending:
+                self.dropped += 1
+                return False
+            self.queued += 1
+        try:
+            self.executor.submit(self._run, function, args, kwargs)
+        except RuntimeError:
+            # The dispatcher has been shut down
+            with self.lock:
+                self.queued -= 1
+                self.dropped += 1
+            return False
+        return True
+
+    def post(self, url, json=None, **kwargs):
+        """POST to url on a worker thread, over the shared session and with the timeout.
+
+        A connection error, timeout or HTTP error status counts as a failed call.
+
+        returns True if the call was queued, False if it was dropped
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.submit(self._post, url, json, kwargs)
+
+    def _post(self, url, json, kwargs):
+        r = self.session.post(url, json=json, **kwargs)
+        r.raise_for_status()
+        return r
+
+    def _run(self, function, args, kwargs):
+        with self.lock:
+            self.running += 1
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+                self.last_error = e
+            print(f"Outbound call failed: {type(e).__name__}: {e}")
+        else:
+            with self.lock:
+                self.completed += 1
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.queued -= 1
+
+    def stats(self):
+        """Counters as a dictionary (in_flight, running, completed, failed, dropped)."""
+        with self.lock:
+            return {
+                "in_flight": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+    def shutdown(self, wait=True):
+        """Stop accepting calls, optionally waiting for the queued ones to finish."""
+        self.executor.shutdown(wait=wait)
+        self.session.close()
@@ -0,0 +1,284 @@
+# Binary encoding of the escape room message dictionary
+#
+# A packet is the same dictionary as the JSON form documented in EscapeRoomEndNode::ParseRxJsonStr:
+#	{"SNID": int, "TNID": int, "PID": int, "UT": int, "CMD": str, "AL": [...], "TL": [...], "ER": str}
+# with AL/TL entries of the form {"ID": int, "T": str, "C": str, "S": str, "ER": str}. CMD, AL, TL, ER, C, S and the entry ER are optional.
+#
+# Binary frame layout (version 1, little endian):
+#	header: MARKER (u8), VERSION (u8), body length (u16), flags (u8), SNID (u8), TNID (u8), PID (u32), UT (u32)
+#	body: CMD (str, if flagged), AL (list, if flagged), TL (list, if flagged), ER (str, if flagged)
+#	list: count (varint), then per entry: ID (zigzag varint), T (str), entry flags (u8), C/S/ER (str, if flagged)
+#	str: length (varint), then UTF-8 bytes
+#
+# JSON packets always start with '{', and binary frames always start with MARKER, so both encodings can share a link: the receiver looks at the first byte.
+#
+# The binary form saves bytes on the link, not CPU on the gateway. json.loads is written in C and DecodeBinary is pure Python, so decoding costs grow with the number of entries: benchmarks/bench_packet_codec.py measures binary decoding a little faster than JSON for one-entry packets, but slower for the 4-entry outlet state report (about 14 us vs 9.5 us). Use binary frames where airtime matters, not to speed up the gateway.
+
+import json
+import struct
+
+MARKER = 0xE5	# Not ASCII, so it can never be the first byte of a JSON packet
+VERSION = 1
+
+HEADER = struct.Struct('<BBHBBBII')
+
+# Packet flags
+FLAG_CMD = 0x01
+FLAG_AL = 0x02
+FLAG_TL = 0x04
+FLAG_ER = 0x08
+
+# Entry flags
+FLAG_ENTRY_C = 0x01
+FLAG_ENTRY_S = 0x02
+FLAG_ENTRY_ER = 0x04
+
+PACKET_KEYS = ('SNID', 'TNID', 'PID', 'UT', 'CMD', 'AL', 'TL', 'ER')
+ENTRY_KEYS = ('ID', 'T', 'C', 'S', 'ER')
+
+_JSON_SEPARATORS = (',', ':')
+
+
+def _IsInt(v):
+	return (type(v) == int)
+
+def _WriteVarint(out:bytearray, n:int):
+	while n >= 0x80:
+		out.append((n & 0x7F) | 0x80)
+		n >>= 7
+	out.append(n)
+	return
+
+def _ReadVarint(data, pos:int):
+	n = 0
+	shift = 0
+	while True:
+		if pos >= len(data):
+			raise ValueError('Truncated varint')
+		b = data[pos]
+		pos += 1
+		n |= (b & 0x7F) << shift
+		if b < 0x80:
+			return n, pos
+		shift += 7
+
+def _WriteStr(out:bytearray, s):
+	if type(s) != str:
+		raise ValueError('Expected a string, got ' + type(s).__name__)
+	b = s.encode('utf-8')
+	_WriteVarint(out, len(b))
+	out += b
+	return
+
+def _ReadStr(data, pos:int):
+	length, pos = _ReadVarint(data, pos)
+	if pos + length > len(data):
+		raise ValueError('Truncated string')
+	return str(data[pos:pos + length], 'utf-8'), pos + length
+
+def _WriteList(out:bytearray, entries):
+	if type(entries) != list:
+		raise ValueError('AL/TL must be a list')
+	_WriteVarint(out, len(entries))
+	for e in entries:
+		if type(e) != dict:
+			raise ValueError('AL/TL entries must be dictionaries')
+		for k in e:
+			if k not in ENTRY_KEYS:
+				raise ValueError('Entry key ' + repr(k) + ' has no binary encoding')
+		if ('ID' not in e) or (not _IsInt(e['ID'])) or (abs(e['ID']) >= (1 << 31)):
+			raise ValueError('Entry ID must be a 32-bit int')
+		if 'T' not in e:
+			raise ValueError('Entry T is required')
+		_WriteVarint(out, (e['ID'] << 1) ^ (e['ID'] >> 63))	# zigzag, so negative IDs stay short
+		_WriteStr(out, e['T'])
+		flags = 0
+		if 'C' in e:
+			flags |= FLAG_ENTRY_C
+		if 'S' in e:
+			flags |= FLAG_ENTRY_S
+		if 'ER' in e:
+			flags |= FLAG_ENTRY_ER
+		out.append(flags)
+		if flags & FLAG_ENTRY_C:
+			_WriteStr(out, e['C'])
+		if flags & FLAG_ENTRY_S:
+			_WriteStr(out, e['S'])
+		if flags & FLAG_ENTRY_ER:
+			_WriteStr(out, e['ER'])
+	return
+
+def _ReadList(data, pos:int):
+	count, pos = _ReadVarint(data, pos)
+	entries = []
+	for i in range(count):
+		zigzag, pos = _ReadVarint(data, pos)
+		e = {'ID': (zigzag >> 1) ^ -(zigzag & 1)}
+		e['T'], pos = _ReadStr(data, pos)
+		if pos >= len(data):
+			raise ValueError('Truncated entry')
+		flags = data[pos]
+		pos += 1
+		if flags & FLAG_ENTRY_C:
+			e['C'], pos = _ReadStr(data, pos)
+		if flags & FLAG_ENTRY_S:
+			e['S'], pos = _ReadStr(data, pos)
+		if flags & FLAG_ENTRY_ER:
+			e['ER'], pos = _ReadStr(data, pos)
+		entries.append(e)
+	return entries, pos
+
+def EncodeBinary(d:dict):
+	'''
+	Encodes a packet dictionary as a binary frame.
+	
+	@d: the packet. SNID and TNID must fit in a byte and PID and UT in 32 bits; anything else raises ValueError (send it as JSON instead).
+	
+	Returns: bytes (the binary frame)
+	'''
+	for k in d:
+		if k not in PACKET_KEYS:
+			raise ValueError('Packet key ' + repr(k) + ' has no binary encoding')
+	for k, bits in (('SNID', 8), ('TNID', 8), ('PID', 32), ('UT', 32)):
+		if (k not in d) or (not _IsInt(d[k])) or (d[k] < 0) or (d[k] >= (1 << bits)):
+			raise ValueError(k + ' must be an unsigned ' + str(bits) + '-bit int')
+	
+	flags = 0
+	body = bytearray()
+	if 'CMD' in d:
+		flags |= FLAG_CMD
+		_WriteStr(body, d['CMD'])
+	if 'AL' in d:
+		flags |= FLAG_AL
+		_WriteList(body, d['AL'])
+	if 'TL' in d:
+		flags |= FLAG_TL
+		_WriteList(body, d['TL'])
+	if 'ER' in d:
+		flags |= FLAG_ER
+		_WriteStr(body, d['ER'])
+	if len(body) > 0xFFFF:
+		raise ValueError('Packet body is too long for a binary frame')
+	
+	return HEADER.pack(MARKER, VERSION, len(body), flags, d['SNID'], d['TNID'], d['PID'], d['UT']) + body
+
+def DecodeBinary(data):
+	'''
+	Decodes a binary frame.
+	
+	@data: bytes, bytearray or memoryview holding exactly one frame
+	
+	Returns: dict (the packet, with keys in the same order the end nodes send them)
+	'''
+	if len(data) < HEADER.size:
+		raise ValueError('Truncated header')
+	marker, version, length, flags, SNID, TNID, PID, UT = HEADER.unpack_from(data, 0)
+	if marker != MARKER:
+		raise ValueError('Not a binary frame')
+	if version != VERSION:
+		raise ValueError('Unsupported binary frame version ' + str(version))
+	if HEADER.size + length != len(data):
+		raise ValueError('Frame length does not match header')
+	
+	d = {'SNID': SNID, 'TNID': TNID, 'PID': PID, 'UT': UT}
+	pos = HEADER.size
+	if flags & FLAG_CMD:
+		d['CMD'], pos = _ReadStr(data, pos)
+	if flags & FLAG_AL:
+		d['AL'], pos = _ReadList(data, pos)
+	if flags & FLAG_TL:
+		d['TL'], pos = _ReadList(data, pos)
+	if flags & FLAG_ER:
+		d['ER'], pos = _ReadStr(data, pos)
+	if pos != len(data):
+		raise ValueError('Trailing bytes after packet body')
+	return d
+
+def EncodeJson(d:dict):
+	'''
+	Returns: bytes (the packet in its compact JSON form, without a line ending)
+	'''
+	return json.dumps(d, separators=_JSON_SEPARATORS).encode('utf-8')
+
+def DecodeJson(data):
+	'''
+	Returns: dict (the packet)
+	'''
+	if type(data) == memoryview:
+		data = bytes(data)
+	return json.loads(data)
+
+def Encode(d:dict, binary:bool=False):
+	'''
+	Encodes a packet in either form.
+	
+	@binary: If true, returns a binary frame, otherwise compact JSON.
+	
+	Returns: bytes
+	'''
+	if binary:
+		return EncodeBinary(d)
+	return EncodeJson(d)
+
+def Decode(data):
+	'''
+	Decodes a packet in either form, telling them apart by the first byte.
+	
+	Returns: dict (the packet)
+	'''
+	if len(data) > 0 and data[0] == MARKER:
+		return DecodeBinary(data)
+	return DecodeJson(data)
+
+def IsBinary(data):
+	return len(data) > 0 and data[0] == MARKER
+
+def _Resync(uart):
+	# Drops the byte at the start of the read buffer and everything after it up to the next MARKER or '{', so a corrupt frame never swallows the frames after it
+	buffered = uart.PeekBytes()
+	if buffered is None:
+		return
+	ends = [i for i in (buffered.find(bytes([MARKER]), 1), buffered.find(b'{', 1)) if i > 0]
+	uart.ReadBytes(min(ends) if ends else len(buffered))
+	return
+
+def ReadFrame(uart):
+	'''
+	Reads the next packet frame from a UART where JSON lines and binary frames are mixed. Binary frames are read by the length in their header (they may contain newline bytes); anything else is read up to the line ending. If it takes longer than the timeout to read any byte from the serial port, returns None.
+	
+	A binary frame is decoded before it is removed from the read buffer (so decoding it again costs a second DecodeBinary). If its version is unknown or it doesn't decode (e.g. a corrupt length), or the rest of it doesn't arrive within the timeout, it is skipped up to the next MARKER or '{' and reading continues from there. Bytes that start neither form are skipped the same way.
+	
+	@uart: an open UART
+	
+	Returns: bytes (the frame, without the line ending for JSON), or None (if timeout elapsed)
+	'''
+	while True:
+		first = uart.PeekBytes(1)
+		if first is None:
+			return None
+		if first == b'{':
+			return uart.ReadBytesUntil(uart.NewlineRead.encode(uart.Encoding), stripTerminator=True)
+		if first[0] != MARKER:
+			_Resync(uart)
+			continue
+		
+		header = uart.PeekBytes(HEADER.size)
+		if header is None:
+			_Resync(uart)
+			continue
+		version = header[1]
+		if version != VERSION:
+			print('ERROR: Unsupported binary frame version', version, '- resyncing')
+			_Resync(uart)
+			continue
+		frame = uart.PeekBytes(HEADER.size + HEADER.unpack(header)[2])
+		if frame is None:
+			_Resync(uart)
+			continue
+		try:
+			DecodeBinary(frame)
+		except ValueError as e:
+			print('ERROR: Corrupt binary frame (' + str(e) + ') - resyncing')
+			_Resync(uart)
+			continue
+		return uart.ReadBytes(len(frame))
@@ -0,0 +1,141 @@
+# Decodes received packets into typed, validated objects
+#
+# The rules are the same ones EscapeRoomEndNode::ParseRxJsonStr applies on the end nodes: SNID, TNID, PID and UT are required integers (PID and UT unsigned), CMD and ER are strings, and every AL/TL entry needs an integer ID and a string T, with optional string C, S and ER.
+
+import json
+from collections import namedtuple
+import packet_codec
+
+Packet = namedtuple('Packet', ['SNID', 'TNID', 'PID', 'UT', 'CMD', 'AL', 'TL', 'ER'])	# AL and TL are tuples of Device, or None
+Device = namedtuple('Device', ['ID', 'T', 'C', 'S', 'ER'])	# An AL/TL entry
+
+# Field name -> (type name, required)
+MESSAGE_SCHEMA = {
+	'SNID': ('int', True),
+	'TNID': ('int', True),
+	'PID': ('uint', True),
+	'UT': ('uint', True),
+	'CMD': ('str', False),
+	'AL': ('list', False),
+	'TL': ('list', False),
+	'ER': ('str', False),
+}
+
+ENTRY_SCHEMA = {
+	'ID': ('int', True),
+	'T': ('str', True),
+	'C': ('str', False),
+	'S': ('str', False),
+	'ER': ('str', False),
+}
+
+# Type name -> expression that is true when v has the right type
+_TypeChecks = {
+	'int': 'type(v) is int',	# bool is not an int on the wire
+	'uint': '(type(v) is int) and (v >= 0)',
+	'str': 'type(v) is str',
+	'list': 'type(v) is list',
+}
+
+_MISSING = object()
+
+class PacketError(ValueError):
+	'''
+	Raised when a received packet does not follow the message dictionary. The message matches the end node's error strings (e.g. "No SNID", "PID invalid type").
+	'''
+	pass
+
+def CompileSchema(schema:dict, resultType, prefix:str='', entryConverters:dict=None, validate:bool=True):
+	'''
+	Generates a function that validates a dictionary against a schema and converts it to resultType in a single pass. The checks are turned into straight-line Python source once, so no schema lookups or per-field function calls are made per packet.
+	
+	@schema: field name -> (type name, required). The fields must be in the same order as resultType's fields.
+	@resultType: the namedtuple to build
+	@prefix: prepended to field names in error messages (e.g. "AD " for activation device entries)
+	@entryConverters: field name -> function used to convert each item of a list field
+	@validate: If false, the generated function only converts
+	
+	Returns: function(dict) -> resultType (raises PacketError if the dictionary is malformed)
+	'''
+	if entryConverters is None:
+		entryConverters = dict()
+	lines = ['def convert(d):']
+	if validate:
+		lines.append('\tif type(d) is not dict:')
+		lines.append('\t\traise PacketError(%r)' % ((prefix or 'Packet ') + 'not a dictionary'))
+	names = []
+	for i, (field, (typeName, required)) in enumerate(schema.items()):
+		name = 'f' + str(i)
+		names.append(name)
+		if required and not validate:
+			lines.append('\t%s = d[%r]' % (name, field))
+			continue
+		lines.append('\tv = d.get(%r, _MISSING)' % field)
+		lines.append('\tif v is _MISSING:')
+		if required:
+			lines.append('\t\traise PacketError(%r)' % ('No ' + prefix + field))
+		else:
+			lines.append('\t\tv = None')
+		if validate:
+			lines.append('\telif not (%s):' % _TypeChecks[typeName])
+			lines.append('\t\traise PacketError(%r)' % (prefix + field + ' invalid type'))
+		if field in entryConverters:
+			lines.append('\telse:')
+			lines.append('\t\tv = tuple([_convert_%s(e) for e in v])' % field)
+		lines.append('\t%s = v' % name)
+	lines.append('\treturn _result(%s)' % ', '.join(names))
+	namespace = {'PacketError': PacketError, '_MISSING': _MISSING, '_result': resultType}
+	for field, converter in entryConverters.items():
+		namespace['_convert_' + field] = converter
+	exec('\n'.join(lines), namespace)
+	return namespace['convert']
+
+class PacketDecoder():
+	'''
+	Decodes JSON lines (or binary frames from packet_codec) into Packet objects, validating them with checks compiled once when the decoder is created.
+	'''
+	# Private variables
+	trusted = False
+	convert = None
+	
+	
+	# Constructor
+	def __init__(self, trusted:bool=False, schema:dict=MESSAGE_SCHEMA, entrySchema:dict=ENTRY_SCHEMA):
+		'''
+		@trusted: If true, packets are converted without validation. Only use this on links where the sender is known to follow the message dictionary.
+		@schema: the packet fields
+		@entrySchema: the AL/TL entry fields
+		'''
+		self.trusted = trusted
+		validate = not trusted
+		convertAL = CompileSchema(entrySchema, Device, prefix='AD ', validate=validate)
+		convertTL = CompileSchema(entrySchema, Device, prefix='TD ', validate=validate)
+		self.convert = CompileSchema(schema, Packet, entryConverters={'AL': convertAL, 'TL': convertTL}, validate=validate)
+		return
+	
+	
+	# Methods
+	def Decode(self, data):
+		'''
+		Decodes one received packet.
+		
+		@data: str, bytes or memoryview. Either a JSON packet (the line ending may be included) or a binary frame.
+		
+		Returns: Packet (raises PacketError if the packet is malformed)
+		'''
+		try:
+			if type(data) is str:
+				d = json.loads(data)
+			else:
+				d = packet_codec.Decode(data)
+		except ValueError as e:
+			raise PacketError('Deserialization ' + str(e))
+		return self.convert(d)
+	
+	def FromDict(self, d:dict):
+		'''
+		Converts an already deserialized packet dictionary.
+		
+		Returns: Packet (raises PacketError if the packet is malformed)
+		'''
+		return self.convert(d)
@@ -0,0 +1,232 @@
+# Acknowledged delivery of activation commands to end nodes
+#
+# End nodes never acknowledge packets, but an AL entry without "S" asks a node to report that activation device's state in its next packet (see EscapeRoomEndNode::ParseRxJsonStr). So every command is sent as the new state followed by a state request for the same device, e.g.
+#	{"SNID":1,"TNID":4,"PID":301,"UT":1,"AL":[{"ID":1,"T":"SO","S":"1"},{"ID":1,"T":"SO"}]}
+# and it counts as delivered once the node reports that state in a packet sent after it took the command's packet ID.
+
+import json
+import threading
+from time import monotonic
+
+class Command():
+	'''
+	An activation command waiting to be delivered
+	'''
+	__slots__ = ('TNID', 'ID', 'T', 'S', 'PID', 'Submitted', 'LastSent', 'Deadline', 'Retries', 'Trace')
+	
+	def __init__(self, TNID:int, ID:int, T:str, S:str, trace=None):
+		self.TNID = TNID
+		self.ID = ID
+		self.T = T
+		self.S = S	# The state the activation device is being set to
+		self.PID = None	# The packet ID of the latest transmission
+		self.Submitted = monotonic()
+		self.LastSent = None	# monotonic() time of the latest transmission, or None while it waits in the TX queue
+		self.Deadline = None	# When the latest transmission is given up on
+		self.Retries = 0
+		self.Trace = trace	# The latency_trace.Trace of the trigger that sent it, or None
+		return
+	
+	def __repr__(self):
+		return 'Command(TNID=%r, ID=%r, T=%r, S=%r, PID=%r, Retries=%d)' % (self.TNID, self.ID, self.T, self.S, self.PID, self.Retries)
+
+class ReliableDelivery():
+	'''
+	Tracks outstanding activation commands by (TNID, PID) and retransmits the ones that are not confirmed, with exponential backoff, through a TxScheduler.
+	Call Observe with every received packet and Poll regularly (e.g. every time the read loop wakes up).
+	'''
+	# Public variables
+	SNID = 1	# The gateway's node ID
+	InitialTimeout = 1.0	# Seconds to wait for confirmation after the first transmission
+	BackoffFactor = 2.0	# How much longer each retry waits than the previous one
+	MaxTimeout = 8.0
+	MaxRetries = 4	# Retransmissions before a command is reported as failed
+	
+	# Private variables
+	tx = None
+	registry = None
+	lock = None
+	outstanding = None	# dict of (TNID, PID) -> Command, one for each transmission not yet confirmed
+	byDevice = None	# dict of (TNID, ID, T) -> Command
+	
+	delivered = 0
+	retransmits = 0
+	failed = 0
+	latencyTotal = 0.0
+	latencyMax = 0.0
+	
+	
+	# Properties
+	@property
+	def Pending(self):
+		return len(self.byDevice)
+	
+	@property
+	def Delivered(self):
+		return self.delivered
+	
+	@property
+	def Retransmits(self):
+		return self.retransmits
+	
+	@property
+	def Failed(self):
+		return self.failed
+	
+	@property
+	def AverageLatency(self):
+		'''
+		Average seconds from a command being sent to it being confirmed
+		'''
+		if self.delivered <= 0:
+			return None
+		return self.latencyTotal / self.delivered
+	
+	@property
+	def MaxLatency(self):
+		return self.latencyMax
+	
+	
+	# Constructor
+	def __init__(self, tx, registry, SNID:int=None):
+		'''
+		@tx: the TxScheduler commands are sent through
+		@registry: the NodeRegistry packet IDs are taken from
+		@SNID: the gateway's node ID. If None, SNID is used.
+		'''
+		self.tx = tx
+		self.registry = registry
+		if SNID is not None:
+			self.SNID = SNID
+		self.lock = threading.Lock()
+		self.outstanding = dict()
+		self.byDevice = dict()
+		return
+	
+	
+	
+	
+	# Methods
+	def Send(self, TNID:int, ID:int, T:str, S:str, trace=None):
+		'''
+		Sets the state of an activation device and keeps resending it until the node confirms it. A command for a device that still has one outstanding replaces it.
+		
+		@TNID: the end node's ID
+		@ID: the activation device's ID on the node
+		@T: the activation device's type (e.g. 'SO')
+		@S: the state to set
+		@trace: a latency_trace.Trace, marked written when the command is first written
+		
+		Returns: Command
+		'''
+		command = Command(TNID, ID, T, S, trace)
+		with self.lock:
+			previous = self.byDevice.get((TNID, ID, T))
+			if previous is not None:
+				self._Forget(previous)
+			self.byDevice[(TNID, ID, T)] = command
+		self._Transmit(command)
+		return command
+	
+	def Get(self, TNID:int, PID:int):
+		'''
+		Returns: Command (the outstanding command sent to node TNID with packet ID PID), or None
+		'''
+		with self.lock:
+			return self.outstanding.get((TNID, PID))
+	
+	def Observe(self, packet):
+		'''
+		Checks a received packet for activation device states that confirm outstanding commands.
+		
+		@packet: a Packet from PacketDecoder
+		
+		Returns: list[Command] (the commands confirmed by this packet)
+		'''
+		if not packet.AL:
+			return []
+		confirmed = []
+		now = monotonic()
+		with self.lock:
+			for device in packet.AL:
+				command = self.byDevice.get((packet.SNID, device.ID, device.T))
+				if (command is None) or (command.PID is None):
+					continue
+				if packet.PID <= command.PID:
+					# Sent before the node took the command's packet ID, so the state is stale
+					continue
+				if device.S != command.S:
+					continue
+				self._Forget(command)
+				latency = now - command.Submitted
+				self.delivered += 1
+				self.latencyTotal += latency
+				self.latencyMax = max(self.latencyMax, latency)
+				confirmed.append(command)
+		return confirmed
+	
+	def Poll(self, now:float=None):
+		'''
+		Retransmits commands whose confirmation is overdue, and gives up on those that have been retried MaxRetries times.
+		
+		@now: monotonic() time. If None, monotonic() is used.
+		
+		Returns: list[Command] (the commands given up on)
+		'''
+		if now is None:
+			now = monotonic()
+		retry = []
+		failed = []
+		with self.lock:
+			for command in list(self.byDevice.values()):
+				if (command.Deadline is None) or (now < command.Deadline):
+					continue
+				if command.Retries >= self.MaxRetries:
+					self._Forget(command)
+					self.failed += 1
+					failed.append(command)
+				else:
+					command.Retries += 1
+					command.Deadline = None	# Until the retransmission actually leaves the TX queue
+					retry.append(command)
+			self.retransmits += len(retry)
+		for command in retry:
+			self._Transmit(command)
+		return failed
+	
+	def _Forget(self, command):
+		# Call with the lock held
+		self.outstanding.pop((command.TNID, command.PID), None)
+		if self.byDevice.get((command.TNID, command.ID, command.T)) is command:
+			del self.byDevice[(command.TNID, command.ID, command.T)]
+		command.Deadline = None
+		return
+	
+	def _Transmit(self, command):
+		def Build():
+			# Runs on the TX scheduler's writer thread, so the packet ID and timeout start when the packet is actually sent
+			with self.lock:
+				if self.byDevice.get((command.TNID, command.ID, command.T)) is not command:
+					return None	# Confirmed or replaced while waiting in the queue
+				PID = self.registry.NextTxPID(command.TNID)
+				if PID is None:
+					return None
+				self.outstanding.pop((command.TNID, command.PID), None)
+				command.PID = PID
+				self.outstanding[(command.TNID, PID)] = command
+				command.LastSent = monotonic()
+				command.Deadline = command.LastSent + min(self.MaxTimeout, self.InitialTimeout * (self.BackoffFactor ** command.Retries))
+			d = {
+				'SNID': self.SNID,
+				'TNID': command.TNID,
+				'PID': PID,
+				'UT': 1,
+				'AL': [
+					{'ID': command.ID, 'T': command.T, 'S': command.S},
+					{'ID': command.ID, 'T': command.T}
+				]
+			}
+			return json.dumps(d, separators=(',', ':'))
+		onSent = command.Trace.Written if (command.Trace is not None) and (command.Retries == 0) else None
+		self.tx.Submit((command.TNID, command.ID), Build, node=command.TNID, onSent=onSent)
+		return
@@ -0,0 +1,202 @@
+# Gateway logic for one escape room
+#
+# Everything the gateway does with a received line, independent of how lines are read (a blocking loop, the UART reader thread or an event loop serving many rooms): decode it, check its packet ID, confirm outstanding commands and advance the puzzle flow.
+
+from time import monotonic
+from packet_decoder import PacketDecoder, PacketError
+from node_registry import NodeRegistry, PID_MISSED, PID_REPLAYED
+
+def RegistryFromFlow(flow, PIDs:dict=None, exclude=('server', 'app')):
+	'''
+	Registers the end nodes of a flow definition, using each node's name as its type
+	
+	@flow: the FlowEngine
+	@PIDs: node name -> packet ID to start counting from
+	@exclude: node names that are not serial end nodes
+	
+	Returns: NodeRegistry
+	'''
+	if PIDs is None:
+		PIDs = dict()
+	registry = NodeRegistry()
+	for name, ID in flow.NodeIDs.items():
+		if name not in exclude:
+			registry.Add(ID, name, PID=PIDs.get(name, 0))
+	return registry
+
+class RoomGateway():
+	'''
+	One escape room behind one gateway board. Call HandleLine with every received line and Poll regularly.
+	'''
+	# Public variables
+	Verbose = True	# Print every received line and flow step
+	DeviceTypes = None	# dict of TNID -> activation device type for SetState commands (default 'SO')
+	
+	# Private variables
+	name = None
+	flow = None
+	registry = None
+	delivery = None
+	decoder = None
+	tracer = None
+	frameTimes = None	# (received, decoded) times of the line being handled, while tracing
+	trace = None	# The Trace of the trigger whose commands are being sent
+	
+	framesReceived = 0
+	decodeErrors = 0
+	unknownNodes = 0
+	replayed = 0
+	
+	
+	# Properties
+	@property
+	def Name(self):
+		return self.name
+	
+	@property
+	def Flow(self):
+		return self.flow
+	
+	@property
+	def Registry(self):
+		return self.registry
+	
+	@property
+	def Delivery(self):
+		return self.delivery
+	
+	@property
+	def Complete(self):
+		return self.flow.Complete
+	
+	@property
+	def FramesReceived(self):
+		return self.framesReceived
+	
+	@property
+	def DecodeErrors(self):
+		return self.decodeErrors
+	
+	@property
+	def UnknownNodes(self):
+		return self.unknownNodes
+	
+	@property
+	def Replayed(self):
+		return self.replayed
+	
+	
+	# Constructor
+	def __init__(self, name:str, flow, registry, delivery=None, decoder=None, verbose:bool=None, tracer=None):
+		'''
+		@name: the room's name, used in messages
+		@flow: the room's FlowEngine
+		@registry: the room's NodeRegistry
+		@delivery: the room's ReliableDelivery. If given, the flow's SetState commands are sent through it.
+		@decoder: the PacketDecoder to use. If None, a validating one is created.
+		@verbose: If not None, overrides Verbose
+		@tracer: a LatencyTracer that traces every trigger to the writes of its commands, or None
+		'''
+		self.name = name
+		self.flow = flow
+		self.registry = registry
+		self.delivery = delivery
+		self.decoder = decoder if decoder is not None else PacketDecoder()
+		if verbose is not None:
+			self.Verbose = verbose
+		self.DeviceTypes = dict()
+		if delivery is not None:
+			flow.OnCommand('SetState', self.SetState)
+		self.tracer = tracer
+		if tracer is not None:
+			flow.OnTrigger(self._BeginTrace)
+		return
+	
+	
+	
+	
+	# Methods
+	def Print(self, *args):
+		if self.Verbose:
+			print('[' + self.name + ']', *args)
+		return
+	
+	def SetState(self, command:dict):
+		'''
+		Sends a flow SetState command to its end node. Commands for nodes that aren't in the registry (e.g. the GUI app) are skipped.
+		'''
+		TNID = int(command['TNID'])
+		if (TNID not in self.registry) or (type(command.get('S')) is not str):
+			return
+		self.Print('Sending: node', TNID, 'device', command['AID'], 'state', command['S'])
+		self.delivery.Send(TNID, int(command['AID']), self.DeviceTypes.get(TNID, 'SO'), command['S'], trace=self.trace)
+		return
+	
+	def HandleLine(self, line:str, now:float=None):
+		'''
+		Runs one received line through the room's gateway logic
+		
+		@now: monotonic() time the line was received. If None, monotonic() is used.
+		
+		Returns: str (the name of the trigger that fired), or None
+		'''
+		if now is None:
+			now = monotonic()
+		self.framesReceived += 1
+		self.Print('Received:', line.strip())
+		
+		# Decode and validate the JSON string
+		try:
+			p = self.decoder.Decode(line)
+		except PacketError as e:
+			self.decodeErrors += 1
+			print('[' + self.name + '] ERROR:', e, 'in JSON string:', line.strip())
+			return None
+		decoded = monotonic() if self.tracer is not None else None
+		
+		# Check the packet ID against the node's previous packets
+		pidStatus = self.registry.Observe(p.SNID, p.PID, UT=p.UT, now=now)
+		if pidStatus is None:
+			self.unknownNodes += 1
+			self.Print('ERROR: Packet from unknown node', p.SNID)
+			return None
+		if pidStatus == PID_REPLAYED:
+			self.replayed += 1
+			self.Print('ERROR: Packet ID', p.PID, 'from node', p.SNID, 'has already been received')
+			return None
+		if pidStatus == PID_MISSED:
+			self.Print('WARNING: Missed packets from node', p.SNID)
+		
+		if self.delivery is not None:
+			for command in self.delivery.Observe(p):
+				self.Print('Node', command.TNID, 'confirmed state', command.S, 'of', command.T, command.ID)
+		
+		# Advance the puzzle flow
+		if decoded is not None:
+			self.frameTimes = (now, decoded)
+		trigger = self.flow.Dispatch(p)
+		self.frameTimes = None
+		self.trace = None
+		if trigger is not None:
+			self.Print(trigger, 'fired, advancing to state', self.flow.State)
+		return trigger
+	
+	def _BeginTrace(self, triggerName:str, step:dict):
+		# Called by the flow when a trigger fires, before its commands are sent
+		if self.frameTimes is not None:
+			received, decoded = self.frameTimes
+		else:
+			# Fired by name, not by a frame
+			received = decoded = monotonic()
+		self.trace = self.tracer.Begin(triggerName, received, decoded)
+		return
+	
+	def Poll(self, now:float=None):
+		'''
+		Resends unconfirmed commands. Call regularly, whether or not lines are arriving.
+		'''
+		if self.delivery is None:
+			return
+		for command in self.delivery.Poll(now):
+			print('[' + self.name + '] ERROR: Node', command.TNID, 'did not confirm state', command.S, 'of', command.T, command.ID, 'after', command.Retries, 'retries')
+		return
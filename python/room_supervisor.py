@@ -0,0 +1,278 @@
+# Shards escape rooms across worker processes
+#
+# Each worker process serves its share of the rooms with a MultiRoomGateway (so each room still uses UART, PacketDecoder, NodeRegistry and FlowEngine unchanged) and reports every room's state and counters to the supervisor over a pipe. The supervisor restarts a worker that crashes, or that stops reporting (e.g. wedged in a room's handler), with its rooms resuming from their last reported flow state, so one bad room only costs the rooms that share its worker.
+#
+#	python room_supervisor.py rooms.json [workers]
+#
+# rooms.json is the same file multi_room_gateway.py uses.
+
+import multiprocessing
+import os
+import sys
+from multiprocessing.connection import wait
+from time import monotonic, sleep
+from multi_room_gateway import MultiRoomGateway, LoadRooms, ResolvePort
+
+def RoomReport(room):
+	'''
+	Returns: dict (a room's state and counters, as sent to the supervisor)
+	'''
+	delivery = room.Delivery
+	return {
+		'state': room.Flow.State,
+		'complete': room.Complete,
+		'frames': room.FramesReceived,
+		'decodeErrors': room.DecodeErrors,
+		'unknownNodes': room.UnknownNodes,
+		'replayed': room.Replayed,
+		'commandsPending': delivery.Pending if delivery is not None else 0,
+		'commandsDelivered': delivery.Delivered if delivery is not None else 0,
+		'commandsFailed': delivery.Failed if delivery is not None else 0,
+		'linkQuality': {node.T: round(node.LinkQuality, 3) for node in room.Registry},
+	}
+
+def _AddRoom(gateway, config:dict, port:str):
+	room = gateway.AddRoom(config['name'], port, config['flow'], baudrate=config.get('baudrate', 115200), verbose=config.get('verbose', False), record=config.get('record'))
+	if (room is not None) and (config.get('state') is not None):
+		room.Flow.Reset(config['state'])
+	return room
+
+def WorkerMain(index:int, rooms:list, conn, reportInterval:float):
+	'''
+	Runs in a worker process: serves the rooms and sends a report of every room over conn every reportInterval seconds, until the supervisor sends 'stop' or goes away
+	'''
+	gateway = MultiRoomGateway()
+	waiting = []	# configs of rooms whose USB rule hasn't matched a free port yet
+	for config in rooms:
+		if type(config['port']) is dict:
+			print('[' + config['name'] + '] Waiting for the gateway serial port...')
+			waiting.append(config)
+		else:
+			_AddRoom(gateway, config, config['port'])
+	
+	nextReport = 0.0
+	while True:
+		gateway.RunOnce()
+		now = monotonic()
+		if now < nextReport:
+			continue
+		nextReport = now + reportInterval
+		# Look for the waiting rooms' ports without waiting, so the reports keep going while a board is unplugged
+		for config in list(waiting):
+			port = ResolvePort(config['port'], timeout=0)
+			if port is not None:
+				waiting.remove(config)
+				_AddRoom(gateway, config, port)
+		report = {'worker': index, 'pid': os.getpid(), 'rooms': {room.Name: RoomReport(room) for room in gateway.Rooms}}
+		try:
+			conn.send(report)
+			if conn.poll() and (conn.recv() == 'stop'):
+				break
+		except (BrokenPipeError, EOFError, OSError):
+			break
+	gateway.Close()
+	return
+
+class Worker():
+	'''
+	The supervisor's handle on one worker process
+	'''
+	__slots__ = ('Index', 'Rooms', 'Process', 'Conn', 'StartTime', 'LastReport', 'Restarts', 'RestartTime')
+	
+	def __init__(self, index:int, rooms:list):
+		self.Index = index
+		self.Rooms = rooms	# list of room configs (see LoadRooms)
+		self.Process = None
+		self.Conn = None
+		self.StartTime = None	# monotonic() time the worker was last started
+		self.LastReport = None	# monotonic() time of the last report
+		self.Restarts = 0	# Restarts since the worker last stayed up for HealthyInterval
+		self.RestartTime = None	# monotonic() time the worker is due to be restarted, while it is down
+		return
+
+class RoomSupervisor():
+	'''
+	Starts the worker processes, restarts them when they die or stop reporting, and gathers the reports of every room
+	'''
+	# Public variables
+	ReportInterval = 1.0	# Seconds between a worker's reports
+	HeartbeatTimeout = 10.0	# Seconds without a report before a worker is restarted
+	RestartDelay = 1.0	# Seconds to wait before restarting a worker (doubled on each restart, up to MaxRestartDelay)
+	MaxRestartDelay = 30.0
+	HealthyInterval = 60.0	# Seconds a worker must keep reporting after it is started before its restart delay starts over from RestartDelay
+	
+	# Private variables
+	workers = None	# list of Worker
+	roomStates = None	# dict of room name -> latest report
+	context = None
+	running = False
+	
+	
+	# Properties
+	@property
+	def RoomStates(self):
+		return dict(self.roomStates)
+	
+	@property
+	def Workers(self):
+		return list(self.workers)
+	
+	
+	# Constructor
+	def __init__(self, rooms:list, workers:int=None):
+		'''
+		@rooms: room configs (see LoadRooms)
+		@workers: the number of worker processes. If None, one per room, up to the number of CPUs.
+		'''
+		if workers is None:
+			workers = min(len(rooms), os.cpu_count() or 1)
+		workers = max(1, min(workers, len(rooms)))
+		self.context = multiprocessing.get_context('spawn')	# Never fork a process with open serial ports or threads
+		self.workers = [Worker(i, rooms[i::workers]) for i in range(workers)]
+		self.roomStates = dict()
+		return
+	
+	
+	
+	
+	# Methods
+	def Start(self):
+		for worker in self.workers:
+			self._StartWorker(worker)
+		self.running = True
+		return
+	
+	def Stop(self, timeout:float=5.0):
+		'''
+		Asks every worker to stop, terminating the ones that don't within timeout
+		'''
+		self.running = False
+		for worker in self.workers:
+			if worker.Conn is not None:
+				try:
+					worker.Conn.send('stop')
+				except (BrokenPipeError, OSError):
+					pass
+		deadline = monotonic() + timeout
+		for worker in self.workers:
+			if worker.Process is not None:
+				worker.Process.join(max(0, deadline - monotonic()))
+				if worker.Process.is_alive():
+					worker.Process.terminate()
+					worker.Process.join()
+			self._CloseWorker(worker)
+		return
+	
+	def Poll(self, timeout:float=None):
+		'''
+		Receives the workers' reports (waiting up to timeout for one) and restarts dead or silent workers
+		
+		Returns: int (the number of reports received)
+		'''
+		if timeout is None:
+			timeout = self.ReportInterval
+		if not any(worker.Process is not None for worker in self.workers):
+			# Every worker is waiting to be restarted
+			sleep(timeout)
+		byHandle = dict()
+		for worker in self.workers:
+			if worker.Process is not None:
+				byHandle[worker.Conn] = worker
+				byHandle[worker.Process.sentinel] = worker
+		
+		received = 0
+		for handle in wait(list(byHandle.keys()), timeout):
+			worker = byHandle[handle]
+			if handle is not worker.Conn:
+				continue
+			try:
+				while worker.Conn.poll():
+					report = worker.Conn.recv()
+					self.roomStates.update(report['rooms'])
+					worker.LastReport = monotonic()
+					if worker.LastReport - worker.StartTime >= self.HealthyInterval:
+						worker.Restarts = 0
+					received += 1
+			except (EOFError, OSError):
+				pass
+		
+		now = monotonic()
+		for worker in self.workers:
+			if worker.Process is None:
+				if (worker.RestartTime is not None) and (now >= worker.RestartTime):
+					self._StartWorker(worker)
+				continue
+			if not worker.Process.is_alive():
+				print('Worker', worker.Index, 'exited with code', worker.Process.exitcode, '- restarting')
+				self._RestartWorker(worker)
+			elif now - worker.LastReport > self.HeartbeatTimeout:
+				print('Worker', worker.Index, 'has not reported for', round(now - worker.LastReport, 1), 's - restarting')
+				worker.Process.terminate()
+				worker.Process.join()
+				self._RestartWorker(worker)
+		return received
+	
+	def Run(self):
+		'''
+		Supervises until Stop is called (e.g. from a signal handler)
+		'''
+		if not self.running:
+			self.Start()
+		while self.running:
+			self.Poll()
+		return
+	
+	def _StartWorker(self, worker):
+		parentConn, childConn = self.context.Pipe()
+		# Resume each room from its last reported flow state
+		rooms = []
+		for config in worker.Rooms:
+			config = dict(config)
+			state = self.roomStates.get(config['name'])
+			if state is not None:
+				config['state'] = state['state']
+			rooms.append(config)
+		worker.Process = self.context.Process(target=WorkerMain, args=(worker.Index, rooms, childConn, self.ReportInterval), name='Room worker ' + str(worker.Index), daemon=True)
+		worker.Process.start()
+		childConn.close()
+		worker.Conn = parentConn
+		worker.StartTime = monotonic()
+		worker.LastReport = worker.StartTime	# Give it HeartbeatTimeout to open its ports and report
+		worker.RestartTime = None
+		return
+	
+	def _CloseWorker(self, worker):
+		if worker.Conn is not None:
+			worker.Conn.close()
+			worker.Conn = None
+		if worker.Process is not None:
+			worker.Process.close()
+			worker.Process = None
+		return
+	
+	def _RestartWorker(self, worker):
+		# The worker is started again by Poll once the delay has passed, so the other workers are still served meanwhile
+		self._CloseWorker(worker)
+		delay = min(self.MaxRestartDelay, self.RestartDelay * (2 ** worker.Restarts))
+		worker.Restarts += 1
+		worker.RestartTime = monotonic() + delay
+		return
+
+if __name__ == '__main__':
+	if len(sys.argv) not in (2, 3):
+		print('Usage: python room_supervisor.py rooms.json [workers]')
+		exit(1)
+	supervisor = RoomSupervisor(LoadRooms(sys.argv[1]), workers=int(sys.argv[2]) if len(sys.argv) == 3 else None)
+	supervisor.Start()
+	print('Supervising', len(supervisor.Workers), 'workers')
+	nextPrint = 0.0
+	try:
+		while True:
+			supervisor.Poll()
+			if monotonic() >= nextPrint:
+				nextPrint = monotonic() + 10.0
+				for name, state in sorted(supervisor.RoomStates.items()):
+					print('[' + name + '] state', state['state'], '(escaped)' if state['complete'] else '', state['frames'], 'frames,', state['decodeErrors'], 'decode errors,', state['commandsPending'], 'commands pending')
+	except KeyboardInterrupt:
+		pass
+	supervisor.Stop()
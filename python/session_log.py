@@ -0,0 +1,224 @@
+# Records a serial session to a file and replays it through a room's gateway logic
+#
+# Record a session by giving the UART a SessionRecorder; every received frame and every written line is appended with its monotonic() time:
+#	uart.Recorder = SessionRecorder('library.session')
+#
+# Replay it through a fresh RoomGateway at the recorded speed, N times faster, or as fast as possible:
+#	python session_log.py library.session flows/demo_flow.json [speed|max]
+#
+# File layout (little endian): a header of magic b'ERSL', version (uint16), reserved (uint16) and the offset of the end of the records (uint64), followed by records of timestamp (float64), direction (uint8), payload length (uint32) and the payload bytes.
+
+import mmap
+import os
+import struct
+import sys
+import threading
+from time import monotonic, sleep
+
+RX = 1	# A frame received from the gateway board
+TX = 2	# A line written to the gateway board
+
+MAGIC = b'ERSL'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHHQ')
+RECORD_HEADER = struct.Struct('<dBI')
+
+class SessionRecorder():
+	'''
+	Appends records to a memory-mapped session file, so recording a frame is a copy into memory rather than a write system call. The file grows in chunks of GrowSize bytes and is trimmed to its records on Close. The end offset in the header is updated after each record, so a session cut short by a crash can still be read up to its last whole record.
+	'''
+	# Public variables
+	GrowSize = 1 << 20	# Bytes the file is extended by when it is full
+	
+	# Private variables
+	path = None
+	file = None
+	map = None
+	end = 0	# Offset of the end of the records
+	lock = None
+	records = 0
+	
+	
+	# Properties
+	@property
+	def Path(self):
+		return self.path
+	
+	@property
+	def IsOpen(self):
+		return self.map is not None
+	
+	@property
+	def Records(self):
+		return self.records
+	
+	@property
+	def Size(self):
+		return self.end
+	
+	
+	# Constructor
+	def __init__(self, path:str):
+		'''
+		@path: the session file. If it already holds a session, new records are appended to it (e.g. when a restarted gateway records to the same file).
+		'''
+		self.path = path
+		self.lock = threading.Lock()
+		self.file = open(path, 'a+b')
+		self.file.seek(0, os.SEEK_END)
+		size = self.file.tell()
+		if size >= FILE_HEADER.size:
+			self.file.seek(0)
+			magic, version, reserved, end = FILE_HEADER.unpack(self.file.read(FILE_HEADER.size))
+			if (magic != MAGIC) or (version != VERSION) or (end > size):
+				self.file.close()
+				raise ValueError(path + ' is not a session file')
+			self.end = end
+		else:
+			self.end = FILE_HEADER.size
+		self._Map(max(size, self.end + self.GrowSize))
+		FILE_HEADER.pack_into(self.map, 0, MAGIC, VERSION, 0, self.end)
+		return
+	
+	
+	
+	
+	# Methods
+	def Received(self, data):
+		'''
+		Records a frame received from the gateway board
+		'''
+		self.Record(RX, data)
+		return
+	
+	def Sent(self, data):
+		'''
+		Records a line written to the gateway board
+		'''
+		self.Record(TX, data)
+		return
+	
+	def Record(self, direction:int, data, timestamp:float=None):
+		'''
+		@direction: RX or TX
+		@data: bytes-like payload
+		@timestamp: monotonic() time of the frame. If None, monotonic() is used.
+		'''
+		if timestamp is None:
+			timestamp = monotonic()
+		length = len(data)
+		with self.lock:
+			if self.map is None:
+				return
+			start = self.end
+			end = start + RECORD_HEADER.size + length
+			if end > len(self.map):
+				self._Map(end + self.GrowSize)
+			RECORD_HEADER.pack_into(self.map, start, timestamp, direction, length)
+			self.map[start + RECORD_HEADER.size:end] = data
+			self.end = end
+			struct.pack_into('<Q', self.map, 8, end)
+			self.records += 1
+		return
+	
+	def Flush(self):
+		'''
+		Writes the records to disk
+		'''
+		with self.lock:
+			if self.map is not None:
+				self.map.flush()
+		return
+	
+	def Close(self):
+		with self.lock:
+			if self.map is None:
+				return
+			self.map.flush()
+			self.map.close()
+			self.map = None
+			self.file.truncate(self.end)
+			self.file.close()
+		return
+	
+	def _Map(self, size:int):
+		if self.map is not None:
+			self.map.flush()
+			self.map.close()
+		self.file.truncate(size)
+		self.map = mmap.mmap(self.file.fileno(), size)
+		return
+
+def ReadSession(path:str):
+	'''
+	Generator that yields the records of a session file in the order they were recorded
+	
+	Yields: tuple (timestamp, direction, payload bytes)
+	'''
+	with open(path, 'rb') as f:
+		data = f.read()
+	if len(data) < FILE_HEADER.size:
+		raise ValueError(path + ' is not a session file')
+	magic, version, reserved, end = FILE_HEADER.unpack_from(data, 0)
+	if (magic != MAGIC) or (version != VERSION):
+		raise ValueError(path + ' is not a session file')
+	end = min(end, len(data))
+	offset = FILE_HEADER.size
+	while offset + RECORD_HEADER.size <= end:
+		timestamp, direction, length = RECORD_HEADER.unpack_from(data, offset)
+		offset += RECORD_HEADER.size
+		if offset + length > end:
+			return
+		yield timestamp, direction, data[offset:offset + length]
+		offset += length
+
+def ReplaySession(path:str, room, speed:float=1.0, encoding:str='latin-1'):
+	'''
+	Feeds the received frames of a session file through room.HandleLine, keeping the recorded gaps between them divided by speed. Each frame is handled with its recorded timestamp as its receive time. Written lines are skipped, since the room sends its own.
+	
+	@room: the RoomGateway to replay into. A room without a ReliableDelivery only runs the decode and flow logic.
+	@speed: how many times faster than recorded to replay. If None, frames are replayed as fast as possible.
+	
+	Returns: dict (frames replayed, triggers fired, recorded and replay duration in seconds)
+	'''
+	frames = 0
+	triggers = 0
+	first = None
+	last = None
+	startTime = monotonic()
+	for timestamp, direction, payload in ReadSession(path):
+		if direction != RX:
+			continue
+		if first is None:
+			first = timestamp
+		last = timestamp
+		if speed is not None:
+			delay = (timestamp - first) / speed - (monotonic() - startTime)
+			if delay > 0:
+				sleep(delay)
+		if room.HandleLine(str(payload, encoding), timestamp) is not None:
+			triggers += 1
+		frames += 1
+	return {
+		'frames': frames,
+		'triggers': triggers,
+		'recorded': (last - first) if first is not None else 0.0,
+		'elapsed': monotonic() - startTime,
+	}
+
+if __name__ == '__main__':
+	from flow_engine import FlowEngine, LoadFlow
+	from room_gateway import RoomGateway, RegistryFromFlow
+	
+	if len(sys.argv) not in (3, 4):
+		print('Usage: python session_log.py session flow.json [speed|max]')
+		exit(1)
+	speed = 1.0
+	if len(sys.argv) == 4:
+		speed = None if sys.argv[3] == 'max' else float(sys.argv[3])
+	flow = FlowEngine(LoadFlow(sys.argv[2]))
+	room = RoomGateway('replay', flow, RegistryFromFlow(flow), verbose=False)
+	result = ReplaySession(sys.argv[1], room, speed=speed)
+	rate = result['frames'] / result['elapsed'] if result['elapsed'] > 0 else 0
+	print(result['frames'], 'frames (' + str(round(result['recorded'], 1)), 's recorded) replayed in', round(result['elapsed'], 3), 's,', round(rate), 'frames/s')
+	print(result['triggers'], 'triggers fired,', room.DecodeErrors, 'decode errors,', room.Replayed, 'replayed packets, flow state', flow.State, '(escaped)' if room.Complete else '')
@@ -0,0 +1,187 @@
+# Rolling aggregates of end node sensor readings
+#
+# Readings come from the TL entries of decoded packets. A light sensor reports "Tel:<lux>,Trig:<0 or 1>", which is split into a "lux" and a "trig" reading; every other trigger device reports a number, kept as its "state" reading.
+
+import threading
+from array import array
+from time import monotonic
+
+def ParseSensorState(T:str, S:str):
+	'''
+	Splits a trigger device's state into readings
+	
+	@T: the device type
+	@S: the device state
+	
+	Returns: dict (reading name -> float), empty if the state is not numeric
+	'''
+	if S is None:
+		return {}
+	readings = dict()
+	if S.startswith('Tel:'):
+		for part in S.split(','):
+			name, _, value = part.partition(':')
+			name = {'Tel': 'lux', 'Trig': 'trig'}.get(name, name.lower())
+			try:
+				readings[name] = float(value)
+			except ValueError:
+				pass
+		return readings
+	try:
+		readings['state'] = float(S)
+	except ValueError:
+		pass
+	return readings
+
+class RollingWindow():
+	'''
+	The last Size readings of one sensor in a fixed array, with a running sum, so adding a reading and reading the average are O(1) however fast the sensor reports
+	'''
+	__slots__ = ('Size', 'samples', 'index', 'filled', 'total', 'Count', 'Rising', 'Falling', 'Last', 'LastTime')
+	
+	def __init__(self, size:int):
+		self.Size = size
+		self.samples = array('d', bytes(8 * size))
+		self.index = 0
+		self.filled = 0	# Readings in the window (up to Size)
+		self.total = 0.0	# Sum of the readings in the window
+		self.Count = 0	# Readings since the counters were last reset
+		self.Rising = 0	# Times the reading went up since the counters were last reset
+		self.Falling = 0	# Times the reading went down since the counters were last reset
+		self.Last = None
+		self.LastTime = None
+		return
+	
+	@property
+	def Average(self):
+		if self.filled <= 0:
+			return None
+		return self.total / self.filled
+	
+	def Add(self, value:float, now:float):
+		if self.filled == self.Size:
+			self.total -= self.samples[self.index]
+		else:
+			self.filled += 1
+		self.samples[self.index] = value
+		self.total += value
+		self.index += 1
+		if self.index == self.Size:
+			self.index = 0
+			# Re-add from scratch once per lap so floating point error can't build up
+			self.total = sum(self.samples)
+		
+		if self.Last is not None:
+			if value > self.Last:
+				self.Rising += 1
+			elif value < self.Last:
+				self.Falling += 1
+		self.Count += 1
+		self.Last = value
+		self.LastTime = now
+		return
+	
+	def ResetCounters(self):
+		self.Count = 0
+		self.Rising = 0
+		self.Falling = 0
+		return
+
+class TelemetryAggregator():
+	'''
+	Keeps a RollingWindow for each (node ID, device type, device ID, reading) in the decoded serial stream, and turns them into IoT Central telemetry.
+	'''
+	# Public variables
+	WindowSize = 64	# Readings kept per sensor
+	
+	# Private variables
+	windows = None	# dict of (SNID, T, ID, reading) -> RollingWindow
+	lock = None
+	
+	
+	# Constructor
+	def __init__(self, windowSize:int=None):
+		'''
+		@windowSize: readings kept per sensor. If None, WindowSize is used.
+		'''
+		if windowSize is not None:
+			self.WindowSize = windowSize
+		self.windows = dict()
+		self.lock = threading.Lock()
+		return
+	
+	
+	
+	
+	# Methods
+	def Observe(self, packet, now:float=None):
+		'''
+		Adds the readings in a packet's TL entries
+		
+		@packet: a Packet from PacketDecoder
+		@now: monotonic() time the packet was received. If None, monotonic() is used.
+		'''
+		if not packet.TL:
+			return
+		if now is None:
+			now = monotonic()
+		with self.lock:
+			for device in packet.TL:
+				for reading, value in ParseSensorState(device.T, device.S).items():
+					key = (packet.SNID, device.T, device.ID, reading)
+					window = self.windows.get(key)
+					if window is None:
+						window = RollingWindow(self.WindowSize)
+						self.windows[key] = window
+					window.Add(value, now)
+		return
+	
+	def Window(self, SNID:int, T:str, ID:int, reading:str='state'):
+		'''
+		Returns: RollingWindow, or None (if there have been no such readings)
+		'''
+		return self.windows.get((SNID, T, ID, reading))
+	
+	def Windows(self, T:str, reading:str='state'):
+		'''
+		Returns: list[RollingWindow] (the windows of every device of type T)
+		'''
+		with self.lock:
+			return [w for (SNID, wT, ID, wReading), w in self.windows.items() if (wT == T) and (wReading == reading)]
+	
+	def Snapshot(self, resetCounters:bool=False):
+		'''
+		Returns: dict ((SNID, T, ID, reading) -> dict of average, last, count, rising, falling)
+		'''
+		with self.lock:
+			snapshot = dict()
+			for key, w in self.windows.items():
+				snapshot[key] = {'average': w.Average, 'last': w.Last, 'count': w.Count, 'rising': w.Rising, 'falling': w.Falling}
+				if resetCounters:
+					w.ResetCounters()
+			return snapshot
+	
+	def Heartbeat(self):
+		'''
+		The heartbeat telemetry of the escape room: the average light level over the light sensors' windows, and the latest step mat and button states. Values are 0 until a reading arrives.
+		
+		Returns: dict (telemetry name -> value)
+		'''
+		with self.lock:
+			total = 0.0
+			filled = 0
+			stepState = None
+			buttonState = None
+			for (SNID, T, ID, reading), w in self.windows.items():
+				if (T == 'light') and (reading == 'lux'):
+					total += w.total
+					filled += w.filled
+				elif (T == 'STEP') and (reading == 'state'):
+					stepState = w.Last
+				elif (T == 'BUTN') and (reading == 'state'):
+					buttonState = w.Last
+		return {
+			'AverageLightLevel': (total / filled) if filled > 0 else 0,
+			'StepState': int(stepState) if stepState is not None else 0,
+			'ButtonState': int(buttonState) if buttonState is not None else 0,
+		}
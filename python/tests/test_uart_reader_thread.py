@@ -0,0 +1,76 @@
+# Reader thread behaviour when the serial port fails, e.g. the gateway board is unplugged.
+#
+# Run from the python directory or this one:
+#	python -m pytest tests
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from UART import UART
+
+
+class UnpluggedReaderThreadTest(unittest.TestCase):
+	def setUp(self):
+		self.uart = UART()
+		self.assertTrue(self.uart.Open('loop://', 115200, timeout=0.1))
+	
+	def tearDown(self):
+		if self.uart.readerThread is not None:
+			self.uart.StopReaderThread()
+	
+	def Unplug(self):
+		# The next read fails the way pyserial does when the device disappears
+		def Fail(*args):
+			raise serial.SerialException('device disconnected')
+		self.uart.ser.readinto = Fail
+	
+	def Call(self, func):
+		# Runs func on its own thread so a hang fails the test instead of blocking it
+		result = []
+		t = threading.Thread(target=lambda: result.append(func()), daemon=True)
+		t.start()
+		t.join(3)
+		self.assertFalse(t.is_alive(), 'blocked on a dead reader thread')
+		return result[0]
+	
+	def WaitForReaderExit(self):
+		deadline = time.monotonic() + 3
+		while self.uart.ReaderThreadRunning and time.monotonic() < deadline:
+			time.sleep(0.01)
+		self.assertFalse(self.uart.ReaderThreadRunning)
+	
+	def test_ReadLine_returns_None_after_unplug(self):
+		self.assertTrue(self.uart.StartReaderThread())
+		self.Unplug()
+		self.assertIsNone(self.Call(self.uart.ReadLine))
+		self.WaitForReaderExit()
+		self.assertIsNone(self.Call(self.uart.ReadLine))
+		self.assertEqual(self.uart.SerialErrors, 1)
+	
+	def test_queued_lines_are_returned_before_None(self):
+		self.uart.WriteLine('one')
+		self.uart.WriteLine('two')
+		self.assertTrue(self.uart.StartReaderThread())
+		deadline = time.monotonic() + 3
+		while self.uart.QueueDepth < 2 and time.monotonic() < deadline:
+			time.sleep(0.01)
+		self.Unplug()
+		self.WaitForReaderExit()
+		self.assertEqual(self.Call(lambda: self.uart.ReadLine(stripNewline=True)), 'one')
+		self.assertEqual(self.Call(lambda: self.uart.ReadLine(stripNewline=True)), 'two')
+		self.assertIsNone(self.Call(self.uart.ReadLine))
+	
+	def test_IterLines_ends_after_unplug(self):
+		self.assertTrue(self.uart.StartReaderThread())
+		self.Unplug()
+		self.assertEqual(self.Call(lambda: list(self.uart.IterLines())), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
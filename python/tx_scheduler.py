@@ -0,0 +1,263 @@
+# Paced, non-blocking transmit queue for a UART
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+class TxScheduler():
+	'''
+	Sends lines through a UART from a dedicated writer thread, paced by a token bucket so the gateway isn't flooded, without ever making the caller (or the read path) sleep.
+	
+	Each submitted line has a key (e.g. (TNID, AID) for an activation command). Submitting a key that is still waiting replaces the waiting line instead of queueing a second one, so repeated commands for the same target and activation are sent once, with the newest content, in the original place in the queue.
+	
+	Lines can be queued per target node. The writer takes one line from each node's queue in turn, so a burst of commands for one node can't hold up the others.
+	'''
+	# Public variables
+	Rate = 2.0	# Lines per second the bucket refills at
+	Burst = 1	# Lines that may be sent back to back after an idle period
+	
+	# Private variables
+	uart = None
+	queues = None	# OrderedDict of node -> OrderedDict of key -> [line or function returning the line, submit time, onSent], in round-robin order
+	pending = 0	# Lines waiting in all queues
+	inFlight = 0	# Lines taken from the queues and not yet written (or skipped)
+	condition = None
+	thread = None
+	running = False
+	tokens = 0.0
+	tokensTime = 0.0
+	
+	sent = 0
+	skipped = 0
+	coalesced = 0
+	latencyTotal = 0.0
+	latencyMax = 0.0
+	lastLatency = None
+	
+	
+	# Properties
+	@property
+	def Pending(self):
+		return self.pending
+	
+	@property
+	def Nodes(self):
+		'''
+		Returns: dict (node -> number of lines waiting for it)
+		'''
+		with self.condition:
+			return {node: len(q) for node, q in self.queues.items()}
+	
+	@property
+	def Sent(self):
+		return self.sent
+	
+	@property
+	def Skipped(self):
+		'''
+		Returns: int (lines whose function returned None, so nothing was written)
+		'''
+		return self.skipped
+	
+	@property
+	def Coalesced(self):
+		return self.coalesced
+	
+	@property
+	def AverageLatency(self):
+		'''
+		Average seconds between a line being submitted and it being written
+		'''
+		if self.sent <= 0:
+			return None
+		return self.latencyTotal / self.sent
+	
+	@property
+	def MaxLatency(self):
+		return self.latencyMax
+	
+	@property
+	def LastLatency(self):
+		return self.lastLatency
+	
+	
+	# Constructor
+	def __init__(self, uart, rate:float=None, burst:int=None, autostart:bool=True):
+		'''
+		@uart: the open UART to write to
+		@rate: lines per second. If None, Rate is used.
+		@burst: lines that may be sent back to back. If None, Burst is used.
+		@autostart: If true, starts the writer thread
+		'''
+		self.uart = uart
+		if rate is not None:
+			self.Rate = rate
+		if burst is not None:
+			self.Burst = burst
+		self.queues = OrderedDict()
+		self.condition = threading.Condition()
+		self.tokens = float(self.Burst)
+		self.tokensTime = monotonic()
+		if autostart:
+			self.Start()
+		return
+	
+	
+	
+	
+	# Methods
+	def Start(self):
+		if (self.thread is not None) and self.thread.is_alive():
+			return
+		self.running = True
+		self.thread = threading.Thread(target=self._WriterLoop, name='UART writer', daemon=True)
+		self.thread.start()
+		return
+	
+	def Stop(self, flush:bool=True, timeout:float=None):
+		'''
+		Stops the writer thread
+		
+		@flush: If true, lines still waiting are sent first
+		@timeout: the longest time to wait for the waiting lines to be sent
+		'''
+		if flush:
+			self.Flush(timeout)
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		return
+	
+	def Submit(self, key, line, node=None, onSent=None):
+		'''
+		Queues a line to be sent. Returns immediately.
+		
+		@key: identifies what the line is for. A line with the same key waiting in the same node's queue is replaced.
+		@line: str, or a function returning the str (or None to send nothing), called on the writer thread just before the line is written (so anything that must follow the wire order, like a packet ID, can be filled in then)
+		@node: the queue the line waits in (e.g. the target node ID). Lines without a node share one queue.
+		@onSent: function(sentTime) called on the writer thread once the line has been written
+		
+		Returns: bool (True if a waiting line with the same key was replaced)
+		'''
+		with self.condition:
+			q = self.queues.get(node)
+			if q is None:
+				q = OrderedDict()
+				self.queues[node] = q
+			entry = q.get(key)
+			if entry is not None:
+				entry[0] = line
+				entry[2] = onSent
+				self.coalesced += 1
+				return True
+			q[key] = [line, monotonic(), onSent]
+			self.pending += 1
+			self.condition.notify()
+		return False
+	
+	def Cancel(self, key, node=None):
+		'''
+		Removes a waiting line
+		
+		Returns: bool (True if the line was still waiting)
+		'''
+		with self.condition:
+			q = self.queues.get(node)
+			if (q is None) or (q.pop(key, None) is None):
+				return False
+			self.pending -= 1
+			if len(q) <= 0:
+				del self.queues[node]
+			return True
+	
+	def Flush(self, timeout:float=None):
+		'''
+		Waits until every waiting line has been sent, including the one being written
+		
+		Returns: bool (True if nothing is waiting or being written anymore)
+		'''
+		with self.condition:
+			return self.condition.wait_for(lambda: ((self.pending == 0) and (self.inFlight == 0)) or (not self.running), timeout)
+	
+	def _TakeToken(self):
+		'''
+		Returns: float (0 if a token was taken, otherwise the seconds until the next one is available)
+		'''
+		now = monotonic()
+		self.tokens = min(float(self.Burst), self.tokens + (now - self.tokensTime) * self.Rate)
+		self.tokensTime = now
+		if self.tokens >= 1.0:
+			self.tokens -= 1.0
+			return 0.0
+		return (1.0 - self.tokens) / self.Rate
+	
+	def Poll(self):
+		'''
+		Sends the waiting lines the token bucket allows right now, on the calling thread. For event loops that drive the scheduler themselves instead of running the writer thread (autostart=False).
+		
+		Returns: float (seconds until the next waiting line can be sent), or None (if nothing is waiting)
+		'''
+		while True:
+			with self.condition:
+				if self.pending == 0:
+					return None
+				wait = self._TakeToken()
+				if wait > 0:
+					return wait
+				line, submitTime, onSent = self._PopNext()
+			self._Send(line, submitTime, onSent)
+	
+	def _PopNext(self):
+		# Call with the condition held. Takes the oldest line of the next node in turn, then sends that node to the back.
+		node, q = next(iter(self.queues.items()))
+		key, (line, submitTime, onSent) = q.popitem(last=False)
+		self.pending -= 1
+		self.inFlight += 1
+		if len(q) > 0:
+			self.queues.move_to_end(node)
+		else:
+			del self.queues[node]
+		return line, submitTime, onSent
+	
+	def _Send(self, line, submitTime:float, onSent=None):
+		try:
+			if callable(line):
+				line = line()
+			if line is None:
+				# Nothing was written, so the line doesn't use up a token or count as sent
+				with self.condition:
+					self.skipped += 1
+					self.tokens = min(float(self.Burst), self.tokens + 1.0)
+				return
+			self.uart.WriteLine(line)
+			sentTime = monotonic()
+			latency = sentTime - submitTime
+			with self.condition:
+				self.sent += 1
+				self.latencyTotal += latency
+				self.latencyMax = max(self.latencyMax, latency)
+				self.lastLatency = latency
+			if onSent is not None:
+				onSent(sentTime)
+		finally:
+			with self.condition:
+				self.inFlight -= 1
+				self.condition.notify_all()
+		return
+	
+	def _WriterLoop(self):
+		while True:
+			with self.condition:
+				while self.running and (self.pending == 0):
+					self.condition.wait()
+				if not self.running:
+					return
+				wait = self._TakeToken()
+				if wait > 0:
+					self.condition.wait(wait)
+					continue
+				line, submitTime, onSent = self._PopNext()
+			self._Send(line, submitTime, onSent)
@@ -0,0 +1,427 @@
+# Simulates a gateway board and its end nodes on a pseudo-terminal, so the Python gateway can be run and benchmarked without hardware
+#
+# The simulator opens a pty and behaves like the Gateway sketch with end nodes behind it: every node sends its state as a JSON line ("\r\n" terminated, as the gateway's println does) at its own rate, and answers AL packets addressed to it the way EscapeRoomEndNode::ParseRxJsonStr does (setting states, sending requested states on its next transfer). Packet IDs can be made to skip and lines to arrive corrupted. Open Port with UART like a real serial port:
+#	fleet = VirtualFleet(extraNodes=200, rate=5)
+#	fleet.Start()
+#	uart.Open(fleet.Port, baudrate=115200)
+#
+#	python virtual_fleet.py [--extra-nodes N] [--rate R] [--gap-rate P] [--corrupt-rate P] [--duration S]
+
+import argparse
+import errno
+import heapq
+import json
+import os
+import random
+import select
+import threading
+import tty
+from time import monotonic
+
+# The demo room's end nodes: node ID -> (node name, activation devices, trigger devices), each device an (ID, type) pair
+DEMO_NODES = {
+	3: ('light', [], [(1, 'light')]),
+	4: ('SO', [(1, 'SO'), (2, 'SO')], []),
+	5: ('BUTN', [], [(1, 'BUTN')]),
+	6: ('LED', [(1, 'SO')], []),	# LED200_main.ino drives the LED as an SO device
+	7: ('STEP', [], [(1, 'STEP')]),
+}
+
+# Trigger device types the extra nodes cycle through
+EXTRA_NODE_TYPES = ('light', 'BUTN', 'STEP')
+
+_JSON_SEPARATORS = (',', ':')
+
+class VirtualDevice():
+	'''
+	An activation or trigger device on a virtual end node
+	'''
+	__slots__ = ('ID', 'T', 'S', 'Requested')
+	
+	def __init__(self, ID:int, T:str, S:str='0'):
+		self.ID = ID
+		self.T = T
+		self.S = S
+		self.Requested = False	# The server asked for this device's state
+		return
+
+class VirtualNode():
+	'''
+	One end node. Like the firmware, it keeps a single packet ID that follows the packets it receives and is incremented for each packet it sends.
+	'''
+	__slots__ = ('ID', 'Name', 'Period', 'ActivationDevices', 'TriggerDevices', 'PacketID', 'ErrorString', 'StartTime', 'Received', 'Ignored', 'lux')
+	
+	def __init__(self, ID:int, name:str, period:float, activationDevices, triggerDevices, now:float):
+		self.ID = ID
+		self.Name = name
+		self.Period = period	# Seconds between the node's state packets (None to only send when asked)
+		self.ActivationDevices = [VirtualDevice(i, T) for i, T in activationDevices]
+		self.TriggerDevices = [VirtualDevice(i, T, '1' if T == 'BUTN' else '0') for i, T in triggerDevices]
+		self.PacketID = 0
+		self.ErrorString = ''
+		self.StartTime = now
+		self.Received = 0	# Packets accepted
+		self.Ignored = 0	# Packets rejected for a replayed packet ID or a bad entry
+		self.lux = 400.0
+		return
+	
+	def Receive(self, d:dict):
+		'''
+		Applies a packet addressed to this node
+		
+		Returns: bool (True if the node has states to send back)
+		'''
+		PID = d.get('PID')
+		if type(PID) is not int:
+			self.ErrorString = 'PID invalid type'
+			self.Ignored += 1
+			return False
+		if PID < self.PacketID + 1:
+			self.ErrorString = 'Received packet ID ' + str(PID) + ', which has already been received before'
+			self.Ignored += 1
+			return False
+		if PID > self.PacketID + 1:
+			self.ErrorString = 'Missed packets ' + str(self.PacketID + 1) + ' to ' + str(PID - 1)
+		self.PacketID = PID
+		self.Received += 1
+		
+		reply = False
+		for entry in (d.get('AL') or []):
+			for device in self.ActivationDevices:
+				if (device.ID == entry.get('ID')) and (device.T == entry.get('T')):
+					if 'S' in entry:
+						if type(entry['S']) is str:
+							device.S = entry['S']
+						else:
+							self.ErrorString = 'AD S invalid type'
+					else:
+						device.Requested = True
+						reply = True
+		for entry in (d.get('TL') or []):
+			for device in self.TriggerDevices:
+				if (device.ID == entry.get('ID')) and (device.T == entry.get('T')) and ('S' not in entry):
+					device.Requested = True
+					reply = True
+		return reply
+	
+	def Sense(self, rng):
+		'''
+		Moves the trigger devices' states along: the light level wanders and trips above 800 lux, the step mat is stepped on and the button pressed now and then
+		'''
+		for device in self.TriggerDevices:
+			if device.T == 'light':
+				self.lux = min(1000.0, max(0.0, self.lux + rng.uniform(-50.0, 50.0)))
+				device.S = 'Tel:%.2f,Trig:%d' % (self.lux, self.lux > 800.0)
+			elif device.T == 'STEP':
+				device.S = '1' if rng.random() < 0.1 else '0'
+			elif device.T == 'BUTN':
+				device.S = '0' if rng.random() < 0.1 else '1'
+		return
+	
+	def Transmit(self, now:float, sendStateOfAll:bool):
+		'''
+		Builds the node's next packet, like EscapeRoomEndNode::CreateTxJsonStr
+		
+		Returns: dict (the packet), or None (if there is nothing to send)
+		'''
+		AL = [device for device in self.ActivationDevices if sendStateOfAll or device.Requested]
+		TL = [device for device in self.TriggerDevices if sendStateOfAll or device.Requested]
+		if not (AL or TL or self.ErrorString):
+			return None
+		self.PacketID += 1
+		d = {'SNID': self.ID, 'TNID': 1, 'PID': self.PacketID, 'UT': int((now - self.StartTime) * 1000)}
+		if AL:
+			d['AL'] = [{'ID': device.ID, 'T': device.T, 'S': device.S} for device in AL]
+		if TL:
+			d['TL'] = [{'ID': device.ID, 'T': device.T, 'S': device.S} for device in TL]
+		if self.ErrorString:
+			d['ER'] = self.ErrorString
+			self.ErrorString = ''
+		for device in AL + TL:
+			device.Requested = False
+		return d
+
+class VirtualFleet():
+	'''
+	The gateway board and end nodes behind a pty. Node transmissions are kept in a heap ordered by due time, so the loop costs the same per packet whether there are five nodes or five hundred.
+	'''
+	# Public variables
+	Rate = 1.0	# State packets per second sent by each node
+	GapRate = 0.0	# Fraction of packets whose packet ID skips ahead, as if packets were lost over the air
+	CorruptRate = 0.0	# Fraction of lines that arrive corrupted (truncated, a byte flipped or the closing brace lost)
+	ResponseDelay = 0.05	# Seconds between a node receiving a state request and its answer reaching the gateway
+	MaxBacklog = 1 << 16	# Bytes waiting to be read by the gateway before new lines are dropped, like a serial overrun
+	
+	# Private variables
+	nodes = None	# dict of node ID -> VirtualNode
+	schedule = None	# heap of (due time, sequence, node ID, periodic)
+	sequence = 0
+	rng = None
+	master = None	# pty master fd (the simulator's end)
+	slave = None	# pty slave fd, kept open so the master doesn't see EIO while no gateway has the port open
+	port = None
+	outbound = None	# bytearray of lines not yet taken by the pty
+	inbound = None	# bytearray of a partial command line
+	thread = None
+	running = False
+	
+	linesSent = 0
+	bytesSent = 0
+	gaps = 0
+	corrupted = 0
+	dropped = 0
+	commandsReceived = 0
+	commandErrors = 0
+	
+	
+	# Properties
+	@property
+	def Port(self):
+		return self.port
+	
+	@property
+	def Nodes(self):
+		return list(self.nodes.values())
+	
+	@property
+	def Running(self):
+		return self.running
+	
+	
+	# Constructor
+	def __init__(self, nodes:dict=None, extraNodes:int=0, rate:float=None, gapRate:float=None, corruptRate:float=None, seed=None):
+		'''
+		@nodes: node ID -> (node name, activation devices, trigger devices). If None, DEMO_NODES.
+		@extraNodes: trigger-only nodes added after the highest node ID, cycling through EXTRA_NODE_TYPES
+		@rate: state packets per second per node. If None, Rate is used.
+		@gapRate: If not None, overrides GapRate
+		@corruptRate: If not None, overrides CorruptRate
+		@seed: random seed, for repeatable runs
+		'''
+		if rate is not None:
+			self.Rate = rate
+		if gapRate is not None:
+			self.GapRate = gapRate
+		if corruptRate is not None:
+			self.CorruptRate = corruptRate
+		if nodes is None:
+			nodes = DEMO_NODES
+		self.rng = random.Random(seed)
+		
+		now = monotonic()
+		period = (1.0 / self.Rate) if self.Rate > 0 else None
+		self.nodes = dict()
+		for ID, (name, activationDevices, triggerDevices) in nodes.items():
+			self.nodes[ID] = VirtualNode(ID, name, period, activationDevices, triggerDevices, now)
+		nextID = max(self.nodes.keys(), default=1) + 1
+		for i in range(extraNodes):
+			T = EXTRA_NODE_TYPES[i % len(EXTRA_NODE_TYPES)]
+			self.nodes[nextID + i] = VirtualNode(nextID + i, T, period, [], [(1, T)], now)
+		
+		self.schedule = []
+		if period is not None:
+			for node in self.nodes.values():
+				# Spread the first packets over one period so the nodes don't send in lockstep
+				self._Schedule(now + self.rng.uniform(0, period), node.ID, True)
+		
+		self.master, self.slave = os.openpty()
+		tty.setraw(self.master)
+		tty.setraw(self.slave)
+		os.set_blocking(self.master, False)
+		self.port = os.ttyname(self.slave)
+		self.outbound = bytearray()
+		self.inbound = bytearray()
+		return
+	
+	
+	
+	
+	# Methods
+	def Stats(self):
+		'''
+		Returns: dict (lines and bytes sent, packet ID gaps, corrupted and dropped lines, commands received and malformed)
+		'''
+		return {
+			'linesSent': self.linesSent,
+			'bytesSent': self.bytesSent,
+			'gaps': self.gaps,
+			'corrupted': self.corrupted,
+			'dropped': self.dropped,
+			'commandsReceived': self.commandsReceived,
+			'commandErrors': self.commandErrors,
+		}
+	
+	
+	def Start(self):
+		'''
+		Runs the simulator on its own thread
+		'''
+		if self.thread is not None:
+			return
+		self.running = True
+		self.thread = threading.Thread(target=self._Loop, name='Virtual fleet', daemon=True)
+		self.thread.start()
+		return
+	
+	def Stop(self):
+		self.running = False
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		return
+	
+	def Close(self):
+		self.Stop()
+		if self.master is not None:
+			os.close(self.master)
+			os.close(self.slave)
+			self.master = None
+			self.slave = None
+		return
+	
+	def Run(self, duration:float=None):
+		'''
+		Runs the simulator on this thread for duration seconds (or until Stop is called)
+		'''
+		self.running = True
+		self._Loop(duration)
+		return
+	
+	def RunOnce(self, timeout:float):
+		'''
+		Sends the packets that are due, then waits up to timeout (or until the next packet is due) for commands from the gateway and answers them
+		'''
+		now = monotonic()
+		while self.schedule and (self.schedule[0][0] <= now):
+			due, sequence, ID, periodic = heapq.heappop(self.schedule)
+			node = self.nodes[ID]
+			if periodic:
+				node.Sense(self.rng)
+				self._Schedule(due + node.Period * self.rng.uniform(0.9, 1.1), ID, True)
+			packet = node.Transmit(now, periodic)
+			if packet is not None:
+				self._Emit(node, packet)
+		
+		if self.schedule:
+			timeout = max(0.0, min(timeout, self.schedule[0][0] - monotonic()))
+		writers = [self.master] if self.outbound else []
+		readable, writable, exceptional = select.select([self.master], writers, [], timeout)
+		if writable:
+			self._Flush()
+		if readable:
+			self._ReceiveCommands()
+		return
+	
+	def _Loop(self, duration:float=None):
+		endTime = (monotonic() + duration) if duration is not None else None
+		while self.running:
+			if (endTime is not None) and (monotonic() >= endTime):
+				break
+			self.RunOnce(0.1)
+		self.running = False
+		return
+	
+	def _Schedule(self, due:float, ID:int, periodic:bool):
+		self.sequence += 1
+		heapq.heappush(self.schedule, (due, self.sequence, ID, periodic))
+		return
+	
+	def _Emit(self, node, packet:dict):
+		if self.rng.random() < self.GapRate:
+			# Lose the packet(s) before this one over the air
+			skipped = self.rng.randint(1, 3)
+			node.PacketID += skipped
+			packet['PID'] = node.PacketID
+			self.gaps += 1
+		line = json.dumps(packet, separators=_JSON_SEPARATORS).encode('latin-1')
+		if self.rng.random() < self.CorruptRate:
+			line = self._Corrupt(line)
+			self.corrupted += 1
+		line += b'\r\n'
+		if len(self.outbound) + len(line) > self.MaxBacklog:
+			self.dropped += 1
+			return
+		self.outbound += line
+		self.linesSent += 1
+		self.bytesSent += len(line)
+		self._Flush()
+		return
+	
+	def _Corrupt(self, line:bytes):
+		kind = self.rng.randrange(3)
+		if kind == 0:
+			return line[:self.rng.randrange(1, len(line))]
+		if kind == 1:
+			i = self.rng.randrange(len(line))
+			return line[:i] + bytes([line[i] ^ (1 << self.rng.randrange(7))]) + line[i + 1:]
+		return line[:-1]
+	
+	def _Flush(self):
+		try:
+			count = os.write(self.master, self.outbound)
+		except BlockingIOError:
+			return
+		except OSError as e:
+			if e.errno == errno.EIO:
+				# No gateway has the port open
+				return
+			raise
+		del self.outbound[:count]
+		return
+	
+	def _ReceiveCommands(self):
+		try:
+			data = os.read(self.master, 65536)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as e:
+			if e.errno == errno.EIO:
+				return
+			raise
+		self.inbound += data
+		while True:
+			index = self.inbound.find(b'\n')
+			if index < 0:
+				break
+			line = bytes(self.inbound[:index]).strip()
+			del self.inbound[:index + 1]
+			if line:
+				self._HandleCommand(line)
+		return
+	
+	def _HandleCommand(self, line:bytes):
+		self.commandsReceived += 1
+		try:
+			d = json.loads(line)
+		except ValueError:
+			self.commandErrors += 1
+			return
+		if (type(d) is not dict) or (type(d.get('TNID')) is not int):
+			self.commandErrors += 1
+			return
+		node = self.nodes.get(d['TNID'])
+		if node is None:
+			return
+		if node.Receive(d):
+			self._Schedule(monotonic() + self.ResponseDelay, node.ID, False)
+		return
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Simulates a gateway board and its end nodes on a pseudo-terminal')
+	parser.add_argument('--extra-nodes', type=int, default=0, help='trigger-only nodes added to the demo nodes')
+	parser.add_argument('--rate', type=float, default=1.0, help='state packets per second per node')
+	parser.add_argument('--gap-rate', type=float, default=0.0, help='fraction of packets whose packet ID skips ahead')
+	parser.add_argument('--corrupt-rate', type=float, default=0.0, help='fraction of lines sent corrupted')
+	parser.add_argument('--duration', type=float, default=None, help='seconds to run (default: until Ctrl+C)')
+	parser.add_argument('--seed', type=int, default=None)
+	args = parser.parse_args()
+	
+	fleet = VirtualFleet(extraNodes=args.extra_nodes, rate=args.rate, gapRate=args.gap_rate, corruptRate=args.corrupt_rate, seed=args.seed)
+	print('Simulating', len(fleet.Nodes), 'nodes on', fleet.Port)
+	try:
+		fleet.Run(args.duration)
+	except KeyboardInterrupt:
+		pass
+	fleet.Close()
+	for name, value in fleet.Stats().items():
+		print(name + ':', value)